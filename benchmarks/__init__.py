@@ -0,0 +1,6 @@
+'''
+Micro-benchmarks of lapels and modtools. Run a benchmark as a module from the
+top directory, e.g. python -m benchmarks.benchCigarBuilder
+
+Synthetic MOD, VCF, FASTA and BAM files are made by benchmarks.synthetic.
+'''
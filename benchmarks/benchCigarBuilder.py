@@ -0,0 +1,78 @@
+'''
+Benchmark of detecting the MIDM pattern (an insertion followed by a deletion)
+in built cigars: the regex on cigar strings versus the ops tracked by
+CigarBuilder.
+'''
+
+import re
+import random
+import timeit
+
+from lapels import cigarutils as cu
+from lapels import cigarbuilder
+
+SIZES = [100, 10000]
+
+
+def makeRegions(nOps, hasMIDM, seed=0):
+    '''Make regions of a read whose built cigar has about nOps ops.'''
+    rng = random.Random(seed)
+    regions = []
+    pos = 0
+    while len(regions) < nOps // 2:
+        length = rng.randint(1, 20)
+        # An M_0 followed by an I_0, or by a gap of deletions.
+        if rng.random() < 0.5:
+            cigar = [(0, length), (1, rng.randint(1, 5))]
+            pos += length
+        else:
+            cigar = [(0, length)]
+            pos += length + rng.randint(1, 5)
+        regions.append((0, cigar, pos - length, pos - 1))
+    # Keep the MIDM pattern out, except at the end if wanted.
+    for i in range(len(regions) - 1):
+        if regions[i][1][-1][0] == 1 and regions[i+1][2] > regions[i][3] + 1:
+            regions[i] = (0, regions[i][1][:1], regions[i][2], regions[i][3])
+    if hasMIDM:
+        end = regions[-1][3]
+        regions.append((0, [(1, 2)], end + 1, end))
+        regions.append((0, [(0, 5)], end + 3, end + 7))
+    return regions
+
+
+def buildOnly(regions):
+    cb = cigarbuilder.CigarBuilder()
+    for reg in regions:
+        cb.append(reg)
+    return cb
+
+
+def regexTrigger(regions):
+    cb = buildOnly(regions)
+    return re.match('.*\d*I,\d*D', cu.toString(cb.cigar)) is not None
+
+
+def structuralTrigger(regions):
+    return buildOnly(regions).hasMIDM
+
+
+def main():
+    print("%8s %6s %14s %14s %8s" % ('ops', 'MIDM', 'regex (us)', 
+                                     'builder (us)', 'speedup'))
+    for nOps in SIZES:
+        for hasMIDM in [False, True]:
+            regions = makeRegions(nOps, hasMIDM)
+            assert regexTrigger(regions) == hasMIDM
+            assert structuralTrigger(regions) == hasMIDM
+            number = max(1, 100000 // nOps)
+            times = []
+            for func in [regexTrigger, structuralTrigger]:
+                timer = timeit.Timer(lambda: func(regions))
+                times.append(min(timer.repeat(3, number)) / number * 1e6)
+            print("%8d %6s %14.1f %14.1f %7.1fx" % 
+                  (len(buildOnly(regions).cigar), hasMIDM, times[0], times[1],
+                   times[0] / times[1]))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,149 @@
+'''
+Micro-benchmarks of the hot paths of annotation on synthetic data: parsing
+target regions, mapping positions, building position maps and sequences,
+cigar utilities, fixing mates and iterating VCF records.
+'''
+
+import shutil
+import logging
+import tempfile
+import timeit
+import pysam
+
+from lapels import annotator
+from lapels import cigarutils as cu
+from lapels import matefixer
+from modtools import tmpmod
+from modtools.mod import Mod
+from modtools.vcfreader import VCFReader
+
+from benchmarks import synthetic
+
+OPTIONS = {'chromLen': 300000, 'density': 0.01, 'nFragments': 2000}
+REPEAT = 3
+
+
+def timeItems(func, nItems, number=1):
+    '''Return the best time of func in microseconds per item.'''
+    timer = timeit.Timer(func)
+    return min(timer.repeat(REPEAT, number)) / number / nItems * 1e6
+
+
+def benchParseTargetRegion(data, mod, chromLen):
+    a = annotator.Annotator(data['chroms'][0], chromLen, mod, [], 0)
+    a.execute()     # Set up the maps and blocks, with no reads
+    items = []
+    for rseq in data['reads']:
+        for treg in annotator.getTargetRegions(rseq):
+            if treg[0] == 0:
+                items.append((treg, rseq))
+    def run():
+        for treg, rseq in items:
+            a.parseTargetRegion(treg, rseq)
+    return 'Annotator.parseTargetRegion', len(items), timeItems(run,
+                                                                len(items))
+
+
+def benchPosMap(data, mod, chromLen):
+    chrom = data['chroms'][0]
+    posmap = mod.getPosMap(chrom, chromLen)
+    refLen = len(data['refSeqs'][chrom])
+    newLen = len(data['targetSeqs'][chrom])
+    refPoses = [(chrom, pos) for pos in range(0, refLen, refLen // 10000)]
+    newPoses = [(chrom, pos) for pos in range(0, newLen, newLen // 10000)]
+    def fmap():
+        for pos in refPoses:
+            posmap.fmap(pos)
+    def bmap():
+        for pos in newPoses:
+            posmap.bmap(pos)
+    return [('PosMap.fmap', len(refPoses), timeItems(fmap, len(refPoses))),
+            ('PosMap.bmap', len(newPoses), timeItems(bmap, len(newPoses)))]
+
+
+def benchBuildPosMap(data, mod, chromLen):
+    return 'Mod.buildPosMap (per row)', len(mod), \
+           timeItems(lambda: mod.buildPosMap(chromLen), len(mod))
+
+
+def benchBuildSeq(data, mod, chromLen):
+    fasta = pysam.Fastafile(data['fasta'])
+    chrom = data['chroms'][0]
+    def run():
+        mod.buildSeq(fasta, chrom, fasta.references)
+    ret = 'Mod.buildSeq (per row)', len(mod), timeItems(run, len(mod))
+    assert mod.seq == data['targetSeqs'][chrom]
+    return ret
+
+
+def benchCigarUtils(data, mod, chromLen):
+    reads = data['reads']
+    # Split the first op, so that there is something to simplify.
+    cigars = [[(rseq.cigar[0][0], 1), (rseq.cigar[0][0],
+                                       rseq.cigar[0][1] - 1)] + rseq.cigar[1:]
+              for rseq in reads]
+    windows = [(rseq.cigar, rseq.pos, rseq.pos + 10, rseq.aend - 11)
+               for rseq in reads]
+    def simplify():
+        for cigar in cigars:
+            cu.simplify(cigar)
+    def sub():
+        for cigar, pos, start, end in windows:
+            cu.sub(cigar, pos, start, end)
+    return [('cigarutils.simplify', len(cigars), timeItems(simplify,
+                                                           len(cigars))),
+            ('cigarutils.sub', len(windows), timeItems(sub, len(windows)))]
+
+
+def benchProcess(data, mod, chromLen):
+    groups = dict()
+    for rseq in data['reads']:
+        groups.setdefault(rseq.qname, []).append(rseq)
+    groups = groups.values()
+    rname = lambda tid: data['chroms'][tid]
+    def run():
+        for reads in groups:
+            matefixer.process(reads, rname)
+    return 'matefixer.process (per name)', len(groups), \
+           timeItems(run, len(groups))
+
+
+def benchVCFIterator(data, mod, chromLen):
+    reader = VCFReader(data['vcf'], [synthetic.SAMPLE])
+    chrom = data['chroms'][0]
+    nRecords = sum(1 for row in reader.fetch(chrom))
+    def run():
+        for row in reader.fetch(chrom):
+            pass
+    return 'VCFIterator (per record)', nRecords, timeItems(run, nRecords)
+
+
+BENCHMARKS = [benchParseTargetRegion, benchPosMap, benchBuildPosMap,
+              benchBuildSeq, benchCigarUtils, benchProcess, benchVCFIterator]
+
+
+def main():
+    logging.basicConfig(level=logging.WARNING)
+    tmpDir = tempfile.mkdtemp()
+    try:
+        data = synthetic.generate(tmpDir, **OPTIONS)
+        modName = tmpmod.getIndexedMod(data['mod'])[0]
+        mod = Mod(modName)
+        chrom = data['chroms'][0]
+        mod.load(chrom)
+        chromLen = mod.meta.getChromLength(chrom)
+        print("%d variant row(s), %d read(s)" % (len(mod),
+                                                len(data['reads'])))
+        print("%-32s %10s %14s" % ('benchmark', 'items', 'us per item'))
+        for bench in BENCHMARKS:
+            results = bench(data, mod, chromLen)
+            if not isinstance(results, list):
+                results = [results]
+            for name, nItems, usPerItem in results:
+                print("%-32s %10d %14.2f" % (name, nItems, usPerItem))
+    finally:
+        shutil.rmtree(tmpDir)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,245 @@
+'''
+End-to-end scaling benchmark of pylapels across numbers of processes and
+input sizes, on synthetic data made offline by benchmarks.synthetic.
+
+For each input size, the inputs are generated once in the work directory and
+reused, with the MOD indexed and its position maps saved beforehand, so that
+every run does the same work. Each run records its wall time, the peak RSS
+of its process tree (summed over the processes, by PSS where the kernel has
+it, so that pages shared copy-on-write are counted once), the peak disk usage
+of its output directory, and from the report of pylapels, the wall time of
+annotation summed over processes and the wall time of the serial tail
+(merge, fixmate and sort). Speedups and efficiencies are relative to the
+run with the fewest processes.
+
+Run it from the top directory, e.g.
+python -m benchmarks.benchScaling --sizes 1M,10M,50M -p 1,2,4,8,16 work
+'''
+
+import os
+import sys
+import time
+import json
+import shutil
+import logging
+import subprocess
+import argparse as ap
+
+import lapels
+from modtools import tmpmod
+from modtools.mod import Mod
+
+from benchmarks import synthetic
+
+PYLAPELS = os.path.join(os.path.dirname(lapels.__file__), 'scripts',
+                        'pylapels')
+POLL_INTERVAL = 0.2     # Seconds between samples of memory and disk usage
+TAIL_STAGES = ('merge', 'fixmate', 'sort')
+
+
+def parseSize(s):
+    '''Return the number of reads of a size such as 500K, 10M or 1G.'''
+    units = {'K': 10**3, 'M': 10**6, 'G': 10**9}
+    s = s.strip().upper()
+    if s[-1] in units:
+        return int(float(s[:-1]) * units[s[-1]])
+    return int(s)
+
+
+def parseList(s, parse=int):
+    return [parse(x) for x in s.split(',') if len(x) > 0]
+
+
+def getChildren():
+    '''Return a dict of the child pids of processes.'''
+    children = dict()
+    for name in os.listdir('/proc'):
+        if not name.isdigit():
+            continue
+        try:
+            fp = open('/proc/%s/stat' % name)
+            stat = fp.read()
+            fp.close()
+        except IOError:
+            continue
+        # The command in parentheses may have spaces.
+        ppid = int(stat[stat.rindex(')') + 2:].split()[1])
+        children.setdefault(ppid, []).append(int(name))
+    return children
+
+
+def getMemory(pid):
+    '''Return the PSS, or the RSS if not available, of a process in bytes.'''
+    for fileName, key in [('/proc/%d/smaps_rollup' % pid, 'Pss:'),
+                          ('/proc/%d/status' % pid, 'VmRSS:')]:
+        try:
+            fp = open(fileName)
+        except IOError:
+            continue
+        for line in fp:
+            if line.startswith(key):
+                fp.close()
+                return int(line.split()[1]) * 1024
+        fp.close()
+    return 0
+
+
+def getTreeMemory(pid):
+    '''Return the memory of a process and all its descendants in bytes.'''
+    children = getChildren()
+    total = 0
+    pids = [pid]
+    while len(pids) > 0:
+        pid = pids.pop()
+        total += getMemory(pid)
+        pids.extend(children.get(pid, []))
+    return total
+
+
+def getDiskUsage(dirName):
+    '''Return the size of the files in a directory in bytes.'''
+    total = 0
+    for root, dirs, files in os.walk(dirName):
+        for name in files:
+            try:
+                total += os.path.getsize(os.path.join(root, name))
+            except OSError:
+                pass    # Removed while walking
+    return total
+
+
+def prepareInputs(workDir, nReads, options):
+    '''
+    Generate the inputs of a size, unless they were generated before, and
+    index the MOD with its position maps saved next to it.
+    Return the names of the MOD and bam files.
+    '''
+    inputDir = os.path.join(workDir, 'input-%d' % nReads)
+    doneName = os.path.join(inputDir, 'done')
+    modName = os.path.join(inputDir, 'synthetic.mod')
+    bamName = os.path.join(inputDir, 'synthetic.bam')
+    if not os.path.isfile(doneName):
+        sys.stdout.write("generating %d reads in %s ...\n" % (nReads,
+                                                              inputDir))
+        sys.stdout.flush()
+        # About 2 reads per fragment, a few more with multi-mappers.
+        synthetic.generate(inputDir, False, nFragments=max(1, nReads // 2),
+                           **options)
+        indexedName = tmpmod.getIndexedMod(modName)[0]
+        mod = Mod(indexedName, True)
+        for chrom in mod.chroms:
+            mod.load(chrom)
+            mod.getPosMap(chrom, mod.meta.getChromLength(chrom))
+        open(doneName, 'w').close()
+    return modName, bamName
+
+
+def runPylapels(runDir, modName, bamName, nProcesses, extraArgs):
+    '''
+    Run pylapels in a fresh directory, sampling the memory of its process
+    tree and the disk usage of the directory. Return a dict of the results.
+    '''
+    if os.path.isdir(runDir):
+        shutil.rmtree(runDir)
+    os.makedirs(runDir)
+    outName = os.path.join(runDir, 'out.bam')
+    reportName = os.path.join(runDir, 'report.json')
+    cmd = [sys.executable, PYLAPELS, '-q', '-p', str(nProcesses),
+           '--report', reportName] + extraArgs + [modName, bamName, outName]
+    peakMemory = 0
+    peakDisk = 0
+    start = time.time()
+    proc = subprocess.Popen(cmd)
+    while proc.poll() is None:
+        peakMemory = max(peakMemory, getTreeMemory(proc.pid))
+        peakDisk = max(peakDisk, getDiskUsage(runDir))
+        time.sleep(POLL_INTERVAL)
+    wallTime = time.time() - start
+    if proc.returncode != 0:
+        raise RuntimeError("pylapels failed (%d): %s" % (proc.returncode,
+                                                         ' '.join(cmd)))
+    fp = open(reportName)
+    report = json.load(fp)
+    fp.close()
+    totals = report['totals']
+    annotateTime = totals.get('annotate', {}).get('wallTime', 0.0)
+    tailTime = sum(totals.get(name, {}).get('wallTime', 0.0)
+                   for name in TAIL_STAGES)
+    return {'nProcesses': nProcesses, 'wallTime': round(wallTime, 3),
+            'peakMemory': peakMemory, 'peakDisk': peakDisk,
+            'annotateTime': round(annotateTime, 3),
+            'tailTime': round(tailTime, 3),
+            'outputSize': os.path.getsize(outName)}
+
+
+def addSpeedups(runs):
+    '''Add speedups and efficiencies relative to the first run.'''
+    base = runs[0]
+    for run in runs:
+        run['speedup'] = round(base['wallTime'] / run['wallTime'], 3)
+        run['efficiency'] = round(run['speedup'] * base['nProcesses'] /
+                                  run['nProcesses'], 3)
+
+
+def printRuns(nReads, runs):
+    MB = 1024.0 ** 2
+    print("\n%d reads" % nReads)
+    print("%4s %10s %8s %6s %-20s %10s %10s %10s %10s" %
+          ('p', 'wall (s)', 'speedup', 'eff.', '', 'annot. sum',
+           'tail (s)', 'RSS (MB)', 'disk (MB)'))
+    for run in runs:
+        bar = '#' * int(round(run['efficiency'] * 20))
+        print("%4d %10.2f %8.2f %6.2f %-20s %10.2f %10.2f %10.1f %10.1f" %
+              (run['nProcesses'], run['wallTime'], run['speedup'],
+               run['efficiency'], bar, run['annotateTime'], run['tailTime'],
+               run['peakMemory'] / MB, run['peakDisk'] / MB))
+
+
+def main():
+    p = ap.ArgumentParser(description='An end-to-end scaling benchmark of '
+                                      'pylapels on synthetic data')
+    p.add_argument('--sizes', type=lambda s: parseList(s, parseSize),
+                   default='1M,10M,50M',
+                   help='numbers of reads (default: 1M,10M,50M)')
+    p.add_argument('-p', dest='processes', type=parseList,
+                   default='1,2,4,8,16',
+                   help='numbers of processes (default: 1,2,4,8,16)')
+    p.add_argument('--chroms', dest='nChroms', type=int, default=16,
+                   help='number of chromosomes (default: 16)')
+    p.add_argument('--chrom-len', dest='chromLen', type=int, default=2000000,
+                   help='length of each chromosome (default: 2000000)')
+    p.add_argument('--keep', action='store_true',
+                   help='keep the outputs of runs (default: no)')
+    p.add_argument('workDir', help='the directory of inputs, runs and'
+                                   ' results (scaling.json)')
+    p.add_argument('lapelsArgs', nargs=ap.REMAINDER,
+                   help='more arguments of pylapels after --, e.g. -- -s 32'
+                        ' --stream')
+    args = p.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+    extraArgs = [arg for arg in args.lapelsArgs if arg != '--']
+    options = {'nChroms': args.nChroms, 'chromLen': args.chromLen}
+
+    results = {'cpus': os.sysconf('SC_NPROCESSORS_ONLN'),
+               'lapelsArgs': extraArgs, 'options': options, 'sizes': []}
+    for nReads in args.sizes:
+        modName, bamName = prepareInputs(args.workDir, nReads, options)
+        runs = []
+        for nProcesses in args.processes:
+            runDir = os.path.join(args.workDir, 'run-%d-p%d' % (nReads,
+                                                                nProcesses))
+            runs.append(runPylapels(runDir, modName, bamName, nProcesses,
+                                    extraArgs))
+            if not args.keep:
+                shutil.rmtree(runDir)
+        addSpeedups(runs)
+        printRuns(nReads, runs)
+        results['sizes'].append({'nReads': nReads, 'runs': runs})
+        # Written after each size, so that finished sizes are kept.
+        fp = open(os.path.join(args.workDir, 'scaling.json'), 'w')
+        json.dump(results, fp, indent=2, sort_keys=True)
+        fp.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,399 @@
+'''
+A deterministic generator of synthetic data for benchmarks: a reference
+chromosome, a MOD of its variants (and the same variants as a VCF), and
+paired-end reads aligned to the in silico chromosome.
+
+The variant density, the ratios of SNPs, insertions and deletions, and the
+indel sizes (geometric with a given mean) set the shape of the MOD. The read
+length, the spliced (N) reads and the multi-mappers (NH/HI tags) set the shape
+of the BAM. The same seed and options always give the same files.
+
+Run it from the top directory to write the files, e.g.
+python -m benchmarks.synthetic outDir --density 0.01 --reads 100000
+'''
+
+import os
+import sys
+import gzip
+import random
+import argparse as ap
+import pysam
+
+from lapels import sorter
+
+__all__ = ['DEFAULTS', 'makeReference', 'makeVariants', 'makeTarget',
+           'iterReads', 'makeReads', 'writeMod', 'writeVCF', 'writeFasta',
+           'writeBam', 'generate']
+
+BASES = 'ACGT'
+REFERENCE = 'mm9'   # The genome in the MOD header, for chromosome lengths
+SAMPLE = 'synthetic'
+
+# Options of the generator, and their defaults.
+DEFAULTS = {'seed': 0,
+            'nChroms': 1,           # Chromosomes named as in the reference
+            'chromLen': 1000000,    # Length of each chromosome
+            'density': 0.002,       # Variants per reference base
+            'insRatio': 0.1,        # Ratio of insertions in variants
+            'delRatio': 0.1,        # Ratio of deletions in variants
+            'indelMean': 3.0,       # Mean of the geometric indel sizes
+            'maxIndel': 50,
+            'nFragments': 10000,    # Read pairs, each may have several hits
+            'readLength': 100,
+            'insertSize': 300,
+            'spliceRatio': 0.1,     # Ratio of reads with a splice junction
+            'intronMean': 1000,     # Mean of the exponential intron lengths
+            'multiRatio': 0.05,     # Ratio of fragments with several hits
+            'maxHits': 4}
+
+
+def getIndelSize(rng, mean, maxSize):
+    '''Return a geometric indel size in [1, maxSize] with the given mean.'''
+    p = 1.0 / mean
+    size = 1
+    while size < maxSize and rng.random() > p:
+        size += 1
+    return size
+
+
+def makeReference(rng, chromLen):
+    '''Return a random reference sequence.'''
+    return ''.join(rng.choice(BASES) for i in xrange(chromLen))
+
+
+def makeVariants(rng, refSeq, density=DEFAULTS['density'],
+                 insRatio=DEFAULTS['insRatio'], delRatio=DEFAULTS['delRatio'],
+                 indelMean=DEFAULTS['indelMean'],
+                 maxIndel=DEFAULTS['maxIndel']):
+    '''
+    Return the variants of a reference as rows of (op, pos, allele) in MOD,
+    sorted by positions. Variants do not overlap, and there is at least one
+    unchanged base between two variants.
+    '''
+    rows = []
+    chromLen = len(refSeq)
+    pos = 0
+    while True:
+        # Gaps between variants are exponential with the given density.
+        pos += 2 + int(rng.expovariate(density))
+        if pos >= chromLen - maxIndel - 1:
+            break
+        x = rng.random()
+        if x < insRatio:
+            size = getIndelSize(rng, indelMean, maxIndel)
+            rows.append(('i', pos, ''.join(rng.choice(BASES)
+                                           for i in range(size))))
+        elif x < insRatio + delRatio:
+            size = getIndelSize(rng, indelMean, maxIndel)
+            for i in range(size):
+                rows.append(('d', pos + i, refSeq[pos + i]))
+            pos += size - 1
+        else:
+            ref = refSeq[pos]
+            alt = rng.choice([b for b in BASES if b != ref])
+            rows.append(('s', pos, '%s/%s' % (ref, alt)))
+    return rows
+
+
+def makeTarget(refSeq, rows):
+    '''
+    Return the in silico sequence of a reference with its variants, as
+    Mod.buildSeq() does: an insertion follows the base at its position.
+    '''
+    seqs = []
+    refPos = 0
+    for op, pos, allele in rows:
+        if refPos < pos:
+            seqs.append(refSeq[refPos:pos])
+            refPos = pos
+        if op == 's':
+            seqs.append(allele[-1])
+            refPos += 1
+        elif op == 'd':
+            refPos += 1
+        else:
+            if refPos == pos:
+                seqs.append(refSeq[pos])
+                refPos += 1
+            seqs.append(allele)
+    seqs.append(refSeq[refPos:])
+    return ''.join(seqs)
+
+
+def makeAlignment(rng, targetSeq, start, readLength, spliceRatio, intronMean):
+    '''
+    Return (cigar, sequence, end) of a read starting at start of the target,
+    with a splice junction at a random offset by the given ratio.
+    '''
+    if rng.random() < spliceRatio:
+        intron = 1 + int(rng.expovariate(1.0 / intronMean))
+        left = rng.randint(1, readLength - 1)
+        right = readLength - left
+        if start + left + intron + right <= len(targetSeq):
+            seq = (targetSeq[start:start+left] +
+                   targetSeq[start+left+intron:start+left+intron+right])
+            return ([(0, left), (3, intron), (0, right)], seq,
+                    start + left + intron + right)
+    return [(0, readLength)], targetSeq[start:start+readLength], \
+           start + readLength
+
+
+def iterReads(rng, targetSeq, tid=0, nFragments=DEFAULTS['nFragments'],
+              readLength=DEFAULTS['readLength'],
+              insertSize=DEFAULTS['insertSize'],
+              spliceRatio=DEFAULTS['spliceRatio'],
+              intronMean=DEFAULTS['intronMean'],
+              multiRatio=DEFAULTS['multiRatio'],
+              maxHits=DEFAULTS['maxHits'], firstIdx=0):
+    '''
+    Iterate paired-end reads aligned to the in silico sequence, in the order
+    of fragments. A multi-mapped fragment has a pair of reads at each hit,
+    tagged with NH and HI. Fragments are named from r<firstIdx>.
+    '''
+    maxStart = len(targetSeq) - insertSize - 2 * intronMean - readLength
+    for i in xrange(firstIdx, firstIdx + nFragments):
+        qname = 'r%d' % i
+        nHits = 1
+        if rng.random() < multiRatio:
+            nHits = rng.randint(2, maxHits)
+        for hit in range(nHits):
+            start1 = rng.randint(0, maxStart)
+            start2 = start1 + insertSize - readLength
+            mates = []
+            for flag, start in [(0x63, start1), (0x93, start2)]:
+                cigar, seq, end = makeAlignment(rng, targetSeq, start,
+                                                readLength, spliceRatio,
+                                                intronMean)
+                rseq = pysam.AlignedRead()
+                rseq.qname = qname
+                rseq.flag = flag
+                rseq.tid = tid
+                rseq.pos = start
+                rseq.mapq = 255 if nHits == 1 else 3
+                rseq.cigar = cigar
+                rseq.seq = seq
+                rseq.qual = 'I' * len(seq)
+                tags = [('NM', 0), ('NH', nHits)]
+                if nHits > 1:
+                    tags.append(('HI', hit))
+                rseq.tags = tags
+                mates.append((rseq, end))
+            for j in range(2):
+                rseq, end = mates[j]
+                mate, mateEnd = mates[1 - j]
+                rseq.mrnm = tid
+                rseq.mpos = mate.pos
+                if j == 0:
+                    rseq.tlen = mateEnd - rseq.pos
+                else:
+                    rseq.tlen = -(end - mate.pos)
+                yield rseq
+
+
+def makeReads(rng, targetSeq, tid=0, **options):
+    '''
+    Return the reads of iterReads() sorted by positions.
+    options: the keyword arguments of iterReads().
+    '''
+    reads = list(iterReads(rng, targetSeq, tid, **options))
+    reads.sort(key=lambda rseq: (rseq.pos, rseq.qname, rseq.flag))
+    return reads
+
+
+def getChromNames(nChroms):
+    '''Return the names of the first chromosomes of the reference.'''
+    names = [str(i) for i in range(1, 20)] + ['X', 'Y']
+    if nChroms > len(names):
+        raise ValueError("At most %d chromosomes are supported." % len(names))
+    return names[:nChroms]
+
+
+def writeMod(fileName, chromRows, reference=REFERENCE):
+    '''
+    Write the rows of chromosomes as a gzipped text MOD.
+    chromRows: a list of (chrom, rows).
+    '''
+    fp = gzip.open(fileName, 'wb')
+    fp.write('#reference=%s\n' % reference)
+    fp.write('#sample=%s\n' % SAMPLE)
+    for chrom, rows in chromRows:
+        for op, pos, allele in rows:
+            fp.write('%s\t%s\t%d\t%s\n' % (op, chrom, pos, allele))
+    fp.close()
+
+
+def writeVCF(fileName, chromRows, refSeqs):
+    '''
+    Write the variants as a VCF of one homozygous sample, with indels
+    anchored on the preceding base. The VCF is compressed and indexed by
+    tabix as fileName.gz.
+    chromRows: a list of (chrom, rows).
+    refSeqs: a dict of reference sequences by chromosomes.
+    '''
+    fp = open(fileName, 'w')
+    fp.write('##fileformat=VCFv4.1\n')
+    fp.write('##FORMAT=<ID=GT,Number=1,Type=String,Description="Genotype">\n')
+    fp.write('#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\tFORMAT\t%s\n'
+             % SAMPLE)
+    for chrom, rows in chromRows:
+        refSeq = refSeqs[chrom]
+        i = 0
+        while i < len(rows):
+            op, pos, allele = rows[i]
+            if op == 's':
+                ref, alt = allele[0], allele[-1]
+                vpos = pos
+            elif op == 'i':
+                ref, alt = refSeq[pos], refSeq[pos] + allele
+                vpos = pos
+            else:
+                j = i
+                while j + 1 < len(rows) and rows[j+1][0] == 'd' and \
+                      rows[j+1][1] == rows[j][1] + 1:
+                    j += 1
+                vpos = pos - 1
+                ref = refSeq[vpos:rows[j][1] + 1]
+                alt = refSeq[vpos]
+                i = j
+            fp.write('%s\t%d\t.\t%s\t%s\t.\tPASS\t.\tGT\t1/1\n' %
+                     (chrom, vpos + 1, ref, alt))
+            i += 1
+    fp.close()
+    pysam.tabix_index(fileName, force=True, preset='vcf')
+
+
+def writeFasta(fileName, chromSeqs, width=60):
+    '''
+    Write sequences as a FASTA file indexed by faidx.
+    chromSeqs: a list of (chrom, sequence).
+    '''
+    fp = open(fileName, 'w')
+    for chrom, seq in chromSeqs:
+        fp.write('>%s\n' % chrom)
+        for i in xrange(0, len(seq), width):
+            fp.write(seq[i:i+width] + '\n')
+    fp.close()
+    pysam.faidx(fileName)
+
+
+def writeBam(fileName, chromLens, reads, bufferSize=sorter.BUFFER_SIZE):
+    '''
+    Write reads as a bam file sorted by positions, and index it. Reads are
+    sorted in bounded memory, so that they can be generated on the fly.
+    chromLens: a list of (chrom, length) of the in silico chromosomes.
+    Return the number of reads.
+    '''
+    header = {'HD': {'VN': '1.0', 'SO': 'coordinate'},
+              'SQ': [{'SN': chrom, 'LN': length}
+                     for chrom, length in chromLens]}
+    readSorter = sorter.Sorter(sorter.coordKey, header, fileName + '.tmp',
+                               bufferSize)
+    for rseq in reads:
+        readSorter.write(rseq)
+    outBam = pysam.Samfile(fileName, 'wb', header=header)
+    for rseq in readSorter:
+        outBam.write(rseq)
+    outBam.close()
+    readSorter.remove()
+    pysam.index(fileName)
+    return len(readSorter)
+
+
+def generate(outDir, keepReads=True, **options):
+    '''
+    Write the synthetic files to a directory, with options in DEFAULTS.
+    Return a dict of the data generated and the names of the files. The
+    reads are kept in the dict, sorted by positions, only if keepReads is
+    set, so that many reads can be written in bounded memory.
+    '''
+    for key in options:
+        if key not in DEFAULTS:
+            raise ValueError("Unknown option '%s'." % key)
+    opts = dict(DEFAULTS)
+    opts.update(options)
+    rng = random.Random(opts['seed'])
+    chroms = getChromNames(opts['nChroms'])
+
+    refSeqs = dict()
+    targetSeqs = dict()
+    chromRows = []
+    for chrom in chroms:
+        refSeq = makeReference(rng, opts['chromLen'])
+        rows = makeVariants(rng, refSeq, opts['density'], opts['insRatio'],
+                            opts['delRatio'], opts['indelMean'],
+                            opts['maxIndel'])
+        refSeqs[chrom] = refSeq
+        targetSeqs[chrom] = makeTarget(refSeq, rows)
+        chromRows.append((chrom, rows))
+
+    def iterAllReads():
+        # Fragments are split evenly among chromosomes.
+        firstIdx = 0
+        for tid, chrom in enumerate(chroms):
+            nFragments = opts['nFragments'] // len(chroms)
+            if tid == 0:
+                nFragments += opts['nFragments'] % len(chroms)
+            for rseq in iterReads(rng, targetSeqs[chrom], tid, nFragments,
+                                  opts['readLength'], opts['insertSize'],
+                                  opts['spliceRatio'], opts['intronMean'],
+                                  opts['multiRatio'], opts['maxHits'],
+                                  firstIdx):
+                yield rseq
+            firstIdx += nFragments
+
+    if not os.path.isdir(outDir):
+        os.makedirs(outDir)
+    data = {'chroms': chroms, 'refSeqs': refSeqs, 'targetSeqs': targetSeqs,
+            'rows': dict(chromRows), 'reads': None,
+            'fasta': os.path.join(outDir, 'ref.fa'),
+            'mod': os.path.join(outDir, 'synthetic.mod'),
+            'vcf': os.path.join(outDir, 'synthetic.vcf.gz'),
+            'bam': os.path.join(outDir, 'synthetic.bam')}
+    writeFasta(data['fasta'], [(chrom, refSeqs[chrom]) for chrom in chroms])
+    writeMod(data['mod'], chromRows)
+    writeVCF(data['vcf'][:-3], chromRows, refSeqs)
+    reads = iterAllReads()
+    if keepReads:
+        reads = sorted(reads, key=sorter.coordKey)
+        data['reads'] = reads
+    data['nReads'] = writeBam(data['bam'],
+                              [(chrom, len(targetSeqs[chrom]))
+                               for chrom in chroms], reads)
+    return data
+
+
+def main():
+    p = ap.ArgumentParser(description='A generator of synthetic MOD, VCF, '
+                                      'FASTA and BAM files for benchmarks')
+    p.add_argument('outDir', help='the output directory')
+    p.add_argument('--seed', type=int, default=DEFAULTS['seed'])
+    p.add_argument('--chroms', dest='nChroms', type=int,
+                   default=DEFAULTS['nChroms'])
+    p.add_argument('--chrom-len', dest='chromLen', type=int,
+                   default=DEFAULTS['chromLen'])
+    p.add_argument('--density', type=float, default=DEFAULTS['density'],
+                   help='variants per reference base')
+    p.add_argument('--ins-ratio', dest='insRatio', type=float,
+                   default=DEFAULTS['insRatio'])
+    p.add_argument('--del-ratio', dest='delRatio', type=float,
+                   default=DEFAULTS['delRatio'])
+    p.add_argument('--indel-mean', dest='indelMean', type=float,
+                   default=DEFAULTS['indelMean'])
+    p.add_argument('--reads', dest='nFragments', type=int,
+                   default=DEFAULTS['nFragments'], help='read pairs')
+    p.add_argument('--read-length', dest='readLength', type=int,
+                   default=DEFAULTS['readLength'])
+    p.add_argument('--splice-ratio', dest='spliceRatio', type=float,
+                   default=DEFAULTS['spliceRatio'])
+    p.add_argument('--multi-ratio', dest='multiRatio', type=float,
+                   default=DEFAULTS['multiRatio'])
+    args = vars(p.parse_args())
+    outDir = args.pop('outDir')
+    data = generate(outDir, False, **args)
+    nRows = sum(len(rows) for rows in data['rows'].values())
+    sys.stdout.write("%d variant row(s), %d read(s) written to %s\n" %
+                     (nRows, data['nReads'], outDir))
+
+
+if __name__ == '__main__':
+    main()
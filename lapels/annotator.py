@@ -9,14 +9,18 @@ Created on Sep 1, 2012
 '''
 
 import bisect
-import re
+import time
 import logging
+import numpy as np
 
 import cigarutils as cu
 import cigarbuilder
 import regionutils
 
+from modtools.cursor import Cursor
+from modtools.blocks import MATCH, SUB
 from lapels.utils import log
+from lapels.metrics import Metrics, CountingMap
 
 VERSION = '0.0.5'
 TESTING = False # For unit test: return the annotated read data once set to 1.
@@ -37,46 +41,98 @@ def getReadOffset(rseq, pos):
     '''
     Given the position in the alignment coordinate, return its offset in read
     '''
-    readPos = rseq.pos    
-    readLen = rseq.qlen
-    cigar = rseq.cigar
+    return ReadOffsets(rseq).getOffset(pos)
 
-    if (pos < readPos):        
-        raise ValueError("position underflows")
 
-    offset = 0
-    curPos = readPos
-    for op, length in cigar:        
-        if op == 0 or op == 7 or op == 8:     # Match
-            if (pos < curPos + length):       # (a) pos in this match         
-                ret = offset + pos - curPos
-                if ret < readLen:
-                    return ret
-                else:
-                    msg = "cigar '%s' and length '%s' conflict in read '%s'"
-                    cigarStr = cu.toString(cigar)
-                    raise ValueError(msg % (cigarStr, readLen, rseq.qname))
-            else:
-                offset += length              # (b) pos not in this match
+
+class ReadOffsets:
+    '''
+    The cumulative offsets of a read's cigar, which map positions in the 
+    alignment coordinate to offsets in the read in O(log(#ops)).
+    
+    The cigar is walked once, up to the first op that conflicts with the read
+    length, and the errors are raised as by walking the cigar for each 
+    position.
+    '''
+    
+    def __init__(self, rseq):
+        self.rseq = rseq
+        self.readPos = rseq.pos
+        self.readLen = rseq.qlen
+        self.starts = []    # Start positions of M/D/N ops with length > 0
+        self.spans = []     # Tuples of (end, offset in read, isMatch) of ops
+        self.error = None   # The error for positions beyond the walked ops
+        self.seq = None     # The read sequence, fetched once by getSeq()
+        
+        readLen = self.readLen
+        appendStart = self.starts.append
+        appendSpan = self.spans.append
+        offset = 0
+        curPos = self.readPos
+        for op, length in rseq.cigar:
+            if op == 0 or op == 7 or op == 8:   # Match
+                if length > 0:
+                    appendStart(curPos)
+                    appendSpan((curPos + length, offset, True))
                 curPos += length
-        elif op == 1:                         # Insertion
-            offset += length
-        elif op == 2 or op == 3:              # Deletion or Splicing junction
-            curPos += length
-        else:
-            raise NotImplementedError("unknown op '%s' in read '%s'" 
-                                      % (op,rseq.qname))
-        
-        # In the case of offset == readLen, there may be an overflow        
-        if offset > readLen:
-            msg = "cigar '%s' and length '%s' conflict in read '%s'"
-            cigarStr = cu.toString(cigar)
-            raise ValueError(msg % (cigarStr, readLen, rseq.qname))
-          
-        if curPos > pos:
-            raise ValueError('position in deletion or splicing junction')
-        
-    raise ValueError('position overflows')
+                offset += length
+            elif op == 1:                       # Insertion
+                offset += length
+            elif op == 2 or op == 3:            # Deletion or Splicing junction
+                if length > 0:
+                    appendStart(curPos)
+                    appendSpan((curPos + length, offset, False))
+                curPos += length
+            else:
+                self.error = (NotImplementedError, 
+                              "unknown op '%s' in read '%s'" 
+                              % (op, rseq.qname))
+                break
+            
+            # In the case of offset == readLen, there may be an overflow
+            if offset > readLen:
+                self.error = (ValueError, None)   # See getConflict()
+                break
+    
+    
+    def getConflict(self):
+        '''Return the message of the conflict of cigar and read length.'''
+        msg = "cigar '%s' and length '%s' conflict in read '%s'"
+        cigarStr = cu.toString(self.rseq.cigar)
+        return msg % (cigarStr, self.readLen, self.rseq.qname)
+    
+    
+    def getOffset(self, pos):
+        '''
+        Given the position in the alignment coordinate, return its offset in 
+        read
+        '''
+        if (pos < self.readPos):
+            raise ValueError("position underflows")
+        
+        i = bisect.bisect_right(self.starts, pos) - 1
+        if i >= 0 and pos < self.spans[i][0]:
+            end, offset, isMatch = self.spans[i]
+            if not isMatch:
+                raise ValueError('position in deletion or splicing junction')
+            ret = offset + pos - self.starts[i]
+            if ret < self.readLen:
+                return ret
+            raise ValueError(self.getConflict())
+        
+        if self.error is not None:
+            errorType, msg = self.error
+            if msg is None:
+                msg = self.getConflict()
+            raise errorType(msg)
+        raise ValueError('position overflows')
+    
+    
+    def getSeq(self):
+        '''Return the read sequence.'''
+        if self.seq is None:
+            self.seq = self.rseq.seq
+        return self.seq
 
 
 
@@ -118,7 +174,8 @@ class Annotator:
     '''The class for annotating reads'''
     
     def __init__(self, chrom, chromLen, mod, inBam, nReads=None, 
-                 tagPrefixes=None, outBam=None, lock=None):
+                 tagPrefixes=None, outBam=None, lock=None, batchSize=0,
+                 sweep=False, fastPath=False, metrics=None, collector=None):
         if lock is None:
             self.logger = logging.getLogger('annotator')
         else:
@@ -131,6 +188,14 @@ class Annotator:
         self.inBam = inBam
         self.tagPrefixes = tagPrefixes
         self.outBam = outBam
+        self.batchSize = batchSize  #reads per batch; 0 for the per-read mode
+        self.sweep = sweep          #use sweep-line cursors for sorted reads
+        self.fastPath = fastPath    #shift variant-free reads without parsing
+        self.nClean = 0             #reads annotated in the fast path
+        self.readOffsets = None     #offsets of the read being annotated
+        self.onMetrics = metrics    #the callback of metrics, or None
+        self.metrics = None         #kept only if there is a callback
+        self.collector = collector  #the collector of mate fields, or None
                 
         
     def setTag(self, tags, key, value):
@@ -139,22 +204,125 @@ class Annotator:
             tags[key] = value
     
     
-    def parseTargetRegion(self, region, rseq):
+    def setTags(self, rseq, nSNPs, nInsertions, nDeletions):
+        '''Set the annotation tags of a read, with its cigar not converted.'''
+        tags = dict(rseq.tags)
+        if self.tagPrefixes is not None:
+            self.setTag(tags, self.tagPrefixes[0]+'0', nSNPs)            
+            self.setTag(tags, self.tagPrefixes[1]+'0', nInsertions)
+            self.setTag(tags, self.tagPrefixes[2]+'0', nDeletions)            
+            self.setTag(tags, 'OC', cu.toString(rseq.cigar).translate(None,','))
+            self.setTag(tags, 'OM', tags['NM'])            
+            del tags['NM']  ## Delete the old 'NM' tag.
+              
+        rseq.tags = [(key, tags[key]) for key in sorted(tags.keys())] 
+    
+    
+    def formatRow(self, row):
+        '''Return a row of (op, pos, allele) as the columns in MOD.'''
+        return [row[0], self.chrom, row[1], row[2]]
+    
+    
+    def advance(self, tpos):
+        '''Move the sweep-line cursors to a read starting at tpos.'''
+        self.bcursor.advance(tpos)
+        try:
+            rpos = abs(self.cmap.bmap(tpos, self.bcursor))
+        except ValueError:
+            return
+        self.fcursor.advance(rpos)
+        self.blockCursor.advance(rpos)
+    
+    
+    def getReadOffsets(self, rseq):
+        '''Return the offsets of the read being annotated.'''
+        if self.readOffsets is None or self.readOffsets.rseq is not rseq:
+            self.readOffsets = ReadOffsets(rseq)
+        return self.readOffsets
+    
+    
+    def countSNPs(self, rseq, snps):
+        '''
+        Count the SNPs observed in a read, in one pass over the read sequence.
+        snps: a list of (pos, base) of SNPs in the alignment coordinate.
+        '''
+        readOffsets = self.getReadOffsets(rseq)
+        getOffset = readOffsets.getOffset
+        seq = readOffsets.getSeq()
+        nSNPs = 0
+        for tpos, base in snps:
+            rbase = seq[getOffset(tpos)]
+            if VERBOSITY > 1:
+                log("SNP found at %d: %s\n" % (tpos, base))
+                log("Read base: %s\n" % rbase)
+            if rbase == base:
+                nSNPs += 1
+        return nSNPs
+    
+    
+    def getVariants(self, rstart, rend):
+        '''
+        Get the variants in [rstart, rend] of the reference coordinate.
+        Return rows of (op, pos, allele) of the variants.
+        '''
+        lo = int(self.modKeys.searchsorted(rstart, 'left'))
+        hi = int(self.modKeys.searchsorted(rend, 'right'))
+        return self.mod.getRows(lo, hi)
+    
+    
+    def getBlocks(self, rstart, rend):
+        '''
+        Get the variant blocks in [rstart, rend] of the reference coordinate.
+        Return rows of (pos, kind, base, insertion length) of the blocks.
+        '''
+        cursor = self.blockCursor
+        if cursor is None:
+            keys = self.blocks.positions
+            lo = int(keys.searchsorted(rstart, 'left'))
+            hi = int(keys.searchsorted(rend, 'right'))
+            return self.blocks.getRows(lo, hi)
+        lo = cursor.search(rstart, 'left')
+        hi = cursor.search(rend, 'right')
+        return cursor.getRows(lo, hi)
+    
+    
+    def countBlocks(self, rstart, rend):
+        '''getBlocks() that counts the regions and blocks in the metrics.'''
+        blocks = Annotator.getBlocks(self, rstart, rend)
+        self.metrics.regions += 1
+        self.metrics.variants += len(blocks)
+        return blocks
+    
+    
+    def publishMetrics(self, count, count2, done=False):
+        '''Update the metrics of reads annotated, and call the callback.'''
+        metrics = self.metrics
+        metrics.reads = count
+        metrics.cleanReads = self.nClean
+        metrics.slowReads = count - self.nClean
+        metrics.variantReads = count2
+        metrics.wallTime = time.time() - metrics.startTime
+        metrics.done = done
+        self.onMetrics(metrics)
+    
+    
+    def parseTargetRegion(self, region, rseq, mapped=None):
         '''
         Parse a read region in the target coordinate and get data in ref.
         
         input region: a tuple of (op, None, start, end)
+        input mapped: None, or a tuple of (rstart, rend, tpos) precomputed by
+                      mapBatch() for the region
         output region: a tuple of (op, newCigar, newStart, newEnd, newPos,
                                    nSNPs, nInsertions, nDeletions)
         '''
                         
-        data = self.data
-        posmap = self.posmap
-        modKeys = self.modKeys  # All variant positions in reference coordinate 
+        cmap = self.cmap        # Position map segments of the chromosome
         
         nSNPs = 0
         nInsertions = 0
         nDeletions = 0
+        snps = []               # SNPs to check against the read
                                        
         # The region's exact start and end in the target coordinate.
         op = region[0]
@@ -164,19 +332,18 @@ class Annotator:
             assert op == 1  # It must be an insertion region(I_1)
             return (op,)
                     
-        # Find the region's fuzzy boundaries in the reference coordinate.
-        # The position will be imprecise if it falls in an Insertion(I_0).        
-        rstart = posmap.bmap((self.chrom, tstart))
-        rend = posmap.bmap((self.chrom, tend))
-        
-        # Detect the case of translocation between two chromosomes.
-        if rstart[0] != self.chrom or rend[0] != self.chrom:
-            raise NotImplementedError("cannot parse this region.")
-        rstart = abs(rstart[1])
-        rend = abs(rend[1])
-        # Detect the case of translocation/duplication/inversion.
-        if rstart > rend:
-            raise NotImplementedError("cannot parse this region.")
+        if mapped is None:
+            # Find the region's fuzzy boundaries in the reference coordinate.
+            # The position will be imprecise if it falls in an Insertion(I_0).
+            # Translocation between two chromosomes is not supported by the
+            # position map.
+            rstart = abs(cmap.bmap(tstart, self.bcursor))
+            rend = abs(cmap.bmap(tend, self.bcursor))
+            # Detect the case of translocation/duplication/inversion.
+            if rstart > rend:
+                raise NotImplementedError("cannot parse this region.")
+        else:
+            rstart, rend, tpos = mapped
                 
         if VERBOSITY > 1:            
             log("T: %d-%d; R: %d-%d\n" %(tstart, tend, rstart, rend))
@@ -189,36 +356,20 @@ class Annotator:
         
         # The next processing position in ref and target coordinate
         rpos = rstart               
-        tpos = posmap.fmap((self.chrom, rstart))[1]  # tpos <= tstart
-        if tpos < 0:        # it falls in a deletion(D_0)
-            tpos = -tpos + 1
-        
-        # The searching boundaries in mod data.
-        # Variants in the region will be in data[lo:hi]
-        lo = bisect.bisect_left(modKeys, rstart)
-        hi = bisect.bisect_right(modKeys, rend)
-                            
-        if lo < hi: # There are some variants in the region            
-            # The boundaries of the processing block in mod data.                    
-            # Rows in data[startIdx:endIdx] will have the same ref position.
-            startIdx = lo
-            endIdx = lo            
-            # The next processing variant position in reference coordinate.
-            vpos = data[lo][2]
-            for i in range(lo, hi+1):  # The plus 1 trick.
+        
+        if mapped is None:
+            tpos = cmap.fmap(rstart, self.fcursor)  # tpos <= tstart
+            if tpos < 0:        # it falls in a deletion(D_0)
+                tpos = -tpos + 1
+        
+        # Blocks of variants in the region, with the sub-regions resolved for 
+        # each variant position.
+        blocks = self.getBlocks(rstart, rend)
+        if len(blocks) > 0:
+            for vpos, kind, base, insLen in blocks:
                 if tpos > tend:        # Already reach the region's end.
                     break
                 
-                # Find the rows that share the same ref position.
-                if i < hi and data[i][2] == vpos:  # The plus 1 trick
-                    endIdx += 1
-                    continue
-                
-                #assert rpos <= vpos
-                if (rpos > vpos):
-                    raise ValueError("position not sorted in MOD at line %d." % 
-                                     (i+1))
-                            
                 if rpos < vpos:     
                     # Fill M's to the head or the gap between sub-regions.
                     if tpos >= tstart and tpos <= tend:
@@ -230,76 +381,49 @@ class Annotator:
                     rpos = vpos
                 
                 if VERBOSITY > 1:
-                    for j in range(startIdx, endIdx):
-                        log(','.join(map(str,data[j])))
-                        log('\n')
+                    log("block at %d: kind %d, base '%s', insertion %d\n" 
+                        % (vpos, kind, base, insLen))
                 
-                # Handle the sub-regions for each variant position.
-                subRegs=[('m',1)]
-                for j in range(startIdx,endIdx):
-                    tup = data[j]                    
-                    if tup[0] == 's' and subRegs[0] != 'd': # 'd' overrides 's'
-                        subRegs[0] = ('s', tup[3])
-                    elif tup[0] == 'i':
-                        subRegs.append(('i', tup[3]))
-                    elif tup[0] == 'd':
-                        subRegs[0] = ('d')
-                    else:
-                        raise NotImplementedError("unknown op '%s'" % tup[0])
-    
-                for reg in subRegs:
-                    segType = reg[0]                                  
-                    if segType == 'm':      # Match
-                        if tpos >= tstart and tpos <= tend:
-                            ncigar.append((0, 1))                                
-                            nstart = min(nstart, rpos)
-                            nend = max(nend, rpos)
-                            npos = min(npos, rpos)
-                        rpos += 1
-                        tpos += 1
-                    elif segType == 's':    # Substitution
-                        if tpos >= tstart and tpos <= tend:                  
-                            ncigar.append((0, 1))                                
-                            nstart = min(nstart, rpos)
-                            nend = max(nend, rpos)
-                            npos = min(npos, rpos)
-                            
-                            if op != 2 and op != 3: # D_1 or N_1                                                                
-                                rbase = rseq.seq[getReadOffset(rseq, tpos)]                            
-                                if VERBOSITY > 1:                                                        
-                                    log("SNP found at %d: %s\n" 
-                                             % (tpos, reg[1]))                                
-                                    log("Read base: %s\n" % rbase)
-                                if rbase == reg[1][-1]:
-                                    nSNPs += 1
-                        rpos += 1
-                        tpos += 1
-                    elif segType == 'i':    # Insertion         
-                        # TODO: Support multiple insertions in a line.
-                        segLen = len(reg[1])                            
-                        tmax = min(tpos + segLen, tend + 1)                        
-                        if tpos > tstart:
-                            ncigar.append((1, tmax - tpos))
-                        else:
-                            if tmax > tstart:
-                                ncigar.append((1, tmax - tstart))                                                                                                                                    
-                        tpos = tmax                                
-                    elif segType == 'd':    # Deletion
-                        if tpos > tstart and tpos <= tend:                                                  
-                            ncigar.append((2, 1))
-                            # NO assignment of 'npos' here: npos is for M only.
-                            nstart = min(nstart, rpos)
-                            nend = max(nend, rpos)
-                        rpos += 1
+                if kind == MATCH:               # Match
+                    if tpos >= tstart and tpos <= tend:
+                        ncigar.append((0, 1))                                
+                        nstart = min(nstart, rpos)
+                        nend = max(nend, rpos)
+                        npos = min(npos, rpos)
+                    rpos += 1
+                    tpos += 1
+                elif kind == SUB:               # Substitution
+                    if tpos >= tstart and tpos <= tend:                  
+                        ncigar.append((0, 1))                                
+                        nstart = min(nstart, rpos)
+                        nend = max(nend, rpos)
+                        npos = min(npos, rpos)
+                        
+                        if op != 2 and op != 3: # D_1 or N_1
+                            snps.append((tpos, base))
+                    rpos += 1
+                    tpos += 1
+                else:                           # Deletion
+                    if tpos > tstart and tpos <= tend:                                                  
+                        ncigar.append((2, 1))
+                        # NO assignment of 'npos' here: npos is for M only.
+                        nstart = min(nstart, rpos)
+                        nend = max(nend, rpos)
+                    rpos += 1
+                if tpos > tend:
+                    break
+                
+                if insLen > 0:                  # Insertions
+                    tmax = min(tpos + insLen, tend + 1)                        
+                    if tpos > tstart:
+                        ncigar.append((1, tmax - tpos))
                     else:
-                        raise NotImplementedError("unknown op '%s'" % segType)                                                                
-                    if tpos > tend:
-                        break
-                                
-                startIdx = endIdx
-                endIdx += 1                
-                if i < hi:  # The plus 1 trick
-                    vpos = data[i][2]
+                        if tmax > tstart:
+                            ncigar.append((1, tmax - tstart))                                                                                                                                    
+                    tpos = tmax                                
+        
+        if len(snps) > 0:
+            nSNPs = self.countSNPs(rseq, snps)
                     
         #assert rpos <= refLens[chrom]
         if rpos > rend + 1:
@@ -343,262 +467,419 @@ class Annotator:
         return (op, ncigar, nstart, nend, npos, nSNPs, nInsertions, nDeletions)
     
         
-    def execute(self):
-        '''The driver method for the module'''
-        self.logger.info("[%s]: %d read(s) found in BAM", self.chrom, self.nReads)
-                
-        self.data = self.mod.data
-        self.modKeys = [tup[2] for tup in self.data]            
-        self.posmap = self.mod.getPosMap(self.chrom, self.chromLen)        
-            
-        count = 0
-        count2 = 0
-        if TESTING:
-            results = []
-        if self.nReads == 0:
-            return 0
-        if not TESTING:            
-            self.logger.info("[%s]: %3d%%", self.chrom, count*100/self.nReads)
-                     
-        for rseq in self.inBam:      # Annotate each reads
-            if VERBOSITY > 1:       
-                log("read name: %s\n" % rseq.qname)                
-                log("t. alignment pos: %d\n" % rseq.pos)
-                log("t. alignment cigar: '%s'\n\n" % cu.toString(rseq.cigar))                
+    def annotateClean(self, rseq):
+        '''
+        Annotate a read that overlaps no variants. Its alignment in the 
+        reference is the same as in the target, shifted by a constant offset.
+        
+        Return False, with the read untouched, if the read has variants or
+        other cigar ops than matches, deletions and splice junctions between
+        matches.
+        '''
+        cigar = cu.simplify(rseq.cigar)
+        if len(cigar) == 0 or cigar[0][0] != 0 or cigar[-1][0] != 0:
+            return False
+        span = 0
+        prevOp = 0
+        for op, length in cigar:
+            if op != 0 and (prevOp != 0 or (op != 2 and op != 3)):
+                return False
+            span += length
+            prevOp = op
+        
+        tstart = rseq.pos
+        if tstart + span != rseq.aend:
+            return False
+        try:
+            rstart = self.cmap.bmap(tstart, self.bcursor)
+        except ValueError:
+            return False
+        # The read starts in an insertion(I_0), or runs over the chromosome 
+        # end, or overlaps some variants.
+        rend = rstart + span - 1
+        if (rstart < 0 or rend >= self.chromLen or 
+            self.variantIndex.count(rstart, rend) > 0):
+            return False
+        
+        if VERBOSITY > 1:
+            log("variant-free read, shifted by %d\n" % (rstart - tstart))
+        rseq.cigar = cigar
+        self.setTags(rseq, 0, 0, 0)
+        rseq.pos = rstart
+        return True
+    
+    
+    def annotateRead(self, rseq, tregs=None, mapped=None):
+        '''
+        Annotate a read and convert it to the reference coordinate.
+        
+        tregs and mapped are the target regions and their mapped boundaries, 
+        which are precomputed by mapBatch() in the batch mode.
+        Return a tuple of (nSNPs, nInsertions, nDeletions).
+        '''
+        if VERBOSITY > 1:       
+            log("read name: %s\n" % rseq.qname)                
+            log("t. alignment pos: %d\n" % rseq.pos)
+            log("t. alignment cigar: '%s'\n\n" % cu.toString(rseq.cigar))                
+        if self.sweep:
+            self.advance(rseq.pos)
+        if self.fastPath and self.annotateClean(rseq):
+            self.nClean += 1
+            return (0, 0, 0)
+        if tregs is None:
             rseq.cigar = cu.simplify(rseq.cigar)   # Simplify the cigar first.
-            regions = []
             tregs = getTargetRegions(rseq)
-            for idx, treg in enumerate(tregs):   
-                if treg[0] == 0 or treg[0] == 7 or treg[0] == 8: # Match
-                    if VERBOSITY > 1:
-                        log("process match\n")
-                        log("t. region cigar(%d): %s\n" 
-                            % (idx, cu.toString([rseq.cigar[idx]])))
-                    rreg = self.parseTargetRegion(treg, rseq)  
-                    if VERBOSITY > 1:                     
-                        logRegion(rreg)                                                                  
-                elif treg[0] == 2 or treg[0] == 3: # Deletion/Splice junction
-                    rreg = (treg[0], )                    
-                else:                    
-                    rreg = (1, [rseq.cigar[idx]], 0, -1, -1) # Insertion
-                regions.append(rreg)
-            
-            if VERBOSITY > 1:                                                                
-                log("\nafter parsing match regions:\n")
-                log('\n'.join(map(str,regions)))
-                log("\n\n")
-                
-            nRegions = len(regions)
-            assert nRegions == len(rseq.cigar)
-                        
-            for idx in range(nRegions):
-                op = regions[idx][0]
-                if op == 2 or op == 3:   # Handle deletions and splicing                    
-                    if VERBOSITY > 1:                                    
-                        log("process deletion/splicing junction\n")
-                        log("t. region cigar(%d): %s\n" 
-                            % (idx, cu.toString([rseq.cigar[idx]])))                    
-                    if ((idx > 0) and idx < (nRegions - 1) and 
-                        (regions[idx-1][0] == 0) and (regions[idx+1][0] == 0)):
-                        delta = regions[idx+1][2] - regions[idx-1][3] - 1
-                        assert delta >= 0
-                        if delta == 0:                                                   
-                            rreg = (op, [], 
-                                    regions[idx-1][3]+1, 
-                                    regions[idx+1][2]-1, 
-                                    -1)
-                        else:                                                                                                       
-                            rreg = (op, [(op, delta)], 
-                                    regions[idx-1][3]+1, 
-                                    regions[idx+1][2]-1, 
-                                    -1)
-                        if VERBOSITY > 1:
-                            logRegion(rreg)           
-                                
-                    else:                        
-                        rreg = self.parseTargetRegion(tregs[idx], rseq)                        
-                        if VERBOSITY > 1:                                        
-                            logRegion(rreg)                             
-                        rreg = regionutils.modifyRegion(rreg)                                            
-                        if VERBOSITY > 1:                    
-                            log("after modification\n")  
-                            logRegion(rreg)                        
-                    regions[idx] = rreg                             
-            
-            if VERBOSITY > 1:                                                                
-                log("\nafter parsing deletions/splicing junction regions:\n")
-                log('\n'.join(map(str,regions)))  
-                log('\n\n')              
-            
-            cb = cigarbuilder.CigarBuilder()
-#            cigar=cb.build(regions)
-            for reg in regions:
-                cb.append(reg)
-            cigar = cb.cigar
-            
-            # Fix the MIDM pattern
-            if re.match('.*\d*I,\d*D', cu.toString(cigar)) is not None:
+        self.readOffsets = None
+        if mapped is None:
+            mapped = [None] * len(tregs)
+        regions = []
+        for idx, treg in enumerate(tregs):   
+            if treg[0] == 0 or treg[0] == 7 or treg[0] == 8: # Match
                 if VERBOSITY > 1:
-                    log("fix MIDM pattern: %s\n" % cu.toString(cigar))                
-#                print("%d,%d,%d" %(nSNPs, nInsertions, nDeletions))
-#                print(regions)           
-                for i in range(nRegions):
-                    if tregs[i][0] == 1:                        
-                        length = rseq.cigar[i][1]
-                        assert length > 0
-                                                                                              
-                        offset = getReadOffset(rseq, tregs[i][3]) + 1
-                        ins = (rseq.seq[offset:offset+length])
-                        if VERBOSITY > 1:
-                            log('seq in insertion: %s\n' % ins)
-                        
-                        if i > 0:
-                            assert regions[i-1][3] >= 0                            
-                            loKey = regions[i-1][3]
-                        elif i < nRegions - 1 and regions[i+1][2] >= length:
-                            loKey = regions[i+1][2] - length
+                    log("process match\n")
+                    log("t. region cigar(%d): %s\n" 
+                        % (idx, cu.toString([rseq.cigar[idx]])))
+                rreg = self.parseTargetRegion(treg, rseq, mapped[idx])  
+                if VERBOSITY > 1:                     
+                    logRegion(rreg)                                                                  
+            elif treg[0] == 2 or treg[0] == 3: # Deletion/Splice junction
+                rreg = (treg[0], )                    
+            else:                    
+                rreg = (1, [rseq.cigar[idx]], 0, -1, -1) # Insertion
+            regions.append(rreg)
+        
+        if VERBOSITY > 1:                                                                
+            log("\nafter parsing match regions:\n")
+            log('\n'.join(map(str,regions)))
+            log("\n\n")
+            
+        nRegions = len(regions)
+        assert nRegions == len(rseq.cigar)
+                    
+        for idx in range(nRegions):
+            op = regions[idx][0]
+            if op == 2 or op == 3:   # Handle deletions and splicing                    
+                if VERBOSITY > 1:                                    
+                    log("process deletion/splicing junction\n")
+                    log("t. region cigar(%d): %s\n" 
+                        % (idx, cu.toString([rseq.cigar[idx]])))                    
+                if ((idx > 0) and idx < (nRegions - 1) and 
+                    (regions[idx-1][0] == 0) and (regions[idx+1][0] == 0)):
+                    delta = regions[idx+1][2] - regions[idx-1][3] - 1
+                    assert delta >= 0
+                    if delta == 0:                                                   
+                        rreg = (op, [], 
+                                regions[idx-1][3]+1, 
+                                regions[idx+1][2]-1, 
+                                -1)
+                    else:                                                                                                       
+                        rreg = (op, [(op, delta)], 
+                                regions[idx-1][3]+1, 
+                                regions[idx+1][2]-1, 
+                                -1)
+                    if VERBOSITY > 1:
+                        logRegion(rreg)           
+                            
+                else:                        
+                    rreg = self.parseTargetRegion(tregs[idx], rseq, 
+                                                  mapped[idx])
+                    if VERBOSITY > 1:                                        
+                        logRegion(rreg)                             
+                    rreg = regionutils.modifyRegion(rreg)                                            
+                    if VERBOSITY > 1:                    
+                        log("after modification\n")  
+                        logRegion(rreg)                        
+                regions[idx] = rreg                             
+        
+        if VERBOSITY > 1:                                                                
+            log("\nafter parsing deletions/splicing junction regions:\n")
+            log('\n'.join(map(str,regions)))  
+            log('\n\n')              
+        
+        cb = cigarbuilder.CigarBuilder()
+#        cigar=cb.build(regions)
+        for reg in regions:
+            cb.append(reg)
+        cigar = cb.cigar
+        
+        # Fix the MIDM pattern, where an insertion is followed by a deletion
+        if cb.hasMIDM:
+            if self.metrics is not None:
+                self.metrics.midmFixes += 1
+            if VERBOSITY > 1:
+                log("fix MIDM pattern: %s\n" % cu.toString(cigar))                
+#            print("%d,%d,%d" %(nSNPs, nInsertions, nDeletions))
+#            print(regions)           
+            for i in range(nRegions):
+                if tregs[i][0] == 1:                        
+                    length = rseq.cigar[i][1]
+                    assert length > 0
+                                                                                          
+                    readOffsets = self.getReadOffsets(rseq)
+                    offset = readOffsets.getOffset(tregs[i][3]) + 1
+                    ins = (readOffsets.getSeq()[offset:offset+length])
+                    if VERBOSITY > 1:
+                        log('seq in insertion: %s\n' % ins)
+                    
+                    if i > 0:
+                        assert regions[i-1][3] >= 0                            
+                        loKey = regions[i-1][3]
+                    elif i < nRegions - 1 and regions[i+1][2] >= length:
+                        loKey = regions[i+1][2] - length
+                    else:
+                        loKey = -1
+                                                
+                    if i < nRegions - 1:
+                        assert regions[i+1][2] >= 0
+                        hiKey = regions[i+1][2] 
+                    elif i > 0 and regions[i-1][3] >= 0:
+                        hiKey = regions[i-1][3] + length
+                    else:
+                        hiKey = -1
+                          
+#                    loKey = regions[i-1][3]                      
+#                    hiKey = regions[i+1][2]
+                  
+                    data = self.getVariants(loKey, hiKey)
+                    lo, hi = 0, len(data)
+                    if VERBOSITY > 1:
+                        log('variants from %d-%d\n' % (loKey,hiKey))                          
+                        for j in range(lo,hi):
+                            log('%s\n' % str(self.formatRow(data[j])))
+                                                                                        
+                    isMatched = False
+                    matchStart = -1
+                    pivot = 0                                                                                                                   
+                    for j in range(lo,hi):
+                        if data[j][0] != 'd':
+                            continue                                           
+                        if matchStart == -1:
+                            matchStart = data[j][1]
+                        if ins[pivot] == data[j][2]:
+                            pivot += 1
                         else:
-                            loKey = -1
-                                                    
-                        if i < nRegions - 1:
-                            assert regions[i+1][2] >= 0
-                            hiKey = regions[i+1][2] 
-                        elif i > 0 and regions[i-1][3] >= 0:
-                            hiKey = regions[i-1][3] + length
+                            break
+                        if j == hi - 1 or pivot >= length:
+                            isMatched = True
+                            break
+                    
+                    if isMatched:
+                        if VERBOSITY > 1:
+                            log('insertion matches gap from left\n')
+                            log("before:\n")
+                            logRegion(regions[i])
+                        if pivot < length:                                                                                                              
+                            regions[i] = (0, [(0, pivot),(1,length-pivot)], 
+                                          matchStart, 
+                                          matchStart + pivot - 1,
+                                          matchStart)
                         else:
-                            hiKey = -1
-                              
-#                        loKey = regions[i-1][3]                      
-#                        hiKey = regions[i+1][2]
-                      
-                        lo = bisect.bisect_left(self.modKeys, loKey)
-                        hi = bisect.bisect_right(self.modKeys, hiKey)
+                            regions[i] = (0, [(0, pivot)], matchStart, 
+                                          matchStart + pivot - 1,
+                                          matchStart)
                         if VERBOSITY > 1:
-                            log('variants from %d-%d\n' % (loKey,hiKey))                          
-                            for j in range(lo,hi):
-                                log('%s\n' % str(self.data[j]))
-                                                                                            
-                        isMatched = False
-                        matchStart = -1
-                        pivot = 0                                                                                                                   
-                        for j in range(lo,hi):
-                            if self.data[j][0] != 'd':
-                                continue                                           
-                            if matchStart == -1:
-                                matchStart = int(self.data[j][2])                            
-                            if ins[pivot] == self.data[j][3]:
-                                pivot += 1
+                            log("after:\n")
+                            logRegion(regions[i])
+                            log("\n")
+                    else:                                                
+                        pivot = length - 1
+                        for j in range(hi-1,lo-1,-1):
+                            if data[j][0] != 'd':
+                                continue                                                                                                                         
+                            if ins[pivot] == data[j][2]:
+                                matchStart = data[j][1]
+                                pivot -= 1
                             else:
                                 break
-                            if j == hi - 1 or pivot >= length:
+                            if j == lo or pivot <= 0:
                                 isMatched = True
                                 break
-                        
+                    
                         if isMatched:
                             if VERBOSITY > 1:
-                                log('insertion matches gap from left\n')
+                                log('insertion matches gap from right\n')
                                 log("before:\n")
                                 logRegion(regions[i])
-                            if pivot < length:                                                                                                              
-                                regions[i] = (0, [(0, pivot),(1,length-pivot)], 
-                                              matchStart, 
-                                              matchStart + pivot - 1,
+                            if pivot >= 0:                                                                                            
+                                regions[i] = (0, [(1, pivot+1), (0, length-1-pivot)], 
+                                              matchStart,
+                                              matchStart + length - pivot - 2,
                                               matchStart)
                             else:
-                                regions[i] = (0, [(0, pivot)], matchStart, 
-                                              matchStart + pivot - 1,
+                                regions[i] = (0, [(0, length-1-pivot)], 
+                                              matchStart,
+                                              matchStart + length - pivot - 2,
                                               matchStart)
                             if VERBOSITY > 1:
                                 log("after:\n")
                                 logRegion(regions[i])
                                 log("\n")
-                        else:                                                
-                            pivot = length - 1
-                            for j in range(hi-1,lo-1,-1):
-                                if self.data[j][0] != 'd':
-                                    continue                                                                                                                         
-                                if ins[pivot] == self.data[j][3]:
-                                    matchStart = int(self.data[j][2])
-                                    pivot -= 1
-                                else:
-                                    break
-                                if j == lo or pivot <= 0:
-                                    isMatched = True
-                                    break
+                        else:
+                            if VERBOSITY > 1:
+                                log('insertion not matches\n')                  
                         
-                            if isMatched:
-                                if VERBOSITY > 1:
-                                    log('insertion matches gap from right\n')
-                                    log("before:\n")
-                                    logRegion(regions[i])
-                                if pivot >= 0:                                                                                            
-                                    regions[i] = (0, [(1, pivot+1), (0, length-1-pivot)], 
-                                                  matchStart,
-                                                  matchStart + length - pivot - 2,
-                                                  matchStart)
-                                else:
-                                    regions[i] = (0, [(0, length-1-pivot)], 
-                                                  matchStart,
-                                                  matchStart + length - pivot - 2,
-                                                  matchStart)
-                                if VERBOSITY > 1:
-                                    log("after:\n")
-                                    logRegion(regions[i])
-                                    log("\n")
-                            else:
-                                if VERBOSITY > 1:
-                                    log('insertion not matches\n')                  
-                            
-                cb = cigarbuilder.CigarBuilder()
-#                cigar=cb.build(regions)
-                for reg in regions:
-                    cb.append(reg)
-                cigar = cb.cigar
-#                print(cu.toString(cigar))
-            
+            cb = cigarbuilder.CigarBuilder()
+#            cigar=cb.build(regions)
+            for reg in regions:
+                cb.append(reg)
+            cigar = cb.cigar
+#            print(cu.toString(cigar))
+        
+        
+        if VERBOSITY > 1:                                                                
+            log("\nafter fixing special pattern:\n")
+            log('\n'.join(map(str,regions)))  
+            log('\n\n')              
             
-            if VERBOSITY > 1:                                                                
-                log("\nafter fixing special pattern:\n")
-                log('\n'.join(map(str,regions)))  
-                log('\n\n')              
+        nSNPs = 0
+        nInsertions = 0
+        nDeletions = 0
+        for reg in regions:
+            if len(reg) > 5:
+                nSNPs += reg[5]
+                nInsertions += reg[6]
+                nDeletions += reg[7]
+                                                    
+        ## Set tags
+        self.setTags(rseq, nSNPs, nInsertions, nDeletions)
+                    
+        ## Set pos to be the first M            
+        pos = -1
+        for reg in regions:
+            if reg[4] >= 0:
+                pos = reg[4]
+                break
+        rseq.pos = pos
+        
+        ## Set cigar
+        rseq.cigar = cu.simplify(cigar)
+        
+        return (nSNPs, nInsertions, nDeletions)
+    
+    
+    def mapBatch(self, reads):
+        '''
+        Get the target regions of a chunk of reads, and map the boundaries of
+        all their match/deletion/splicing junction regions to the reference 
+        coordinate in one vectorized pass.
+        
+        Return a list of tuples of (read, target regions, mapped boundaries), 
+        where the mapped boundaries are aligned with the target regions. 
+        Boundaries that cannot be mapped are left as None so that the regions 
+        will be parsed (and the errors will be raised) in order by 
+        annotateRead(). 
+        '''
+        allTregs = []
+        tstarts = []
+        tends = []
+        for rseq in reads:
+            try:
+                rseq.cigar = cu.simplify(rseq.cigar)   # Simplify the cigar first.
+                tregs = getTargetRegions(rseq)
+            except Exception:
+                tregs = None    # Leave the read to annotateRead().
+            allTregs.append(tregs)
+            if tregs is not None:
+                for treg in tregs:
+                    if treg[0] != 1:    # Match/Deletion/Splice junction
+                        tstarts.append(treg[2])
+                        tends.append(treg[3])
+        
+        cmap = self.cmap
+        rstarts, valid = cmap.bmapMany(tstarts)
+        rends, isValid = cmap.bmapMany(tends)
+        rstarts = np.abs(rstarts)
+        rends = np.abs(rends)
+        valid &= isValid & (rstarts <= rends)        
+        tposes, isValid = cmap.fmapMany(rstarts)
+        valid &= isValid
+        tposes = np.where(tposes < 0, -tposes + 1, tposes)
+        
+        boundaries = zip(rstarts.tolist(), rends.tolist(), tposes.tolist())
+        valid = valid.tolist()
+        
+        ret = []
+        k = 0
+        for rseq, tregs in zip(reads, allTregs):
+            if tregs is None:
+                ret.append((rseq, None, None))
+                continue
+            mapped = []
+            for treg in tregs:
+                if treg[0] != 1:
+                    mapped.append(boundaries[k] if valid[k] else None)
+                    k += 1
+                else:
+                    mapped.append(None)
+            ret.append((rseq, tregs, mapped))
+        return ret
+    
+    
+    def iterBatches(self):
+        '''Iterate reads in chunks of batchSize with their mapped regions.'''
+        reads = []
+        for rseq in self.inBam:
+            reads.append(rseq)
+            if len(reads) >= self.batchSize:
+                for item in self.mapBatch(reads):
+                    yield item
+                reads = []
+        for item in self.mapBatch(reads):
+            yield item
+        
+        
+    def execute(self):
+        '''The driver method for the module'''
+        self.logger.info("[%s]: %d read(s) found in BAM", self.chrom, self.nReads)
                 
-            nSNPs = 0
-            nInsertions = 0
-            nDeletions = 0
-            for reg in regions:
-                if len(reg) > 5:
-                    nSNPs += reg[5]
-                    nInsertions += reg[6]
-                    nDeletions += reg[7]
-                                                        
-            ## Set tags
-            tags = dict(rseq.tags)
-            if self.tagPrefixes is not None:
-                self.setTag(tags, self.tagPrefixes[0]+'0', nSNPs)            
-                self.setTag(tags, self.tagPrefixes[1]+'0', nInsertions)
-                self.setTag(tags, self.tagPrefixes[2]+'0', nDeletions)            
-                self.setTag(tags, 'OC', cu.toString(rseq.cigar).translate(None,','))
-                self.setTag(tags, 'OM', tags['NM'])            
-                del tags['NM']  ## Delete the old 'NM' tag.
-                  
+        self.modKeys = self.mod.positions   # Variant positions in reference
+        self.posmap = self.mod.getPosMap(self.chrom, self.chromLen)        
+        self.cmap = self.posmap.getChromMap(self.chrom)
+        self.blocks = self.mod.getBlocks(self.chrom)
+        if self.fastPath:
+            self.variantIndex = self.mod.getVariantIndex(self.chrom)
+        if self.sweep:
+            self.blockCursor = Cursor(self.blocks.positions, 
+                                      self.blocks.getRows)
+            self.fcursor = self.cmap.getFCursor()
+            self.bcursor = self.cmap.getBCursor()
+        else:
+            self.blockCursor = None
+            self.fcursor = None
+            self.bcursor = None
+        if self.onMetrics is not None:
+            # The counting wrappers are used only if the metrics are kept, 
+            # with no cost on the loop of reads otherwise.
+            self.metrics = Metrics(self.chrom)
+            self.cmap = CountingMap(self.cmap, self.metrics)
+            self.getBlocks = self.countBlocks
+            
+        count = 0
+        count2 = 0
+        if TESTING:
+            results = []
+        if self.nReads == 0:
+            if self.metrics is not None:
+                self.publishMetrics(0, 0, True)
+            return 0
+        if not TESTING:            
+            self.logger.info("[%s]: %3d%%", self.chrom, count*100/self.nReads)
+        
+        if self.batchSize > 0:
+            items = self.iterBatches()
+        else:
+            items = ((rseq, None, None) for rseq in self.inBam)
+                     
+        for rseq, tregs, mapped in items:      # Annotate each reads
+            nSNPs, nInsertions, nDeletions = self.annotateRead(rseq, tregs, 
+                                                               mapped)
             if nSNPs != 0 or nInsertions != 0 or nDeletions != 0:
                 count2 += 1
-                                          
-            rseq.tags = [(key, tags[key]) for key in sorted(tags.keys())] 
-                        
-            ## Set pos to be the first M            
-            pos = -1
-            for reg in regions:
-                if reg[4] >= 0:
-                    pos = reg[4]
-                    break
-            rseq.pos = pos
-            
-            ## Set cigar
-            rseq.cigar = cu.simplify(cigar)
 
             if self.outBam is not None:                
                 self.outBam.write(rseq)
+            if self.collector is not None:
+                self.collector.add(rseq)
         
             if TESTING:
                 results.append((rseq.cigar, rseq.pos, nSNPs, nInsertions, 
@@ -612,13 +893,32 @@ class Annotator:
                     (nSNPs, nInsertions, nDeletions))
             count += 1
             
-            if not TESTING and count % 100000 == 0:
-                self.logger.info("[%s]: %3d%%", self.chrom, count*100/self.nReads)        
+            if count % 100000 == 0:
+                if not TESTING:
+                    self.logger.info("[%s]: %3d%%", self.chrom, 
+                                     count*100/self.nReads)
+                if self.metrics is not None:
+                    self.publishMetrics(count, count2)
                 
+        if self.metrics is not None:
+            self.publishMetrics(count, count2, True)
         if not TESTING:
             self.logger.info("[%s]: %3d%%", self.chrom, count*100/self.nReads)
             self.logger.info("[%s]: %d read(s) written to file", self.chrom, count)
             self.logger.info("[%s]: %d read(s) have variants", self.chrom, count2)
+            if self.fastPath:
+                self.logger.info("[%s]: %d read(s) (%.1f%%) have no variants "
+                                 "and took the fast path", self.chrom, 
+                                 self.nClean, self.nClean*100.0/max(count, 1))
+            if self.sweep:
+                nSearches = 0
+                nFallbacks = 0
+                for cursor in (self.blockCursor, self.fcursor, self.bcursor):
+                    nSearches += cursor.nSearches
+                    nFallbacks += cursor.nFallbacks
+                self.logger.info("[%s]: %d of %d search(es) fell back to "
+                                 "binary search", self.chrom, nFallbacks, 
+                                 nSearches)
         else:
             return results
         
@@ -13,8 +13,19 @@ class CigarBuilder():
     def __init__(self):
         self.pend = -1
         self.cigar = []
+        self.lastOp = -1        # The last op with a non-zero length
+        self.hasMIDM = False    # An insertion followed by a deletion found
             
         
+    def track(self, cigar):
+        '''Track the ops appended to find the MIDM pattern.'''
+        for op, length in cigar:
+            if length > 0:
+                if op == 2 and self.lastOp == 1:
+                    self.hasMIDM = True
+                self.lastOp = op
+        
+        
     def append(self, region):
         if region[0] != 1:
             if self.pend >= 0:            
@@ -27,9 +38,13 @@ class CigarBuilder():
 #                    return                                
                 if delta > 0:
                     self.cigar.append((2, delta))  ##Insert deletions to gaps
+                    if self.lastOp == 1:
+                        self.hasMIDM = True
+                    self.lastOp = 2
         if region[3] >= 0:
             self.pend = region[3]
         self.cigar.extend(region[1])
+        self.track(region[1])
         
     
     def build(self, regions):
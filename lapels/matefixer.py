@@ -4,70 +4,66 @@ Created on Nov 13, 2012
 @author: Shunping Huang
 '''
 
-__all__ = ['fixmate']
+__all__ = ['fixmate', 'fixmateReads', 'fixmateReadsParallel', 'fixmateByPos',
+           'fixmateReadsByPos', 'MateCollector']
 
+import os
 import gc
+import marshal
+import collections
+import multiprocessing as mp
 import pysam
 import logging
+from lapels import sorter
 logger = logging.getLogger() 
 
 MAX_SEGMENTS_PER_HIT = 2
+CHUNK_SIZE = 50000      # Reads per chunk fixed by a worker
+workerRname = None      # rname() of workers, inherited when they fork
+WINDOW_SIZE = 500000    # Reads held in order while their mates are awaited
+KEEP = object()         # A tag kept as it is
+MATE_TAGS = ('NH', 'HI', 'CC', 'CP')    # The tags updated by process()
 
 
 def process(reads, rname):
-    '''Process a set of reads with the same read name'''
+    '''
+    Process a set of reads with the same read name.
+    
+    Only NH, HI, CC and CP of reads are updated, and the tags of a read are
+    set, which is the most costly, only if any of them is changed.
+    '''
     nReads = len(reads)    
     assert nReads > 0
-         
-    tags = [dict(r.tags) for r in reads]        
+    
+    tags = [dict(r.tags) for r in reads]
     hits = dict()
-    for i in range(nReads):       
-        hi = int(tags[i].get('HI',0))
-        if hi in hits.keys():
+    for i in range(nReads):
+        hi = int(tags[i].get('HI', 0))
+        if hi in hits:
             hits[hi].append(i)
         else:
             hits[hi] = [i]
-    
-#    if logger.isEnabledFor(logging.DEBUG):
-#        logger.debug(reads[0].qname)
-#        for k,v in hits.items():
-#            logger.debug('%s -> %s' %(k, str(v)))
+    keys = sorted(hits)
+    NH = len(keys)
+    # The new CC and CP of reads, None to remove them, or KEEP to keep them.
+    ccs = [KEEP] * nReads
+    cps = [KEEP] * nReads
     
     try:
-        NH = len(hits)
-#        if logger.isEnabledFor(logging.DEBUG):
-#            logger.debug("before:")
-#            for i in range(len(reads)):
-#                logger.debug(str(reads[i]))
-#                logger.debug(reads[i].tlen)
-                                        
-        # Update NH, HI, mate chrom and position, and insertion size                
-        for HI,k in enumerate(sorted(hits.keys())):
+        # Update mate chrom and position, and insertion size
+        for k in keys:
             hit = hits[k]
             n = len(hit) # Number of segments in a hit
-            assert n > 0
-            
             if n > MAX_SEGMENTS_PER_HIT:
                 logger.warning("%d reads in a hit" % n)
                 raise ValueError("%d reads in a hit" % n)
             
-            for j in hit:
-                tag = tags[j]            
-                if NH != tag.get('NH', None):
-#                    logger.debug("replacing NH=%d with %d" % (tag['NH'], NH))
-                    tag['NH'] = NH
-                if HI != tag.get('HI', 0):
-#                    logger.debug("replacing NH=%d with %d" % (tag['NH'], NH))
-                    if NH > 1:
-                        tag['HI'] = HI
-                    else:
-                        del tag['HI']
-                                                            
             # Single-end reads
             if n == 1:
-                reads[hit[0]].mrnm = -1
-                reads[hit[0]].mpos = -1
-                reads[hit[0]].tlen = 0
+                cur = reads[hit[0]]
+                cur.mrnm = -1
+                cur.mpos = -1
+                cur.tlen = 0
             # Multi-end reads
             else:
                 for j in range(n):
@@ -75,7 +71,6 @@ def process(reads, rname):
                     nxt = reads[hit[(j+1)%n]]                            
                     cur.mrnm = nxt.tid
                     cur.mpos = nxt.pos
-                            
                     if cur.tid == nxt.tid:                    
                         if cur.pos < nxt.pos:
                             cur.tlen = nxt.aend - cur.pos 
@@ -84,70 +79,104 @@ def process(reads, rname):
                     else:
                         cur.tlen = 0                        
         
-        # Update CC and CP
+        # Update CC and CP of each hit to the next hit
         prev = dict()
-        for HI,k in enumerate(sorted(hits.keys())):
-            if HI > 0 and HI < NH:
-                for j in hits[k]:
-                    idx = prev[reads[j].is_read1]                    
+        for HI, k in enumerate(keys):
+            hit = hits[k]
+            if HI > 0:
+                for j in hit:
                     try:
-                        if reads[idx].tid == reads[j].tid:
-                            tags[idx]['CC'] = '='
-                        else:
-                            tags[idx]['CC'] = rname(reads[j].tid)
+                        idx = prev[reads[j].is_read1]                    
                     except KeyError:
                         raise ValueError('No previous read1 or read2 is found')
-                    tags[idx]['CP'] = reads[j].pos + 1 # 1-based CP
-                prev=dict()
+                    if reads[idx].tid == reads[j].tid:
+                        ccs[idx] = '='
+                    else:
+                        ccs[idx] = rname(reads[j].tid)
+                    cps[idx] = reads[j].pos + 1 # 1-based CP
+                prev = dict()
                     
-            for j in hits[k]:      
+            for j in hit:      
                 is_read1 = reads[j].is_read1
                 if is_read1 in prev:                                    
                     raise ValueError("More than one read1 or read2 is found.")
-                else:
-                    prev[is_read1] = j
+                prev[is_read1] = j
                     
-            if HI == NH - 1:
-                for j in hits[k]:
-                    if 'CC' in tags[j].keys():
-                        del tags[j]['CC']
-                    if 'CP' in tags[j].keys():
-                        del tags[j]['CP']
-        
-        # Update tags
-        for i in range(nReads):
-            reads[i].tags = [(k,v) for k,v in tags[i].items()]
+        for j in hits[keys[-1]]:
+            ccs[j] = None
+            cps[j] = None
             
     except ValueError, err:
         logger.warning('%s : %s', str(err), reads[0].qname)        
         return 0
-        
-#    if logger.isEnabledFor(logging.DEBUG):
-#        logger.debug("after:")
-#        for i in range(len(reads)):
-#            logger.debug(str(reads[i]))
-#            logger.debug(reads[i].tlen)
+    
+    # Update NH, HI, CC and CP, and set the tags changed
+    for HI, k in enumerate(keys):
+        for i in hits[k]:
+            tag = tags[i]
+            changed = False
+            if NH != tag.get('NH', None):
+                tag['NH'] = NH
+                changed = True
+            if HI != tag.get('HI', 0):
+                if NH > 1:
+                    tag['HI'] = HI
+                else:
+                    del tag['HI']
+                changed = True
+            cc = ccs[i]
+            if cc is None:
+                for key in ('CC', 'CP'):
+                    if key in tag:
+                        del tag[key]
+                        changed = True
+            elif cc is not KEEP:
+                if cc != tag.get('CC', None) or cps[i] != tag.get('CP', None):
+                    tag['CC'] = cc
+                    tag['CP'] = cps[i]
+                    changed = True
+            if changed:
+                reads[i].tags = tag.items()
             
     return nReads
 
 
-def fixmate(infile, outfile):
+def fixmate(infile, outfile, nProcesses=1):
     inbam = pysam.Samfile(infile, 'rb')
     outbam = pysam.Samfile(outfile, 'wb', header=inbam.header, 
                            referencenames=inbam.references)
+    if nProcesses > 1:
+        ret = fixmateReadsParallel(inbam.fetch(until_eof=True), outbam, 
+                                   inbam.getrname, inbam.header, outfile,
+                                   nProcesses)
+    else:
+        ret = fixmateReads(inbam.fetch(until_eof=True), outbam, 
+                           inbam.getrname)
+    inbam.close()
+    outbam.close()
+    return ret
+
+
+def fixmateReads(readIter, outbam, rname, verbose=True):
+    '''
+    Fix mates of reads grouped by names, and write them to outbam, which is a
+    bam file or any object with a write() method.
+    rname: a function that returns the reference name of a tid.
+    verbose: whether to log the progress.
+    '''
     qname = None    
     nTotal = 0
     nFixed = 0
     count = 0;        
     reads = []    
     gc.disable()    
-    for rseq in inbam.fetch(until_eof=True):
+    for rseq in readIter:
         nTotal += 1        
         if qname is None or qname == rseq.qname:
             qname = rseq.qname
             reads.append(rseq)            
         else:            
-            count = process(reads, inbam.getrname) 
+            count = process(reads, rname) 
             if count > 0:
                 for r in reads:
                     outbam.write(r)
@@ -156,18 +185,396 @@ def fixmate(infile, outfile):
             del reads
             reads = [rseq]
         if nTotal % 200000 == 0:        
-            logger.info('%d read(s) fixed' % nTotal)
+            if verbose:
+                logger.info('%d read(s) fixed' % nTotal)
             gc.enable()
             gc.disable()
     
-    count = process(reads, inbam.getrname)
-    if count > 0:
-        for r in reads:
-            outbam.write(r)
-        nFixed += count
+    if len(reads) > 0:
+        count = process(reads, rname)
+        if count > 0:
+            for r in reads:
+                outbam.write(r)
+            nFixed += count
+    gc.enable()
+    if verbose:
+        logger.info('%d read(s) processed' % nTotal)
+        logger.info('%d read(s) fixed and written to file' % nFixed)
+    return (nTotal, nFixed)
+
+
+def iterChunks(readIter, chunkSize):
+    '''
+    Iterate chunks of about chunkSize reads grouped by names, where a group of
+    reads with the same name is never split between chunks.
+    '''
+    chunk = []
+    for rseq in readIter:
+        if len(chunk) >= chunkSize and chunk[-1].qname != rseq.qname:
+            yield chunk
+            chunk = []
+        chunk.append(rseq)
+    if len(chunk) > 0:
+        yield chunk
+
+
+def fixmateChunk(inName, outName):
+    '''
+    Fix mates of the reads in a chunk file in a worker, and write them to an
+    uncompressed bam file. Return (nTotal, nFixed) of the chunk.
+    '''
+    inFile = pysam.Samfile(inName, 'rb')
+    outFile = pysam.Samfile(outName, 'wbu', template=inFile)
+    ret = fixmateReads(inFile.fetch(until_eof=True), outFile, workerRname, 
+                       False)
+    outFile.close()
+    inFile.close()
+    os.remove(inName)
+    return ret
+
+
+def fixmateReadsParallel(readIter, outbam, rname, header, prefix, nProcesses,
+                         chunkSize=CHUNK_SIZE):
+    '''
+    Fix mates of reads grouped by names as fixmateReads() does, in nProcesses
+    worker processes. 
+    
+    Reads are split into chunks on the boundaries of groups and spilled to
+    uncompressed bam files, which are fixed by workers. The fixed chunks are
+    read back in their order and written to outbam, so that it is written 
+    with the same reads in the same order as by fixmateReads(). At most two
+    chunks per worker are in flight, so that the memory is bounded.
+    header: the bam header of reads.
+    prefix: the prefix of file names of chunks.
+    '''
+    global workerRname
+    workerRname = rname     # Set before workers are forked
+    pool = mp.Pool(nProcesses)
+    pending = collections.deque()
+    nTotal = 0
+    nFixed = 0
+    
+    def writeChunk(outName, result):
+        ret = result.get()
+        inFile = pysam.Samfile(outName, 'rb')
+        for rseq in inFile.fetch(until_eof=True):
+            outbam.write(rseq)
+        inFile.close()
+        os.remove(outName)
+        return ret
+    
+    try:
+        for idx, chunk in enumerate(iterChunks(readIter, chunkSize)):
+            inName = "%s.fixmate%d.bam" % (prefix, idx)
+            outName = "%s.fixmate%d.fixed.bam" % (prefix, idx)
+            chunkFile = pysam.Samfile(inName, 'wbu', header=header)
+            for rseq in chunk:
+                chunkFile.write(rseq)
+            chunkFile.close()
+            del chunk
+            pending.append((outName, pool.apply_async(fixmateChunk, 
+                                                      (inName, outName))))
+            if len(pending) >= 2 * nProcesses:
+                total, fixed = writeChunk(*pending.popleft())
+                nTotal += total
+                nFixed += fixed
+                logger.info('%d read(s) fixed' % nTotal)
+        while len(pending) > 0:
+            total, fixed = writeChunk(*pending.popleft())
+            nTotal += total
+            nFixed += fixed
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+        for outName, result in pending:
+            for fileName in [outName.replace('.fixed.bam', '.bam'), outName]:
+                if os.path.isfile(fileName):
+                    os.remove(fileName)
     logger.info('%d read(s) processed' % nTotal)
     logger.info('%d read(s) fixed and written to file' % nFixed)
-        
+    return (nTotal, nFixed)
+
+
+def getTag(rseq, tag, default):
+    '''Return the value of a tag of a read, or default if not found.'''
+    try:
+        return rseq.opt(tag)
+    except KeyError:
+        return default
+
+
+def getHitSize(rseq):
+    '''Return the number of segments expected in the hit of a read.'''
+    if rseq.is_paired and not rseq.mate_is_unmapped:
+        return 2
+    return 1
+
+
+
+class MateGroup:
+    '''
+    The reads with the same name held in the window, until all their hits,
+    as told by their NH and HI tags, are seen.
+    '''
+
+    def __init__(self):
+        self.entries = []       # [read, state] in the window
+        self.segments = dict()  # Number of segments seen by HI
+        self.nHits = 0          # Number of hits with all segments seen
+
+
+    def add(self, entry):
+        '''Add an entry of a read. Return whether the group is complete.'''
+        rseq = entry[0]
+        self.entries.append(entry)
+        hi = getTag(rseq, 'HI', 0)
+        n = self.segments.get(hi, 0) + 1
+        self.segments[hi] = n
+        if n == getHitSize(rseq):
+            self.nHits += 1
+        return self.nHits >= getTag(rseq, 'NH', 1)
+
+
+    def fix(self, rname):
+        '''Fix the reads, and set the states of entries. Return the count.'''
+        count = process([entry[0] for entry in self.entries], rname)
+        for entry in self.entries:
+            entry[1] = count > 0
+        return count
+
+
+
+def fixmateByPos(infile, outfile, windowSize=WINDOW_SIZE):
+    '''Fix mates of a bam file sorted by positions, without a name sort.'''
+    inbam = pysam.Samfile(infile, 'rb')
+    outbam = pysam.Samfile(outfile, 'wb', header=inbam.header, 
+                           referencenames=inbam.references)
+    ret = fixmateReadsByPos(inbam.fetch(until_eof=True), outbam, 
+                            inbam.getrname, inbam.header, outfile, windowSize)
     inbam.close()
     outbam.close()
-    return (nTotal, nFixed)
\ No newline at end of file
+    return ret
+
+
+def fixmateReadsByPos(readIter, outbam, rname, header, prefix, 
+                      windowSize=WINDOW_SIZE):
+    '''
+    Fix mates of reads sorted by positions, and write them to outbam in the
+    same order, without sorting them by names.
+    
+    Reads are held in a window in their order, with the reads of each name in
+    a group, until the group is complete by the NH and HI tags. A complete
+    group is fixed at once, and fixed reads leave the window in their order.
+    When the window is full, the group of its first read, whose mates are far
+    apart or on other chromosomes, is spilled to a sorter by names, as are the
+    later reads of the name. Spilled groups are fixed at the end, and merged
+    back by positions with the reads written after the first spill, which are
+    kept in an uncompressed run. Groups incomplete at the end, e.g. with a 
+    stale NH tag, are fixed as they are.
+    header: the bam header of reads.
+    prefix: the prefix of file names of spilled reads.
+    '''
+    nTotal = 0
+    nFixed = 0
+    window = collections.deque()
+    groups = dict()     # The incomplete groups in the window by names
+    farNames = set()    # The names of spilled groups
+    farSorter = None
+    runName = "%s.bypos.bam" % prefix
+    out = outbam
+    
+    def emit():
+        while len(window) > 0 and window[0][1] is not None:
+            rseq, state = window.popleft()
+            if state:
+                out.write(rseq)
+    
+    gc.disable()
+    for rseq in readIter:
+        nTotal += 1
+        qname = rseq.qname
+        if qname in farNames:
+            farSorter.write(rseq)
+        else:
+            entry = [rseq, None]
+            window.append(entry)
+            group = groups.get(qname)
+            if group is None:
+                group = groups[qname] = MateGroup()
+            if group.add(entry):
+                del groups[qname]
+                nFixed += group.fix(rname)
+                emit()
+            while len(window) > windowSize:
+                if farSorter is None:
+                    # All reads spilled later are after the reads written.
+                    farSorter = sorter.Sorter(sorter.nameKey, header, 
+                                              prefix + '.far')
+                    out = pysam.Samfile(runName, 'wbu', header=header)
+                qname = window[0][0].qname
+                farNames.add(qname)
+                for entry in groups.pop(qname).entries:
+                    farSorter.write(entry[0])
+                    entry[1] = False
+                emit()
+        if nTotal % 200000 == 0:
+            logger.info('%d read(s) fixed' % nTotal)
+            gc.enable()
+            gc.disable()
+    
+    for group in groups.values():
+        nFixed += group.fix(rname)
+    emit()
+    gc.enable()
+    
+    if farSorter is not None:
+        out.close()
+        logger.info('%d read(s) with far mates spilled' % len(farSorter))
+        posSorter = sorter.Sorter(sorter.coordKey, header, prefix + '.far.pos')
+        nFixed += fixmateReads(iter(farSorter), posSorter, rname, False)[1]
+        farSorter.remove()
+        for rseq in sorter.mergeRuns([runName, posSorter], sorter.coordKey):
+            outbam.write(rseq)
+        posSorter.remove()
+        os.remove(runName)
+    logger.info('%d read(s) processed' % nTotal)
+    logger.info('%d read(s) fixed and written to file' % nFixed)
+    return (nTotal, nFixed)
+
+
+def getMateTags(tags):
+    '''Return the tags updated by process() in a list of tags.'''
+    return [(key, value) for key, value in tags if key in MATE_TAGS]
+
+
+
+class MateRecord(object):
+    '''
+    The fields of a read that process() reads and fixes, on which it works in
+    place of the read.
+    '''
+    __slots__ = ('qname', 'flag', 'tid', 'pos', 'aend', 'tags', 'mateTags',
+                 'mrnm', 'mpos', 'tlen')
+
+    def __init__(self, qname, flag, tid, pos, aend, mateTags):
+        self.qname = qname
+        self.flag = flag
+        self.tid = tid
+        self.pos = pos
+        self.aend = aend
+        self.tags = mateTags        # Replaced by process() if changed
+        self.mateTags = mateTags    # The tags as collected
+        self.mrnm = -1
+        self.mpos = -1
+        self.tlen = 0
+
+
+    @property
+    def is_read1(self):
+        return (self.flag & 0x40) != 0
+
+
+
+class MateCollector:
+    '''
+    The collector of the fields of reads that fixing mates needs, added as
+    reads are annotated. Once all reads are added, the mates are fixed in
+    memory by names, and the fixed fields are patched into the reads as they
+    are written, so that the reads are neither sorted by names nor rewritten
+    to fix their mates.
+    '''
+
+    def __init__(self):
+        self.items = []     # (qname, flag, tid, pos, aend, mateTags) of reads
+        self.fixes = None   # The fixed fields by the keys of reads
+
+
+    def __len__(self):
+        return len(self.items)
+
+
+    def add(self, rseq):
+        '''Add the fields of a read.'''
+        self.items.append((rseq.qname, rseq.flag, rseq.tid, rseq.pos, 
+                           rseq.aend, getMateTags(rseq.tags)))
+
+
+    def save(self, fileName):
+        '''Save the fields added, e.g. in a worker process.'''
+        fp = open(fileName, 'wb')
+        marshal.dump(self.items, fp)
+        fp.close()
+
+
+    def load(self, fileName):
+        '''Add the fields saved in a file.'''
+        fp = open(fileName, 'rb')
+        self.items.extend(marshal.load(fp))
+        fp.close()
+
+
+    def resolve(self, rname):
+        '''
+        Fix the mates of reads grouped by names. Return (nTotal, nFixed).
+        rname: a function that returns the reference name of a tid.
+        '''
+        groups = dict()
+        for item in self.items:
+            record = MateRecord(*item)
+            if record.qname in groups:
+                groups[record.qname].append(record)
+            else:
+                groups[record.qname] = [record]
+        nTotal = len(self.items)
+        self.items = []
+        self.fixes = dict()
+        nFixed = 0
+        gc.disable()
+        for records in groups.itervalues():
+            count = process(records, rname)
+            nFixed += count
+            for r in records:
+                key = (r.qname, r.flag, r.tid, r.pos, tuple(r.mateTags))
+                if count == 0:
+                    self.fixes[key] = None
+                elif r.tags is r.mateTags:
+                    self.fixes[key] = (r.mrnm, r.mpos, r.tlen, None)
+                else:
+                    self.fixes[key] = (r.mrnm, r.mpos, r.tlen, r.tags)
+        gc.enable()
+        logger.info('%d read(s) processed' % nTotal)
+        logger.info('%d read(s) fixed' % nFixed)
+        return (nTotal, nFixed)
+
+
+    def patch(self, rseq):
+        '''
+        Patch the fixed fields into a read. Return False if the mates of the
+        read failed to be fixed, when the read is dropped.
+        '''
+        tags = rseq.tags
+        mateTags = getMateTags(tags)
+        fix = self.fixes[(rseq.qname, rseq.flag, rseq.tid, rseq.pos, 
+                          tuple(mateTags))]
+        if fix is None:
+            return False
+        rseq.mrnm, rseq.mpos, rseq.tlen, newTags = fix
+        if newTags is not None:
+            rseq.tags = [(key, value) for key, value in tags 
+                         if key not in MATE_TAGS] + newTags
+        return True
+
+
+    def writeTo(self, readIter, outbam):
+        '''
+        Patch the fixed fields into reads, and write them to outbam, which is
+        a bam file or any object with a write() method. Return the number of
+        reads written.
+        '''
+        count = 0
+        for rseq in readIter:
+            if self.patch(rseq):
+                outbam.write(rseq)
+                count += 1
+        return count
@@ -0,0 +1,177 @@
+'''
+The module of the counters of annotating reads.
+
+The counters are kept only if a callback is given to an annotator, which is
+called with the metrics on progress and when the annotation ends. The
+TextfileExporter is such a callback, which writes the counters of all
+annotators in the Prometheus text format, for the textfile collector of the
+node exporter.
+'''
+
+import os
+import time
+
+__all__ = ['Metrics', 'CountingMap', 'TextfileExporter']
+
+# The counters, and their help texts in the exported file.
+COUNTERS = (('reads', 'reads annotated'),
+            ('cleanReads', 'reads without variants shifted in the fast path'),
+            ('slowReads', 'reads annotated by parsing their regions'),
+            ('variantReads', 'reads with observed variants'),
+            ('regions', 'read regions parsed'),
+            ('variants', 'variant blocks visited in parsed regions'),
+            ('bmapCalls', 'positions mapped back to the reference'),
+            ('fmapCalls', 'positions mapped forth to the target'),
+            ('midmFixes', 'reads with the MIDM pattern fixed'))
+PREFIX = 'lapels_'
+
+
+def toSnakeCase(name):
+    '''Return a camelCase name in snake_case.'''
+    return ''.join('_' + c.lower() if c.isupper() else c for c in name)
+
+
+def getRatio(x, y):
+    '''Return x/y, or 0 if y is 0.'''
+    if y == 0:
+        return 0.0
+    return float(x) / y
+
+
+class Metrics:
+    '''The counters of annotating reads of a chromosome.'''
+
+    def __init__(self, chrom):
+        self.chrom = chrom
+        for name, text in COUNTERS:
+            setattr(self, name, 0)
+        self.startTime = time.time()
+        self.wallTime = 0.0
+        self.done = False
+
+
+    def getReadsPerSecond(self):
+        return getRatio(self.reads, self.wallTime)
+
+
+    def getRegionsPerRead(self):
+        '''Return the regions parsed per read out of the fast path.'''
+        return getRatio(self.regions, self.slowReads)
+
+
+    def getVariantsPerRegion(self):
+        return getRatio(self.variants, self.regions)
+
+
+    def toDict(self):
+        '''Return the counters and the wall time as a dict.'''
+        data = dict((name, getattr(self, name)) for name, text in COUNTERS)
+        data['wallTime'] = round(self.wallTime, 6)
+        return data
+
+
+
+class CountingMap:
+    '''
+    A position map of a chromosome that counts the positions mapped in the
+    metrics, used in place of the map only when the metrics are kept.
+    '''
+
+    def __init__(self, cmap, metrics):
+        self.cmap = cmap
+        self.metrics = metrics
+
+
+    def __getattr__(self, name):
+        return getattr(self.cmap, name)
+
+
+    def bmap(self, pos, cursor=None):
+        self.metrics.bmapCalls += 1
+        return self.cmap.bmap(pos, cursor)
+
+
+    def fmap(self, pos, cursor=None):
+        self.metrics.fmapCalls += 1
+        return self.cmap.fmap(pos, cursor)
+
+
+    def bmapMany(self, poses):
+        self.metrics.bmapCalls += len(poses)
+        return self.cmap.bmapMany(poses)
+
+
+    def fmapMany(self, poses):
+        self.metrics.fmapCalls += len(poses)
+        return self.cmap.fmapMany(poses)
+
+
+
+class TextfileExporter:
+    '''
+    A callback of metrics, which writes the counters summed over annotators
+    to a file in the Prometheus text format. The file is replaced atomically,
+    and only by the process that created the exporter.
+    '''
+
+    def __init__(self, fileName):
+        self.fileName = fileName
+        self.pid = os.getpid()
+        self.counters = dict()  # The counters of each annotator by keys
+
+
+    def __call__(self, metrics):
+        self.update(id(metrics), metrics.toDict())
+        self.write()
+
+
+    def update(self, key, counters):
+        '''Set the counters, as a dict, of an annotator.'''
+        self.counters[key] = counters
+
+
+    def getTotals(self):
+        '''Return the counters summed over annotators.'''
+        totals = dict((name, 0) for name, text in COUNTERS)
+        totals['wallTime'] = 0.0
+        for counters in self.counters.values():
+            for name in totals:
+                totals[name] += counters.get(name, 0)
+        return totals
+
+
+    def format(self):
+        '''Return the summed counters in the Prometheus text format.'''
+        totals = self.getTotals()
+        lines = []
+        def addMetric(name, kind, text, value):
+            lines.append('# HELP %s%s %s' % (PREFIX, name, text))
+            lines.append('# TYPE %s%s %s' % (PREFIX, name, kind))
+            lines.append('%s%s %s' % (PREFIX, name, value))
+        for name, text in COUNTERS:
+            addMetric(toSnakeCase(name) + '_total', 'counter',
+                      'Total number of ' + text + '.', totals[name])
+        addMetric('annotate_seconds_total', 'counter',
+                  'Total wall time of annotating reads in seconds.',
+                  round(totals['wallTime'], 6))
+        addMetric('reads_per_second', 'gauge',
+                  'Reads annotated per second of annotation.',
+                  round(getRatio(totals['reads'], totals['wallTime']), 3))
+        addMetric('regions_per_read', 'gauge',
+                  'Regions parsed per read out of the fast path.',
+                  round(getRatio(totals['regions'], totals['slowReads']), 3))
+        addMetric('variants_per_region', 'gauge',
+                  'Variant blocks visited per parsed region.',
+                  round(getRatio(totals['variants'], totals['regions']), 3))
+        return '\n'.join(lines) + '\n'
+
+
+    def write(self):
+        '''Replace the file with the summed counters.'''
+        if os.getpid() != self.pid:
+            return
+        tmpName = "%s.%d.tmp" % (self.fileName, self.pid)
+        fp = open(tmpName, 'w')
+        fp.write(self.format())
+        fp.close()
+        os.rename(tmpName, self.fileName)
@@ -0,0 +1,165 @@
+'''
+The module of timing the stages of a run.
+
+Each stage records its wall time, CPU time, the growth of the peak RSS of
+the process during the stage, the numbers of records in and out, and the
+numbers of bytes read and written, with keys such as the chromosome it works
+on. The records are written as a JSON report at the end of a run.
+'''
+
+import os
+import sys
+import time
+import json
+import resource
+
+__all__ = ['Report']
+
+IO_FILE = '/proc/self/io'   # The I/O counters of this process on Linux
+REPORT_VERSION = 2
+
+
+def getIOCounts():
+    '''
+    Return the numbers of bytes read and written by this process, or None if
+    they are not available.
+    '''
+    try:
+        fp = open(IO_FILE, 'r')
+    except IOError:
+        return None
+    counts = dict()
+    for line in fp:
+        key, sep, value = line.partition(':')
+        counts[key] = int(value)
+    fp.close()
+    return (counts.get('rchar'), counts.get('wchar'))
+
+
+def getCPUTime(who=resource.RUSAGE_SELF):
+    '''
+    Return the user and system CPU time in seconds of this process, or of its
+    terminated and waited-for children with RUSAGE_CHILDREN.
+    '''
+    usage = resource.getrusage(who)
+    return usage.ru_utime + usage.ru_stime
+
+
+def getMaxRSS(who=resource.RUSAGE_SELF):
+    '''
+    Return the peak RSS in bytes of this process, or of the largest of its
+    terminated and waited-for children with RUSAGE_CHILDREN.
+    '''
+    maxRSS = resource.getrusage(who).ru_maxrss
+    if sys.platform == 'darwin':
+        return maxRSS           # In bytes on Mac OS X
+    return maxRSS * 1024        # In kilobytes on Linux
+
+
+
+class Stage:
+    '''
+    The context of a timed stage. The numbers of records in and out, and the
+    counters of the stage as a dict, can be set before the stage ends.
+
+    The peak RSS of a process never decreases, so a stage records how much it
+    grew during the stage as maxRSSGrowth, which is 0 if the stage did not use
+    more memory than an earlier stage of the same process.
+    '''
+
+    def __init__(self, report, name, keys):
+        self.report = report
+        self.name = name
+        self.keys = keys
+        self.recordsIn = None
+        self.recordsOut = None
+        self.metrics = None
+
+
+    def __enter__(self):
+        self.io = getIOCounts()
+        self.cpu = getCPUTime()
+        self.maxRSS = getMaxRSS()
+        self.wall = time.time()
+        return self
+
+
+    def __exit__(self, excType, excValue, tb):
+        wall = time.time() - self.wall
+        record = dict(self.keys)
+        record['stage'] = self.name
+        record['pid'] = os.getpid()
+        record['wallTime'] = round(wall, 6)
+        record['cpuTime'] = round(getCPUTime() - self.cpu, 6)
+        record['maxRSSGrowth'] = getMaxRSS() - self.maxRSS
+        record['recordsIn'] = self.recordsIn
+        record['recordsOut'] = self.recordsOut
+        if self.recordsIn is not None and wall > 0:
+            record['recordsPerSecond'] = round(self.recordsIn / wall, 1)
+        io = getIOCounts()
+        if self.io is not None and io is not None:
+            record['bytesRead'] = io[0] - self.io[0]
+            record['bytesWritten'] = io[1] - self.io[1]
+        if self.metrics is not None:
+            record['metrics'] = self.metrics
+        if excType is not None:
+            record['failed'] = True
+        self.report.stages.append(record)
+        return False
+
+
+
+class Report:
+    '''The class of the records of timed stages in a run.'''
+
+    def __init__(self):
+        self.stages = []
+        self.startTime = time.time()
+
+
+    def stage(self, name, **keys):
+        '''
+        Return the context of a stage, which is recorded when it ends.
+        keys: the keys of the stage, such as the chromosome.
+        '''
+        return Stage(self, name, keys)
+
+
+    def getTotals(self):
+        '''Return the total wall and CPU time of stages by their names.'''
+        totals = dict()
+        for record in self.stages:
+            total = totals.setdefault(record['stage'],
+                                      {'count': 0, 'wallTime': 0.0,
+                                       'cpuTime': 0.0})
+            total['count'] += 1
+            total['wallTime'] += record['wallTime']
+            total['cpuTime'] += record['cpuTime']
+        for total in totals.values():
+            total['wallTime'] = round(total['wallTime'], 6)
+            total['cpuTime'] = round(total['cpuTime'], 6)
+        return totals
+
+
+    def write(self, fileName, **info):
+        '''
+        Write the report as JSON. The CPU time of the run includes that of the
+        worker processes which have ended, and its peak RSS is the larger of
+        those of this process and the largest worker.
+        info: other information of the run, such as the version and command.
+        '''
+        data = dict(info)
+        data['reportVersion'] = REPORT_VERSION
+        data['startTime'] = time.strftime('%Y-%m-%dT%H:%M:%S',
+                                          time.localtime(self.startTime))
+        data['wallTime'] = round(time.time() - self.startTime, 6)
+        data['cpuTime'] = round(getCPUTime() +
+                                getCPUTime(resource.RUSAGE_CHILDREN), 6)
+        data['maxRSS'] = max(getMaxRSS(),
+                             getMaxRSS(resource.RUSAGE_CHILDREN))
+        data['stages'] = self.stages
+        data['totals'] = self.getTotals()
+        fp = open(fileName, 'w')
+        json.dump(data, fp, indent=2, sort_keys=True)
+        fp.write('\n')
+        fp.close()
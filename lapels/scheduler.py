@@ -0,0 +1,93 @@
+'''
+The module of running jobs in a pool of worker processes.
+
+Jobs are queued from the most costly to the least, and a worker takes the next
+job once it finishes one, so that long jobs do not start at the end of a run.
+Results are sent back to the parent as soon as jobs finish. A failed job, or a
+worker that dies, stops all workers, and the error is raised in the parent.
+'''
+
+import Queue
+import traceback
+import multiprocessing as mp
+
+__all__ = ['runJobs']
+
+POLL_INTERVAL = 0.5     # Seconds between checks of dead workers
+
+
+def runWorker(workerId, func, tasks, results, running):
+    '''
+    Run jobs from the task queue until a None is found.
+    running: the shared array of the indexes of jobs running in workers, which
+             is written at once, unlike messages that may be lost if the 
+             worker dies.
+    '''
+    while True:
+        task = tasks.get()
+        if task is None:
+            return
+        idx, args = task
+        running[workerId] = idx
+        try:
+            ret = func(*args)
+        except Exception:
+            results.put(('error', idx, traceback.format_exc()))
+            return
+        results.put(('done', idx, ret))
+
+
+def getOrder(costs):
+    '''Return the indexes of jobs from the most costly to the least.'''
+    return sorted(range(len(costs)), key=lambda i: costs[i], reverse=True)
+
+
+def runJobs(func, jobs, costs, nProcesses):
+    '''
+    Run func(*args) for each tuple of args in jobs, with nProcesses worker
+    processes. Return the results in the order of jobs.
+    costs: the costs of jobs, which decide the order to start them.
+    '''
+    assert len(jobs) == len(costs)
+    nJobs = len(jobs)
+    tasks = mp.Queue()
+    results = mp.Queue()
+    for idx in getOrder(costs):
+        tasks.put((idx, jobs[idx]))
+    nProcesses = max(min(nProcesses, nJobs), 1)
+    for i in range(nProcesses):
+        tasks.put(None)
+
+    running = mp.Array('i', [-1] * nProcesses, lock=False)
+    workers = [mp.Process(target=runWorker, 
+                          args=(i, func, tasks, results, running))
+               for i in range(nProcesses)]
+    for worker in workers:
+        worker.start()
+
+    ret = [None] * nJobs
+    nDone = 0
+    try:
+        while nDone < nJobs:
+            try:
+                status, idx, value = results.get(True, POLL_INTERVAL)
+            except Queue.Empty:
+                for workerId, worker in enumerate(workers):
+                    if worker.exitcode is not None and worker.exitcode != 0:
+                        raise RuntimeError("worker %d died with exit code %d"
+                                           " in job %d"
+                                           % (workerId, worker.exitcode,
+                                              running[workerId]))
+                continue
+            if status == 'error':
+                raise RuntimeError("job %d failed:\n%s" % (idx, value))
+            ret[idx] = value
+            nDone += 1
+    except:
+        for worker in workers:
+            if worker.is_alive():
+                worker.terminate()
+        raise
+    for worker in workers:
+        worker.join()
+    return ret
@@ -0,0 +1,114 @@
+'''
+The module of splitting chromosomes into shards.
+
+A shard is a window [start, end) of a chromosome in the target (in silico)
+coordinate. A read belongs to the shard where it starts, so that every read is
+annotated exactly once, and the shards of a chromosome can be annotated in
+parallel.
+
+Chromosomes are split in proportion to their numbers of reads, and the windows
+of a chromosome are cut where the costs of reads and variants, counted in bins,
+are balanced.
+'''
+
+import array
+import numpy as np
+
+__all__ = ['BIN_SIZE', 'getShardCounts', 'splitBins', 'getShards',
+           'countBins', 'isInShard']
+
+BIN_SIZE = 100000   # Number of bases in a bin of density
+CHUNK_SIZE = 1000000  # Number of positions binned at a time
+
+
+def getShardCounts(costs, nShards):
+    '''
+    Given the costs of chromosomes, return the number of shards of each
+    chromosome, such that there are about nShards shards in total.
+    '''
+    costs = np.asarray(costs, dtype=np.float64)
+    total = costs.sum()
+    if len(costs) == 0 or total <= 0 or nShards <= len(costs):
+        return [1] * len(costs)
+    counts = np.ceil(costs * nShards / total).astype(np.int64)
+    return np.maximum(counts, 1).tolist()
+
+
+def splitBins(binCosts, nShards):
+    '''
+    Split bins into at most nShards groups of consecutive bins with balanced
+    total costs. Return the indexes of the first bins of the groups.
+    '''
+    cumCosts = np.cumsum(np.asarray(binCosts, dtype=np.float64))
+    nBins = len(cumCosts)
+    if nBins == 0 or nShards <= 1 or cumCosts[-1] <= 0:
+        return [0]
+    targets = cumCosts[-1] * np.arange(1, nShards) / nShards
+    # The bin where the cumulative cost reaches a target goes to the group 
+    # whose cost is closer to the target.
+    i = np.searchsorted(cumCosts, targets, 'left')
+    before = np.where(i > 0, cumCosts[np.maximum(i-1, 0)], 0)
+    starts = np.where(targets - before < cumCosts[i] - targets, i, i+1)
+    starts = np.unique(starts[(starts > 0) & (starts < nBins)])
+    return [0] + starts.tolist()
+
+
+def getShards(chrom, readBins, variantBins, nShards, binSize=BIN_SIZE):
+    '''
+    Split a chromosome into shards by the numbers of reads and variants in its
+    bins. The variants are binned in the reference coordinate, which is close
+    enough to the target coordinate for balancing.
+
+    Return a list of tuples of (chrom, start, end, nReads), where end is None
+    for the last shard, which runs to the chromosome end.
+    '''
+    readBins = np.asarray(readBins, dtype=np.int64)
+    variantBins = np.asarray(variantBins, dtype=np.int64)
+    nBins = max(len(readBins), len(variantBins))
+    binReads = np.zeros(nBins, np.int64)
+    binReads[:len(readBins)] = readBins
+    binCosts = binReads.copy()
+    binCosts[:len(variantBins)] += variantBins
+    
+    starts = splitBins(binCosts, nShards)
+    ends = starts[1:] + [nBins]
+    shards = []
+    for i in range(len(starts)):
+        nReads = int(binReads[starts[i]:ends[i]].sum())
+        if i == len(starts) - 1:
+            shards.append((chrom, starts[i] * binSize, None, nReads))
+        else:
+            shards.append((chrom, starts[i] * binSize, ends[i] * binSize,
+                           nReads))
+    return shards
+
+
+def countBins(positions, binSize=BIN_SIZE):
+    '''Return the numbers of positions from an iterable in bins.'''
+    counts = np.zeros(1, np.int64)
+    chunk = array.array('l')
+    for pos in positions:
+        chunk.append(pos)
+        if len(chunk) >= CHUNK_SIZE:
+            counts = addBins(counts, chunk, binSize)
+            chunk = array.array('l')
+    return addBins(counts, chunk, binSize)
+
+
+def addBins(counts, positions, binSize):
+    '''Add the numbers of positions in bins to counts.'''
+    positions = np.asarray(positions, dtype=np.int64)
+    positions = positions[positions >= 0]
+    if len(positions) == 0:
+        return counts
+    binCounts = np.bincount(positions // binSize)
+    if len(binCounts) > len(counts):
+        binCounts[:len(counts)] += counts
+        return binCounts
+    counts[:len(binCounts)] += binCounts
+    return counts
+
+
+def isInShard(pos, start, end):
+    '''Return whether a read starting at pos belongs to the shard.'''
+    return pos >= start and (end is None or pos < end)
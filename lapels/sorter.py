@@ -0,0 +1,331 @@
+'''
+The module of sorting reads in bounded memory.
+
+Reads are buffered in memory, and each time the buffer is full it is sorted
+and spilled to disk as a run. The runs are merged at the end, so that every
+read is written to and read from disk at most once, and not at all if all
+reads fit in the buffer.
+
+The buffer is bounded by a number of reads, or by a memory budget in bytes.
+Runs are uncompressed by default, as they are read back once, and may be
+spilled to a scratch directory. With more than one process, runs are sorted
+and written by forked processes while the next buffer is filled, and the
+budget is shared by the buffers in flight. More than MAX_RUNS runs are merged
+in passes, in a Sorter and in mergeRuns() given a header, so that the files
+open at once are bounded.
+
+sortFile() and mergeFiles() sort and merge bam files, in place of 'samtools
+sort' and 'samtools merge'.
+'''
+
+import os
+import re
+import sys
+import heapq
+import multiprocessing as mp
+import pysam
+
+__all__ = ['Sorter', 'nameKey', 'coordKey', 'mergeRuns', 'compactRuns',
+           'sortFile', 'mergeFiles']
+
+BUFFER_SIZE = 500000    # Number of reads kept in memory before a spill
+READ_BYTES = 600        # Bytes of a read in memory and its key, besides the
+                        # bytes of its sequence and qualities
+MAX_RUNS = 64           # Number of runs merged at once
+
+DIGITS = re.compile(r'(\d+)')
+
+
+def naturalKey(name):
+    '''
+    The key of a read name, in which runs of digits are compared by their
+    numeric values, as 'samtools sort -n' does.
+    '''
+    parts = DIGITS.split(name)
+    for i in range(1, len(parts), 2):
+        digits = parts[i].lstrip('0')
+        parts[i] = (len(digits), digits, parts[i])
+    return parts
+
+
+def nameKey(rseq):
+    '''The key of a read by its name, then read1 before read2.'''
+    return (naturalKey(rseq.qname), rseq.flag & 0xc0)
+
+
+def coordKey(rseq):
+    '''The key of a read by its position, with unmapped reads at the end.'''
+    tid = rseq.tid
+    if tid < 0:
+        tid = sys.maxint
+    return (tid, rseq.pos + 1, rseq.is_reverse)
+
+
+def decorate(reads, key, runIdx):
+    '''Decorate reads with their keys, and their orders for stability.'''
+    i = 0
+    for rseq in reads:
+        yield (key(rseq), runIdx, i, rseq)
+        i += 1
+
+
+def iterRun(fileName):
+    '''Iterate reads in a run file.'''
+    inFile = pysam.Samfile(fileName, 'rb')
+    for rseq in inFile.fetch(until_eof=True):
+        yield rseq
+    inFile.close()
+
+
+def writeReads(fileName, reads, header, mode='wb'):
+    '''Write reads to a bam file. Return the number of reads.'''
+    outFile = pysam.Samfile(fileName, mode, header=header)
+    count = 0
+    for rseq in reads:
+        outFile.write(rseq)
+        count += 1
+    outFile.close()
+    return count
+
+
+def compactRuns(runs, key, header, prefix, nRuns=None, mode='wbu', 
+                remove=False):
+    '''
+    Merge runs in passes, MAX_RUNS runs at a time, until there are at most
+    nRuns runs. Adjacent runs are merged, so that their order is kept. Return
+    the runs, some of which are files written by the passes, named by prefix.
+    Files written by a pass are removed once merged by the next pass.
+    runs: a list of run file names, or iterables of reads.
+    nRuns: the number of runs left, or None for MAX_RUNS.
+    remove: whether the given run files are removed once merged.
+    '''
+    if nRuns is None:
+        nRuns = MAX_RUNS
+    written = set()
+    nPasses = 0
+    while len(runs) > nRuns:
+        merged = []
+        for i in range(0, len(runs), MAX_RUNS):
+            group = runs[i:i + MAX_RUNS]
+            if len(group) == 1:
+                merged.append(group[0])
+                continue
+            fileName = "%s.pass%d.%d.bam" % (prefix, nPasses, len(merged))
+            writeReads(fileName, mergeRuns(group, key), header, mode)
+            for run in group:
+                if isinstance(run, str) and (remove or run in written):
+                    os.remove(run)
+            written.add(fileName)
+            merged.append(fileName)
+        runs = merged
+        nPasses += 1
+    return runs
+
+
+def mergeRuns(runs, key, header=None, prefix=None):
+    '''
+    Merge sorted runs into one stream of reads. Reads with the same key are
+    in the order of their runs.
+    runs: a list of run file names, or iterables of reads.
+    header, prefix: the bam header of reads, and the prefix of file names of
+    the runs merged in passes if there are more than MAX_RUNS runs, or None
+    to merge all runs at once.
+    '''
+    merged = runs
+    if header is not None and len(runs) > MAX_RUNS:
+        merged = compactRuns(runs, key, header, prefix)
+    try:
+        streams = []
+        for runIdx, run in enumerate(merged):
+            if isinstance(run, str):
+                run = iterRun(run)
+            streams.append(decorate(run, key, runIdx))
+        for item in heapq.merge(*streams):
+            yield item[3]
+    finally:
+        for run in merged:
+            if isinstance(run, str) and run not in runs:
+                os.remove(run)
+
+
+
+class Sorter:
+    '''
+    The class for sorting reads in bounded memory, with spills to runs.
+    It can replace an output bam file, as it has a write() method.
+    '''
+
+    def __init__(self, key, header, prefix, bufferSize=BUFFER_SIZE, 
+                 memory=None, nProcesses=1, compress=False, tmpDir=None):
+        '''
+        key: a function that returns the key of a read.
+        header: the bam header of reads.
+        prefix: the prefix of file names of runs.
+        bufferSize: the number of reads in the buffer.
+        memory: the bytes of reads in memory, or None for no budget.
+        nProcesses: the number of processes sorting and writing runs.
+        compress: whether runs are compressed.
+        tmpDir: the directory of runs, or None for the directory of prefix.
+        '''
+        assert bufferSize > 0
+        assert nProcesses > 0
+        self.key = key
+        self.header = header
+        self.prefix = prefix
+        if tmpDir is not None:
+            # Named by the process, as the directory may be shared.
+            self.prefix = os.path.join(tmpDir, "%s.%d" % (
+                                       os.path.basename(prefix), os.getpid()))
+        self.bufferSize = bufferSize
+        self.bufferBytes = None
+        if memory is not None:
+            # The buffer being filled shares the budget with those spilled.
+            self.bufferBytes = memory // nProcesses
+        self.nProcesses = nProcesses
+        self.runMode = 'wb' if compress else 'wbu'
+        self.buffer = []
+        self.nBytes = 0         # Bytes of reads in the buffer
+        self.runs = []          # File names of spilled runs
+        self.spills = []        # Processes writing runs
+        self.nReads = 0
+
+
+    def __len__(self):
+        return self.nReads
+
+
+    def write(self, rseq):
+        '''Add a read.'''
+        self.buffer.append(rseq)
+        self.nReads += 1
+        if self.bufferBytes is not None:
+            self.nBytes += READ_BYTES + 2 * rseq.rlen
+            if self.nBytes >= self.bufferBytes:
+                self.spill()
+                return
+        if len(self.buffer) >= self.bufferSize:
+            self.spill()
+
+
+    def spill(self):
+        '''Sort the reads in the buffer and write them to a run.'''
+        if len(self.buffer) == 0:
+            return
+        fileName = "%s.run%d.bam" % (self.prefix, len(self.runs))
+        if self.nProcesses > 1:
+            while len(self.spills) >= self.nProcesses - 1:
+                self.join(self.spills.pop(0))
+            # The forked process has the buffer with no copy or pickling.
+            proc = mp.Process(target=self.writeRun, 
+                              args=(fileName, self.buffer))
+            proc.start()
+            self.spills.append(proc)
+        else:
+            self.writeRun(fileName, self.buffer)
+        self.runs.append(fileName)
+        self.buffer = []
+        self.nBytes = 0
+
+
+    def writeRun(self, fileName, reads):
+        '''Sort reads in place, and write them to a run.'''
+        reads.sort(key=self.key)
+        self.writeTo(fileName, reads, self.runMode)
+
+
+    def join(self, proc):
+        '''Wait for a process writing a run.'''
+        proc.join()
+        if proc.exitcode != 0:
+            raise RuntimeError("Failed to write a run of reads (exit code: "
+                               "%s)." % proc.exitcode)
+
+
+    def wait(self):
+        '''Wait for all processes writing runs.'''
+        while len(self.spills) > 0:
+            self.join(self.spills.pop(0))
+
+
+    def writeTo(self, fileName, reads, mode='wb'):
+        '''Write reads to a bam file.'''
+        writeReads(fileName, reads, self.header, mode)
+
+
+    def compact(self, nRuns):
+        '''Merge runs in passes until there are at most nRuns runs.'''
+        self.runs = compactRuns(self.runs, self.key, self.header, self.prefix,
+                                nRuns, self.runMode, True)
+
+
+    def finish(self):
+        '''Spill all reads in memory. Return the file names of runs.'''
+        self.spill()
+        self.wait()
+        return self.runs
+
+
+    def __iter__(self):
+        '''Iterate all reads in order.'''
+        self.wait()
+        self.compact(MAX_RUNS - 1)
+        self.buffer.sort(key=self.key)
+        return mergeRuns(self.runs + [self.buffer], self.key)
+
+
+    def remove(self):
+        '''Remove the runs.'''
+        for proc in self.spills:
+            proc.join()
+        self.spills = []
+        for fileName in self.runs:
+            if os.path.isfile(fileName):
+                os.remove(fileName)
+        self.runs = []
+        self.buffer = []
+        self.nBytes = 0
+
+
+
+# The sort orders in bam headers of the keys
+SORT_ORDERS = {nameKey: 'queryname', coordKey: 'coordinate'}
+
+
+def sortFile(inName, outName, key, **options):
+    '''
+    Sort the reads of a bam file to another, as 'samtools sort' does. Return
+    the number of reads.
+    options: the keyword arguments of Sorter.
+    '''
+    inFile = pysam.Samfile(inName, 'rb')
+    header = dict(inFile.header.items())
+    if 'HD' in header and key in SORT_ORDERS:
+        header['HD']['SO'] = SORT_ORDERS[key]
+    prefix = outName
+    if prefix.endswith('.bam'):
+        prefix = prefix[:-4]
+    readSorter = Sorter(key, header, prefix, **options)
+    try:
+        for rseq in inFile.fetch(until_eof=True):
+            readSorter.write(rseq)
+        inFile.close()
+        readSorter.writeTo(outName, readSorter)
+    finally:
+        readSorter.remove()
+    return len(readSorter)
+
+
+def mergeFiles(fileNames, outName, key):
+    '''
+    Merge bam files sorted by a key to another, as 'samtools merge' does.
+    Reads with the same key are in the order of files. Return the number of
+    reads.
+    '''
+    inFile = pysam.Samfile(fileNames[0], 'rb')
+    header = dict(inFile.header.items())
+    inFile.close()
+    prefix = outName
+    if prefix.endswith('.bam'):
+        prefix = prefix[:-4]
+    return writeReads(outName, mergeRuns(fileNames, key, header, prefix), 
+                      header)
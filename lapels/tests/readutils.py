@@ -0,0 +1,36 @@
+'''
+The reads and files in memory shared by the tests of sorting and fixing mates.
+'''
+
+import pysam
+
+
+HEADER = {'HD': {'VN': '1.0'},
+          'SQ': [{'SN': '1', 'LN': 1000}, {'SN': '2', 'LN': 1000}]}
+RNAME = ['1', '2'].__getitem__      # The names of the chromosomes in HEADER
+
+
+def makeRead(qname, tid, pos, flag=0, tags=None):
+    '''Return a read of 10 bases matched at a position.'''
+    rseq = pysam.AlignedRead()
+    rseq.qname = qname
+    rseq.flag = flag
+    rseq.tid = tid
+    rseq.pos = pos
+    rseq.mapq = 255
+    rseq.cigar = [(0, 10)]
+    rseq.seq = 'A' * 10
+    rseq.tags = tags or []
+    return rseq
+
+
+
+class Writer:
+    '''A bam file in memory.'''
+
+    def __init__(self, reads=None):
+        self.reads = [] if reads is None else reads
+
+
+    def write(self, rseq):
+        self.reads.append(rseq)
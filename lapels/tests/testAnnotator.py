@@ -96,10 +96,30 @@ class TestGetReadOffset(unittest.TestCase):
         self.assertRaisesRegexp(ValueError, 'conflict', annot.getReadOffset, r, 49)
         self.assertRaisesRegexp(ValueError, 'conflict', annot.getReadOffset, r, 50)                
 
+
+    def test3(self):
+        # One index for all positions; the op 9 is unknown
+        r = Read(10, 50, [(0,10),(3,5),(0,0),(1,5),(0,10),(9,1),(0,10)])
+        offsets = annot.ReadOffsets(r)
+        self.assertRaisesRegexp(ValueError, 'underflows', offsets.getOffset, 9)
+        self.assertEquals(offsets.getOffset(10), 0)
+        self.assertEquals(offsets.getOffset(19), 9)
+        self.assertRaisesRegexp(ValueError, 'splicing', offsets.getOffset, 20)
+        self.assertRaisesRegexp(ValueError, 'splicing', offsets.getOffset, 24)
+        self.assertEquals(offsets.getOffset(25), 15)
+        self.assertEquals(offsets.getOffset(34), 24)
+        self.assertRaises(NotImplementedError, offsets.getOffset, 35)
+        self.assertRaises(NotImplementedError, offsets.getOffset, 45)
+
         
     
 class TestAnnotator(unittest.TestCase):    
     ''' Test class for Annotator '''
+    
+    batchSize = 0
+    sweep = False
+    fastPath = False
+    keepMetrics = False
             
     def setUp(self):
         annot.TESTING = 1
@@ -125,7 +145,11 @@ class TestAnnotator(unittest.TestCase):
             bamIter=[Read(tup[0], tup[1]+1, tup[2]) for tup in pool]        
                                    
         a = annot.Annotator(self.chromoID, refLens[self.chromoID],
-                                self.modobj, bamIter)
+                                self.modobj, bamIter, batchSize=self.batchSize,
+                                sweep=self.sweep, fastPath=self.fastPath,
+                                metrics=self.checkMetrics 
+                                        if self.keepMetrics else None)
+        self.nReads = len(pool)
         results = a.execute()
         
         for i,res in enumerate(results):            
@@ -138,6 +162,13 @@ class TestAnnotator(unittest.TestCase):
         os.remove(tmpName)
         os.remove(tmpName+'.tbi')
         
+        
+    def checkMetrics(self, metrics):
+        self.assertTrue(metrics.done)
+        self.assertEqual(metrics.reads, self.nReads)
+        self.assertEqual(metrics.cleanReads + metrics.slowReads, self.nReads)
+        self.assertTrue(metrics.regions >= metrics.slowReads)
+        self.assertTrue(metrics.bmapCalls >= metrics.reads)
               
                 
     def test1(self):
@@ -293,6 +324,35 @@ i\t1\t24\tabcdefghij
 
 
 
+class TestAnnotatorBatch(TestAnnotator):
+    ''' Test class for Annotator in the batch mode '''
+    
+    batchSize = 3
+    
+    
+
+class TestAnnotatorSweep(TestAnnotator):
+    ''' Test class for Annotator with sweep-line cursors '''
+    
+    sweep = True
+    
+    
+
+class TestAnnotatorFastPath(TestAnnotator):
+    ''' Test class for Annotator with the fast path of variant-free reads '''
+    
+    fastPath = True
+    
+    
+
+class TestAnnotatorMetrics(TestAnnotator):
+    ''' Test class for Annotator with the metrics kept '''
+    
+    fastPath = True
+    keepMetrics = True
+    
+    
+
 class TestAnnotator2(unittest.TestCase):    
     '''
     Test case for insertions/deletion/splicing junction in read
@@ -90,6 +90,21 @@ class TestCigarBuilder(unittest.TestCase):
         self.assertEqual(cigarutils.simplify(cigar),[(0,26),(1,1),(0,74)])   
         
         
+    def test_hasMIDM(self):
+        cb = cigarbuilder.CigarBuilder()
+        cb.append(makeReadRegion(0, '5M', 0, 4))
+        cb.append(makeReadRegion(1, '2I', 5, 4))
+        self.assertFalse(cb.hasMIDM)
+        cb.append(makeReadRegion(0, '3M', 8, 10))   ## a gap of deletions here
+        self.assertTrue(cb.hasMIDM)
+        
+        cb = cigarbuilder.CigarBuilder()
+        cb.append((0, [(0, 5), (1, 2), (2, 0)], 0, 4))
+        cb.append((0, [(3, 2), (2, 1), (0, 3)], 5, 10))
+        self.assertFalse(cb.hasMIDM)
+        cb.append((0, [(1, 1), (0, 0), (2, 2), (0, 1)], 11, 14))
+        self.assertTrue(cb.hasMIDM)
+        
     
 if __name__ == '__main__':
     unittest.main()
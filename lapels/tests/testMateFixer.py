@@ -0,0 +1,194 @@
+import os
+import shutil
+import filecmp
+import tempfile
+import unittest
+import pysam
+
+from lapels import sorter
+from lapels import matefixer
+from lapels.tests.readutils import HEADER, RNAME, makeRead, Writer
+
+
+class TestProcess(unittest.TestCase):
+
+    def test_multiHits(self):
+        reads = [makeRead('r', 0, 100, 0x41,
+                          [('NM', 0), ('NH', 3), ('HI', 1)]),
+                 makeRead('r', 1, 300, 0x41,
+                          [('NM', 0), ('NH', 3), ('HI', 3)]),
+                 makeRead('r', 0, 200, 0x41,
+                          [('NM', 0), ('NH', 3), ('HI', 2)]),
+                 makeRead('r', 0, 150, 0x81,
+                          [('NM', 0), ('NH', 3), ('HI', 1)]),
+                 makeRead('r', 0, 250, 0x81,
+                          [('NM', 0), ('NH', 3), ('HI', 2)]),
+                 makeRead('r', 1, 350, 0x81,
+                          [('NM', 0), ('NH', 3), ('HI', 3)])]
+        self.assertEqual(matefixer.process(reads, RNAME), 6)
+        tags = [dict(r.tags) for r in reads]
+        self.assertEqual([t['HI'] for t in tags], [0, 2, 1, 0, 1, 2])
+        self.assertEqual([(t.get('CC'), t.get('CP')) for t in tags],
+                         [('=', 201), (None, None), ('2', 301), ('=', 251),
+                          ('2', 351), (None, None)])
+        self.assertEqual([(r.mrnm, r.mpos, r.tlen) for r in reads[:2]],
+                         [(0, 150, 60), (1, 350, 60)])
+
+
+    def test_unchanged(self):
+        tags = [('NH', 1), ('XS', '+'), ('NM', 2)]
+        reads = [makeRead('r', 0, 100, 0x41, list(tags)),
+                 makeRead('r', 0, 200, 0x81, list(tags))]
+        self.assertEqual(matefixer.process(reads, RNAME), 2)
+        # Tags not changed are kept in their order.
+        self.assertEqual([r.tags for r in reads], [tags, tags])
+        reads = [makeRead('r', 0, 100, 0x41,
+                          [('NH', 2), ('HI', 1), ('CP', 5)])]
+        self.assertEqual(matefixer.process(reads, RNAME), 1)
+        self.assertEqual(reads[0].tags, [('NH', 1)])
+
+
+    def test_invalid(self):
+        # No read2 in the first hit, or three reads in a hit
+        reads = [makeRead('r', 0, 100, 0x41, [('NH', 2), ('HI', 1)]),
+                 makeRead('r', 0, 200, 0x81, [('NH', 2), ('HI', 2)])]
+        self.assertEqual(matefixer.process(reads, RNAME), 0)
+        reads = [makeRead('r', 0, i, 0x41, [('NH', 1)]) for i in range(3)]
+        self.assertEqual(matefixer.process(reads, RNAME), 0)
+        self.assertEqual([r.tags for r in reads], [[('NH', 1)]] * 3)
+
+
+
+class TestMateCollector(unittest.TestCase):
+
+    def makeReads(self):
+        return [makeRead('r', 0, 100, 0x41, [('NM', 0), ('NH', 2), ('HI', 1)]),
+                makeRead('q', 0, 120, 0x41, [('NM', 1), ('NH', 1)]),
+                makeRead('r', 0, 150, 0x81, [('NM', 0), ('NH', 2), ('HI', 1)]),
+                makeRead('q', 0, 180, 0x81, [('NM', 1), ('NH', 1)]),
+                makeRead('r', 1, 300, 0x41, [('NM', 0), ('NH', 2), ('HI', 2)]),
+                makeRead('r', 1, 350, 0x81, [('NM', 0), ('NH', 2), ('HI', 2)]),
+                makeRead('s', 1, 400, 0x41, [('NH', 1)]),
+                makeRead('s', 1, 410, 0x41, [('NH', 1)])]
+
+
+    def test_patch(self):
+        collector = matefixer.MateCollector()
+        for rseq in self.makeReads():
+            collector.add(rseq)
+        # Collected in a worker, and loaded by the main process
+        fileName = tempfile.mkstemp('.mates')[1]
+        collector.save(fileName)
+        collector = matefixer.MateCollector()
+        collector.load(fileName)
+        os.remove(fileName)
+        self.assertEqual(collector.resolve(RNAME), (8, 6))
+        reads = []
+        self.assertEqual(collector.writeTo(self.makeReads(), Writer(reads)), 
+                         6)
+        # The same fields as fixed by process(), with 's' dropped
+        expected = self.makeReads()
+        matefixer.process([expected[i] for i in (0, 2, 4, 5)], RNAME)
+        matefixer.process([expected[i] for i in (1, 3)], RNAME)
+        for rseq, fixed in zip(reads, expected[:6]):
+            self.assertEqual((rseq.mrnm, rseq.mpos, rseq.tlen),
+                             (fixed.mrnm, fixed.mpos, fixed.tlen))
+            self.assertEqual(sorted(rseq.tags), sorted(fixed.tags))
+        # Tags not changed are kept in their order.
+        self.assertEqual(reads[1].tags, [('NM', 1), ('NH', 1)])
+        self.assertEqual(reads[0].tags[0], ('NM', 0))
+
+
+
+class TestFixmate(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpDir = tempfile.mkdtemp()
+        self.prefix = os.path.join(self.tmpDir, 'test')
+
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpDir)
+
+
+    def test_fixmate(self):
+        s = sorter.Sorter(sorter.nameKey, HEADER, self.prefix, 2)
+        s.write(makeRead('p', 0, 100, 0x41, [('NH', 1)]))
+        s.write(makeRead('q', 1, 10, 0, [('NH', 1)]))
+        s.write(makeRead('p', 1, 300, 0x81, [('NH', 1)]))
+        out = sorter.Sorter(sorter.coordKey, HEADER, self.prefix + '.pos')
+        nTotal, nFixed = matefixer.fixmateReads(iter(s), out, RNAME)
+        self.assertEqual((nTotal, nFixed), (3, 3))
+        reads = list(out)
+        self.assertEqual([(r.qname, r.tid, r.pos, r.mrnm, r.mpos)
+                          for r in reads],
+                         [('p', 0, 100, 1, 300), ('q', 1, 10, -1, -1),
+                          ('p', 1, 300, 0, 100)])
+        s.remove()
+
+
+    def test_fixmateParallel(self):
+        inName = self.prefix + '.names.bam'
+        inFile = pysam.Samfile(inName, 'wb', header=HEADER)
+        for i in range(20):
+            inFile.write(makeRead('r%02d' % i, 0, 10 * i, 0x41, [('NH', 1)]))
+            inFile.write(makeRead('r%02d' % i, 1, 5 * i, 0x81, [('NH', 1)]))
+        inFile.close()
+        outNames = []
+        for nProcesses, chunkSize in [(1, 0), (2, 3), (3, 1)]:
+            outName = self.prefix + '.p%d.bam' % nProcesses
+            inFile = pysam.Samfile(inName, 'rb')
+            outFile = pysam.Samfile(outName, 'wb', template=inFile)
+            reads = inFile.fetch(until_eof=True)
+            if nProcesses == 1:
+                ret = matefixer.fixmateReads(reads, outFile, inFile.getrname)
+            else:
+                ret = matefixer.fixmateReadsParallel(reads, outFile, 
+                                                     inFile.getrname, 
+                                                     inFile.header, 
+                                                     self.prefix, nProcesses,
+                                                     chunkSize)
+            outFile.close()
+            inFile.close()
+            self.assertEqual(ret, (40, 40))
+            outNames.append(outName)
+        # The same bytes as written by a single process, with no chunk left.
+        for outName in outNames[1:]:
+            self.assertTrue(filecmp.cmp(outNames[0], outName, False))
+        self.assertEqual(len(os.listdir(self.tmpDir)), 4)
+
+
+    def makeReadsByPos(self):
+        return [makeRead('p', 0, 100, 0x41, [('NH', 1)]),
+                makeRead('m', 0, 150, 0x41, [('NH', 2), ('HI', 1)]),
+                makeRead('q', 0, 200, 0, [('NH', 1)]),
+                makeRead('m', 0, 250, 0x81, [('NH', 2), ('HI', 1)]),
+                makeRead('p', 1, 300, 0x81, [('NH', 1)]),
+                makeRead('m', 1, 400, 0x41, [('NH', 2), ('HI', 2)]),
+                makeRead('m', 1, 420, 0x81, [('NH', 2), ('HI', 2)])]
+
+
+    def test_fixmateByPos(self):
+        byName = Writer()
+        reads = sorted(self.makeReadsByPos(), key=sorter.nameKey)
+        matefixer.fixmateReads(iter(reads), byName, RNAME)
+        for windowSize in [10, 2]:   # With no spill, and with spills
+            outbam = Writer()
+            ret = matefixer.fixmateReadsByPos(iter(self.makeReadsByPos()),
+                                              outbam, RNAME, HEADER,
+                                              self.prefix, windowSize)
+            self.assertEqual(ret, (7, 7))
+            # The reads are in the same order, and fixed as in groups by
+            # names, with no spilled file left.
+            self.assertEqual([r.qname for r in outbam.reads],
+                             ['p', 'm', 'q', 'm', 'p', 'm', 'm'])
+            self.assertEqual(sorted(str(r) for r in outbam.reads),
+                             sorted(str(r) for r in byName.reads))
+            self.assertEqual(os.listdir(self.tmpDir), [])
+        self.assertEqual([(r.mrnm, r.mpos) for r in outbam.reads[:2]], 
+                         [(1, 300), (0, 250)])
+
+
+
+if __name__ == '__main__':
+    unittest.main()
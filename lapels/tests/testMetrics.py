@@ -0,0 +1,50 @@
+import os
+import tempfile
+import unittest
+
+from lapels.metrics import Metrics, CountingMap, TextfileExporter
+from modtools.posmap import ChromMap
+
+
+class TestMetrics(unittest.TestCase):
+
+    def test_CountingMap(self):
+        metrics = Metrics('1')
+        cmap = ChromMap('1', [0, 10, -14], [0, -9, 10], [10, 5, 10], 
+                        [0, 0, 0])
+        counting = CountingMap(cmap, metrics)
+        self.assertEqual(counting.bmap(15), cmap.bmap(15))
+        self.assertEqual(counting.fmap(5), cmap.fmap(5))
+        counting.bmapMany([1, 2, 3])
+        self.assertEqual((metrics.bmapCalls, metrics.fmapCalls), (4, 1))
+        self.assertEqual(len(counting), len(cmap))
+
+
+    def test_TextfileExporter(self):
+        fileName = tempfile.mkstemp('.prom')[1]
+        exporter = TextfileExporter(fileName)
+        for chrom in ['1', '2']:
+            metrics = Metrics(chrom)
+            metrics.reads = 10
+            metrics.slowReads = 4
+            metrics.regions = 8
+            metrics.variants = 2
+            metrics.wallTime = 0.5
+            exporter(metrics)
+        exporter(metrics)   # Updated, not added again
+        fp = open(fileName)
+        lines = [line.split() for line in fp if not line.startswith('#')]
+        fp.close()
+        os.remove(fileName)
+        values = dict(lines)
+        self.assertEqual(values['lapels_reads_total'], '20')
+        self.assertEqual(values['lapels_slow_reads_total'], '8')
+        self.assertEqual(values['lapels_reads_per_second'], '20.0')
+        self.assertEqual(values['lapels_regions_per_read'], '2.0')
+        self.assertEqual(values['lapels_variants_per_region'], '0.25')
+        self.assertEqual(len(values), 13)
+
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,61 @@
+import os
+import json
+import tempfile
+import unittest
+
+from lapels.report import Report
+
+
+class TestReport(unittest.TestCase):
+
+    def test_stage(self):
+        report = Report()
+        with report.stage('annotate', chrom='1') as stage:
+            stage.recordsIn = 10
+            stage.recordsOut = 8
+        with report.stage('annotate', chrom='2'):
+            pass
+        self.assertEqual(len(report.stages), 2)
+        record = report.stages[0]
+        self.assertEqual(record['stage'], 'annotate')
+        self.assertEqual(record['chrom'], '1')
+        self.assertEqual(record['pid'], os.getpid())
+        self.assertEqual((record['recordsIn'], record['recordsOut']), (10, 8))
+        self.assertTrue(record['wallTime'] >= 0)
+        self.assertTrue(record['maxRSSGrowth'] >= 0)
+        self.assertFalse('failed' in record)
+        self.assertEqual(report.getTotals()['annotate']['count'], 2)
+
+
+    def test_failed(self):
+        report = Report()
+        try:
+            with report.stage('load'):
+                raise ValueError()
+        except ValueError:
+            pass
+        self.assertTrue(report.stages[0]['failed'])
+
+
+    def test_write(self):
+        report = Report()
+        with report.stage('sort'):
+            pass
+        fileName = tempfile.mkstemp('.json')[1]
+        report.write(fileName, version='0.1')
+        fp = open(fileName)
+        data = json.load(fp)
+        fp.close()
+        os.remove(fileName)
+        self.assertEqual(data['version'], '0.1')
+        self.assertEqual(data['reportVersion'], 2)
+        self.assertTrue(data['maxRSS'] > 0)
+        self.assertTrue(data['cpuTime'] >= 0)
+        self.assertEqual([record['stage'] for record in data['stages']],
+                         ['sort'])
+        self.assertEqual(data['totals']['sort']['count'], 1)
+
+
+
+if __name__ == '__main__':
+    unittest.main()
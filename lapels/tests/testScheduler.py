@@ -0,0 +1,57 @@
+import os
+import time
+import unittest
+
+from lapels import scheduler
+
+
+def square(x):
+    return x * x
+
+
+def fail(x):
+    if x == 3:
+        raise ValueError("bad job %d" % x)
+    time.sleep(0.1)
+    return x
+
+
+def die(x):
+    if x == 2:
+        os._exit(3)
+    return x
+
+
+
+class TestScheduler(unittest.TestCase):
+
+    def test_getOrder(self):
+        self.assertEqual(scheduler.getOrder([5, 1, 9, 5, 0]), [2, 0, 3, 1, 4])
+        self.assertEqual(scheduler.getOrder([]), [])
+
+
+    def test_runJobs(self):
+        jobs = [(i,) for i in range(10)]
+        costs = [i % 3 for i in range(10)]
+        self.assertEqual(scheduler.runJobs(square, jobs, costs, 3),
+                         [i * i for i in range(10)])
+        self.assertEqual(scheduler.runJobs(square, jobs[:2], [0, 0], 8),
+                         [0, 1])
+        self.assertEqual(scheduler.runJobs(square, [], [], 2), [])
+
+
+    def test_failure(self):
+        jobs = [(i,) for i in range(6)]
+        self.assertRaisesRegexp(RuntimeError, 'job 3 failed(.|\n)*bad job 3',
+                                scheduler.runJobs, fail, jobs, [0] * 6, 2)
+
+
+    def test_death(self):
+        jobs = [(i,) for i in range(4)]
+        self.assertRaisesRegexp(RuntimeError, 'exit code 3 in job 2',
+                                scheduler.runJobs, die, jobs, [0] * 4, 2)
+
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,46 @@
+import unittest
+from lapels import shards
+
+
+class TestShards(unittest.TestCase):
+
+    def test_getShardCounts(self):
+        self.assertEqual(shards.getShardCounts([100, 10, 0], 6), [6, 1, 1])
+        self.assertEqual(shards.getShardCounts([100, 10, 0], 2), [1, 1, 1])
+        self.assertEqual(shards.getShardCounts([0, 0], 8), [1, 1])
+        self.assertEqual(shards.getShardCounts([], 8), [])
+
+
+    def test_splitBins(self):
+        self.assertEqual(shards.splitBins([1, 1, 1, 1, 10, 1], 3), [0, 4, 5])
+        self.assertEqual(shards.splitBins([1] * 10, 4), [0, 3, 5, 8])
+        self.assertEqual(shards.splitBins([0, 0, 5], 3), [0, 2])
+        self.assertEqual(shards.splitBins([3], 4), [0])
+        self.assertEqual(shards.splitBins([], 4), [0])
+        self.assertEqual(shards.splitBins([1, 2, 3], 1), [0])
+
+
+    def test_getShards(self):
+        self.assertEqual(shards.getShards('1', [5, 5, 5], [0, 0, 0, 30], 2,
+                                          10),
+                         [('1', 0, 30, 15), ('1', 30, None, 0)])
+        self.assertEqual(shards.getShards('1', [5, 5], [], 1, 10),
+                         [('1', 0, None, 10)])
+
+
+    def test_countBins(self):
+        self.assertEqual(shards.countBins(iter([5, 15, 25, -1, 3]), 10).tolist(),
+                         [2, 1, 1])
+        self.assertEqual(shards.countBins([], 10).tolist(), [0])
+
+
+    def test_isInShard(self):
+        self.assertTrue(shards.isInShard(10, 10, 20))
+        self.assertFalse(shards.isInShard(9, 10, 20))
+        self.assertFalse(shards.isInShard(20, 10, 20))
+        self.assertTrue(shards.isInShard(200, 10, None))
+
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,154 @@
+import os
+import shutil
+import tempfile
+import unittest
+import pysam
+
+from lapels import sorter
+from lapels.tests.readutils import HEADER, makeRead
+
+
+class TestSorter(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpDir = tempfile.mkdtemp()
+        self.prefix = os.path.join(self.tmpDir, 'test')
+
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpDir)
+
+
+    def test_nameKey(self):
+        names = ['r10', 'r9', 'a', 'r9x', 'r09', 'r100', 'b2c10', 'b2c9']
+        reads = [makeRead(name, 0, 0) for name in names]
+        self.assertEqual([r.qname for r in sorted(reads, key=sorter.nameKey)],
+                         ['a', 'b2c9', 'b2c10', 'r09', 'r9', 'r9x', 'r10',
+                          'r100'])
+        read1 = makeRead('r1', 0, 0, 0x41)
+        read2 = makeRead('r1', 0, 0, 0x81)
+        self.assertTrue(sorter.nameKey(read1) < sorter.nameKey(read2))
+
+
+    def test_coordKey(self):
+        reads = [makeRead('a', 1, 5), makeRead('b', -1, -1, 4),
+                 makeRead('c', 0, 7), makeRead('d', 0, 7, 16),
+                 makeRead('e', 0, 2)]
+        self.assertEqual([r.qname for r in sorted(reads, key=sorter.coordKey)],
+                         ['e', 'c', 'd', 'a', 'b'])
+
+
+    def test_spill(self):
+        s = sorter.Sorter(sorter.coordKey, HEADER, self.prefix, 3)
+        positions = [9, 3, 7, 3, 1, 8, 3, 2]
+        for i, pos in enumerate(positions):
+            s.write(makeRead('r%d' % i, 0, pos))
+        self.assertEqual(len(s), 8)
+        self.assertEqual(len(s.runs), 2)
+        self.assertEqual(len(s.buffer), 2)
+        # Reads with the same key stay in the order they were written.
+        self.assertEqual([(r.qname, r.pos) for r in s],
+                         [('r4', 1), ('r7', 2), ('r1', 3), ('r3', 3),
+                          ('r6', 3), ('r2', 7), ('r5', 8), ('r0', 9)])
+        runs = s.finish()
+        self.assertEqual(len(runs), 3)
+        self.assertEqual([r.qname for r in sorter.mergeRuns(runs,
+                                                             sorter.coordKey)],
+                         ['r4', 'r7', 'r1', 'r3', 'r6', 'r2', 'r5', 'r0'])
+        s.remove()
+        self.assertEqual(os.listdir(self.tmpDir), [])
+
+
+    def test_budget(self):
+        positions = [9, 3, 7, 3, 1, 8, 3, 2, 6, 5, 4, 0]
+        scratchDir = os.path.join(self.tmpDir, 'scratch')
+        os.mkdir(scratchDir)
+        # Two reads per buffer by the memory, with runs written by forked 
+        # processes, and merged in passes.
+        s = sorter.Sorter(sorter.coordKey, HEADER, self.prefix, 
+                          memory=2 * (sorter.READ_BYTES + 20) * 2, 
+                          nProcesses=2, compress=True, tmpDir=scratchDir)
+        for i, pos in enumerate(positions):
+            s.write(makeRead('r%d' % i, 0, pos))
+        self.assertEqual(len(s.runs), 6)
+        maxRuns = sorter.MAX_RUNS
+        sorter.MAX_RUNS = 2
+        try:
+            self.assertEqual([r.pos for r in s], sorted(positions))
+        finally:
+            sorter.MAX_RUNS = maxRuns
+        self.assertEqual(len(s.runs), 1)
+        self.assertEqual(os.listdir(self.tmpDir), ['scratch'])
+        s.remove()
+        self.assertEqual(os.listdir(scratchDir), [])
+
+
+    def test_sortFile(self):
+        inName = self.prefix + '.in.bam'
+        inFile = pysam.Samfile(inName, 'wb', header=HEADER)
+        for i, pos in enumerate([5, 1, 3, 1]):
+            inFile.write(makeRead('r%d' % (9 - i), 1 - i % 2, pos))
+        inFile.close()
+        names = [self.prefix + '.pos.bam', self.prefix + '.names.bam']
+        self.assertEqual(sorter.sortFile(inName, names[0], sorter.coordKey, 
+                                         bufferSize=1), 4)
+        self.assertEqual(sorter.sortFile(inName, names[1], sorter.nameKey), 
+                         4)
+        outFile = pysam.Samfile(names[0], 'rb')
+        self.assertEqual(outFile.header['HD']['SO'], 'coordinate')
+        self.assertEqual([(r.tid, r.pos) for r in outFile], 
+                         [(0, 1), (0, 1), (1, 3), (1, 5)])
+        outFile.close()
+        self.assertEqual(sorter.mergeFiles([names[1], names[1]], 
+                                           self.prefix + '.out.bam',
+                                           sorter.nameKey), 8)
+        outFile = pysam.Samfile(self.prefix + '.out.bam', 'rb')
+        self.assertEqual([r.qname for r in outFile.fetch(until_eof=True)],
+                         ['r6', 'r6', 'r7', 'r7', 'r8', 'r8', 'r9', 'r9'])
+        outFile.close()
+        self.assertEqual(len(os.listdir(self.tmpDir)), 4)
+
+
+    def test_mergeMany(self):
+        names = []
+        for i in range(7):
+            names.append(self.prefix + '.%d.bam' % i)
+            inFile = pysam.Samfile(names[-1], 'wb', header=HEADER)
+            for pos in range(i, 20, 7):
+                inFile.write(makeRead('r%d' % i, 0, pos))
+            inFile.close()
+        # Runs open at once, counted as they are read
+        opened = [0, 0]
+        iterRun = sorter.iterRun
+        def countRun(fileName):
+            opened[0] += 1
+            opened[1] = max(opened)
+            for rseq in iterRun(fileName):
+                yield rseq
+            opened[0] -= 1
+        maxRuns = sorter.MAX_RUNS
+        sorter.iterRun = countRun
+        sorter.MAX_RUNS = 3
+        try:
+            self.assertEqual(sorter.mergeFiles(names, self.prefix + '.out.bam',
+                                               sorter.coordKey), 20)
+            self.assertEqual(opened[1], 3)
+            opened[1] = 0
+            reads = sorter.mergeRuns(names + [[makeRead('x', 0, 3)]], 
+                                     sorter.coordKey, HEADER, self.prefix)
+            self.assertEqual([(r.qname, r.pos) for r in reads][3:5],
+                             [('r3', 3), ('x', 3)])
+            self.assertEqual(opened[1], 3)
+        finally:
+            sorter.iterRun = iterRun
+            sorter.MAX_RUNS = maxRuns
+        outFile = pysam.Samfile(self.prefix + '.out.bam', 'rb')
+        self.assertEqual([r.pos for r in outFile.fetch(until_eof=True)], 
+                         range(20))
+        outFile.close()
+        # The runs merged in passes are removed.
+        self.assertEqual(len(os.listdir(self.tmpDir)), 8)
+
+
+if __name__ == '__main__':
+    unittest.main()
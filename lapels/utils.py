@@ -12,7 +12,8 @@ import sys
 import argparse as ap
 from time import localtime, strftime
 
-__all__ = ['log', 'validChromList', 'readableFile', 'writableFile'] 
+__all__ = ['log', 'validChromList', 'readableFile', 'writableFile', 
+           'writableDir', 'validSize'] 
 
 
 def log(s, verbosity=2, showtime=False):     
@@ -56,5 +57,25 @@ def writableFile(fileName):
         return fileName
     else:        
         raise ap.ArgumentTypeError("Cannot write file '%s'." % fileName)
-            
-                
\ No newline at end of file
+
+
+def writableDir(dirName):
+    if os.path.isdir(dirName) and os.access(dirName, os.W_OK):
+        return dirName
+    else:        
+        raise ap.ArgumentTypeError("Cannot write directory '%s'." % dirName)
+
+
+def validSize(s):
+    '''Return the bytes of a size such as 512K, 768M or 2G.'''
+    units = {'K': 2**10, 'M': 2**20, 'G': 2**30}
+    try:
+        if s[-1].upper() in units:
+            size = int(float(s[:-1]) * units[s[-1].upper()])
+        else:
+            size = int(s)
+    except (ValueError, IndexError):
+        raise ap.ArgumentTypeError("Invalid size '%s'." % s)
+    if size <= 0:
+        raise ap.ArgumentTypeError("Invalid size '%s'." % s)
+    return size
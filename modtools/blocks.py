@@ -0,0 +1,99 @@
+'''
+The module of variant blocks.
+
+A block holds all variants at the same reference position of a chromosome,
+with its sub-segments resolved: the kind of the base at the position (match,
+substitution or deletion), the base of a substitution, and the total length
+of insertions after the position. Together they give the number of bases the
+block takes in the in silico genome.
+'''
+
+import numpy as np
+from modtools import variants
+
+__all__ = ['Blocks', 'buildBlocks', 'MATCH', 'SUB', 'DEL']
+
+MATCH = 0   # The base is unchanged.
+SUB = 1     # The base is substituted.
+DEL = 2     # The base is deleted.
+
+
+class Blocks(object):
+    '''The table of variant blocks of a chromosome.'''
+
+    def __init__(self, positions, kinds, bases, insLengths):
+        '''
+        positions: the reference positions of blocks, in increasing order.
+        kinds: the kinds of the bases at the positions.
+        bases: a string of the substituted bases, one for each block.
+        insLengths: the total lengths of insertions after the positions.
+        '''
+        self.positions = positions
+        self.kinds = kinds
+        self.bases = bases
+        self.insLengths = insLengths
+
+
+    def __len__(self):
+        return len(self.positions)
+
+
+    def getRows(self, start, end):
+        '''Return blocks in [start, end) as a list of tuples of
+        (pos, kind, base, insertion length).'''
+        return zip(self.positions[start:end].tolist(),
+                   self.kinds[start:end].tolist(),
+                   self.bases[start:end],
+                   self.insLengths[start:end].tolist())
+
+
+
+def buildBlocks(ops, positions, alleles, alleleOffsets):
+    '''
+    Build the blocks from the columns of mod data (see Mod.load()).
+    '''
+    ops = np.asarray(ops)
+    positions = np.asarray(positions, dtype=np.int64)
+    nRows = len(positions)
+    if nRows == 0:
+        return Blocks(positions, np.zeros(0, np.uint8), '', 
+                      np.zeros(0, np.int64))
+    if np.any(positions[1:] < positions[:-1]):
+        i = int(np.flatnonzero(positions[1:] < positions[:-1])[0])
+        raise ValueError("Position not in order at line %d" % (i+2))
+
+    isSub = ops == ord(variants.SUB)
+    isIns = ops == ord(variants.INS)
+    isDel = ops == ord(variants.DEL)
+    isUnknown = ~(isSub | isIns | isDel)
+    if np.any(isUnknown):
+        i = int(np.flatnonzero(isUnknown)[0])
+        raise ValueError("Unknown operation %s" % chr(ops[i]))
+
+    # The index of the block of each row.
+    isFirst = np.ones(nRows, bool)
+    isFirst[1:] = positions[1:] != positions[:-1]
+    blockIdx = np.cumsum(isFirst) - 1
+    nBlocks = int(isFirst.sum())
+
+    # The last substitution or deletion at a position decides its base, as
+    # in the in silico genome built by Mod.buildSeq().
+    kinds = np.zeros(nBlocks, np.uint8)
+    bases = np.zeros(nBlocks, 'S1')
+    bases[:] = ' '
+    baseRows = np.flatnonzero(isSub | isDel)[::-1]
+    baseBlocks, first = np.unique(blockIdx[baseRows], return_index=True)
+    baseRows = baseRows[first]
+    kinds[baseBlocks] = np.where(isDel[baseRows], DEL, SUB)
+
+    # The last base of the allele of a substitution.
+    alleleLens = np.diff(alleleOffsets)
+    isSnp = isSub[baseRows] & (alleleLens[baseRows] > 0)
+    if np.any(isSnp):
+        lastChars = np.frombuffer(alleles, 'S1')[alleleOffsets[baseRows+1]-1]
+        bases[baseBlocks[isSnp]] = lastChars[isSnp]
+
+    insLengths = np.bincount(blockIdx[isIns], weights=alleleLens[isIns], 
+                             minlength=nBlocks).astype(np.int64)
+
+    return Blocks(positions[isFirst], kinds, bases.tostring(), insLengths)
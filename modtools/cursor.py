@@ -0,0 +1,100 @@
+'''
+The module of sweep-line cursors over sorted keys.
+
+A cursor keeps a window of the keys, and of the rows they index, as python
+lists. The window slides forward as the sweep line advances, so that searches
+of nearby keys are done on short lists instead of the whole arrays. Searches
+outside the window, or after the sweep line has moved backward, fall back to
+a binary search of the arrays.
+'''
+
+import bisect
+
+__all__ = ['Cursor']
+
+WINDOW_SIZE = 4096  # Number of keys in a window
+
+
+class Cursor(object):
+    '''A sweep-line cursor over a sorted array of keys.'''
+
+    def __init__(self, keys, loader, windowSize=WINDOW_SIZE):
+        '''
+        keys: a sorted numpy array.
+        loader: a function that returns the rows in [start, end) as a list.
+        '''
+        assert windowSize > 1
+        self.keys = keys
+        self.nKeys = len(keys)
+        self.loader = loader
+        self.windowSize = windowSize
+        self.isSorted = True    # False once the sweep line moves backward.
+        self.sweepKey = None    # The key of the sweep line.
+        self.start = 0          # The index of the first key in the window.
+        self.window = []        # keys[start:start+len(window)]
+        self.rows = []          # The rows of keys in the window.
+        self.nSearches = 0
+        self.nFallbacks = 0
+
+
+    def load(self, start):
+        '''Load the window starting at the index.'''
+        end = min(start + self.windowSize, self.nKeys)
+        self.start = start
+        self.window = self.keys[start:end].tolist()
+        self.rows = self.loader(start, end)
+
+
+    def advance(self, key):
+        '''
+        Move the sweep line to the key. The window slides forward once the key
+        passes its middle. Moving backward stops the sweep, and all following
+        searches will fall back to binary search.
+        '''
+        if not self.isSorted or self.nKeys == 0:
+            return
+        if self.sweepKey is not None and key < self.sweepKey:
+            self.isSorted = False
+            self.window = []
+            self.rows = []
+            return
+        self.sweepKey = key
+        window = self.window
+        if (len(window) == 0 or
+            (key >= window[len(window)//2] and
+             self.start + len(window) < self.nKeys)):
+            # Start the window at the last key before the sweep line.
+            start = int(self.keys.searchsorted(key, 'left')) - 1
+            self.load(max(start, 0))
+
+
+    def search(self, key, side='left'):
+        '''Return the same index as numpy.searchsorted(keys, key, side).'''
+        self.nSearches += 1
+        window = self.window
+        if len(window) > 0:
+            if side == 'left':
+                i = bisect.bisect_left(window, key)
+            else:
+                i = bisect.bisect_right(window, key)
+            # The index is exact unless it hits an end of a partial window.
+            if ((i > 0 or self.start == 0) and
+                (i < len(window) or self.start + len(window) == self.nKeys)):
+                return self.start + i
+        self.nFallbacks += 1
+        return int(self.keys.searchsorted(key, side))
+
+
+    def getRow(self, i):
+        '''Return the row of the i-th key.'''
+        j = i - self.start
+        if 0 <= j < len(self.rows):
+            return self.rows[j]
+        return self.loader(i, i+1)[0]
+
+
+    def getRows(self, start, end):
+        '''Return the rows of keys in [start, end).'''
+        if start >= self.start and end <= self.start + len(self.rows):
+            return self.rows[start-self.start:end-self.start]
+        return self.loader(start, end)
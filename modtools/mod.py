@@ -7,22 +7,50 @@ Created on Sep 20, 2012
 '''
 
 import gc
+import os
+import array
 import pysam
 import gzip
 import logging
+import numpy as np
 from modtools import posmap
+from modtools import blocks
+from modtools import rankselect
 from modtools import metadata
+from modtools import modb
 
 
 VERSION = '0.1.0'
 
 __all__ = ['Mod', 'VERSION']
 
+CHUNK_SIZE = 65536  # Number of rows converted to python objects at a time
+PRELOADED = ('ops', 'positions', 'alleles', 'alleleOffsets', 'posmap', 
+             'blocks', 'variantIndex')   # Attributes kept by preload()
+
 class Mod:
     '''The class for parsing a piece of a mod file from the same chromosome.'''
     
-    def __init__(self, fileName):
+    def __init__(self, fileName, cachePosMap=False):
+        '''
+        cachePosMap: whether to save position maps next to the file, and load
+                     them from there in later runs.
+        '''
         self.logger = logging.getLogger('mod')
+        self.fileName = fileName
+        self.cachePosMap = cachePosMap
+        self.chrom = -1
+        self.preloaded = dict()     # chrom -> attributes kept by preload()
+        if modb.isModb(fileName):
+            # Columns are sliced from the memory map of a binary mod file.
+            self.modb = modb.ModbFile(fileName)
+            self.tabix = None
+            self.header = self.modb.header
+            self.chroms = self.modb.chroms
+            self.initMeta()
+            return
+        
+        self.modb = None
         fp = gzip.open(fileName, 'rb')
         self.header = dict()
         for line in fp:
@@ -49,9 +77,12 @@ class Mod:
 #                              end_col=2, meta_char='#', zerobased=True)
                         
         self.tabix = pysam.Tabixfile(fileName)
-        self.fileName = fileName
         self.chroms = self.tabix.contigs
-        self.chrom = -1
+        self.initMeta()
+        
+    
+    def initMeta(self):
+        '''Load the meta data of the reference in the header.'''
         try:
             self.meta = metadata.MetaData(self.header['reference'])
         except KeyError:
@@ -59,44 +90,140 @@ class Mod:
     
         
     def load(self, chrom):
-        '''Load data from an iterator and do conversion of integer if needed.'''                    
+        '''Load data from an iterator and do conversion of integer if needed.
+        
+        Rows are stored in columns: op codes (uint8), positions (int64), and
+        all alleles in one string with the offsets (int64) of each allele.
+        '''
+        if self.chrom != chrom and chrom in self.preloaded:
+            # Restore the data kept by preload() without reading the file.
+            self.chrom = chrom
+            self.seq = None
+            for key, value in self.preloaded[chrom].items():
+                setattr(self, key, value)
+            
         if self.chrom != chrom: # chrom not loaded                                                                                            
             self.chrom = chrom
-            # Reset posmap, seq, and data
+            # Reset posmap, blocks, variant index, seq, and data
             self.posmap = None
+            self.blocks = None
+            self.variantIndex = None
             self.seq = None                            
-            self.data = []        
+            self.ops = np.zeros(0, np.uint8)
+            self.positions = np.zeros(0, np.int64)
+            self.alleles = ''
+            self.alleleOffsets = np.zeros(1, np.int64)
             
             if chrom not in self.chroms:                    
                 self.logger.warning("chromosome '%s' not found in MOD", chrom)
                 return
+            
+            if self.modb is not None:
+                (self.ops, self.positions, self.alleles, 
+                 self.alleleOffsets) = self.modb.getColumns(chrom)
+                assert len(self) > 0 
+                self.logger.info("%d line(s) found in MOD" % len(self))
+                return
         
             gc.disable()
-            append = self.data.append            
+            ops = array.array('B')
+            positions = array.array('l')
+            alleles = array.array('c')
+            offsets = array.array('l', [0])
             for line in self.tabix.fetch(reference=chrom):
                 try:
                     cols = line.split('\t')
-                    cols[2] = int(cols[2]) # Convert positions to integers.
-                    cols[-1] = cols[-1].rstrip()
-                    append(cols)                        
+                    pos = int(cols[2])  # Convert positions to integers.
+                    op = ord(cols[0])
+                    allele = cols[-1].rstrip()
                 except:
                     print(line)
                     print(cols)
-                    raise Exception("ERROR!! at line %d" % len(self.data))
+                    raise Exception("ERROR!! at line %d" % (len(ops)+1))
+                ops.append(op)
+                positions.append(pos)
+                alleles.fromstring(allele)
+                offsets.append(len(alleles))
+            self.ops = np.frombuffer(ops, np.uint8).copy()
+            self.positions = np.frombuffer(positions, 'l').astype(np.int64)
+            self.alleles = alleles.tostring()
+            self.alleleOffsets = np.frombuffer(offsets, 'l').astype(np.int64)
             gc.enable()
             
-        assert len(self.data) > 0 
-        self.logger.info("%d line(s) found in MOD" % len(self.data))
+        assert len(self) > 0 
+        self.logger.info("%d line(s) found in MOD" % len(self))
+
+
+    def preload(self, chrom, chromLen=None, variantIndex=False):
+        '''
+        Load a chromosome with its position map and blocks, and keep them so
+        that loading the chromosome again reads nothing from the file.
+        
+        The data are numpy arrays and strings, so processes forked afterwards
+        share them copy-on-write, instead of loading their own copies.
+        '''
+        self.load(chrom)
+        self.getPosMap(chrom, chromLen)
+        self.getBlocks(chrom)
+        if variantIndex:
+            self.getVariantIndex(chrom)
+        self.preloaded[chrom] = dict((key, getattr(self, key)) 
+                                     for key in PRELOADED)
+
+
+    def iterPositions(self, chrom):
+        '''Iterate the positions of rows of a chromosome without loading it.'''
+        if chrom not in self.chroms:
+            return iter([])
+        if self.modb is not None:
+            return iter(self.modb.getPositions(chrom).tolist())
+        return (int(line.split('\t', 3)[2]) 
+                for line in self.tabix.fetch(reference=chrom))
+
+
+    def __len__(self):
+        '''The number of rows loaded.'''
+        return len(self.positions)
+
+
+    def getRows(self, start, end):
+        '''Return rows in [start, end) as a list of (op, pos, allele).'''
+        ops = self.ops[start:end].tolist()
+        positions = self.positions[start:end].tolist()
+        offsets = self.alleleOffsets[start:end+1].tolist()
+        alleles = self.alleles
+        return [(chr(ops[k]), positions[k], alleles[offsets[k]:offsets[k+1]])
+                for k in range(len(ops))]
+
+
+    def iterRows(self):
+        '''Iterate all rows as tuples of (op, pos, allele).'''
+        for start in range(0, len(self), CHUNK_SIZE):
+            for row in self.getRows(start, start+CHUNK_SIZE):
+                yield row
+
+
+    def iterGroups(self):
+        '''Iterate rows grouped by their positions.
+        Yield tuples of (line number of the first row, position, rows).
+        '''
+        group = []
+        lineNo = 1
+        for i, row in enumerate(self.iterRows()):
+            if len(group) > 0 and row[1] != group[0][1]:
+                yield (lineNo, group[0][1], group)
+                group = []
+                lineNo = i + 1
+            group.append(row)
+        if len(group) > 0:
+            yield (lineNo, group[0][1], group)
 
 
     def buildPosMap(self, chromLen):
         '''Build the position mapping instance.'''
-        assert self.data is not None        
+        assert self.positions is not None        
         gc.disable()
-        # Read rows at the same position
-        data = self.data
         chrom = self.chrom        
-        nRows = len(data)
         maps = []
 
         self.logger.info("[%s]: building position map ...", chrom)
@@ -104,67 +231,51 @@ class Mod:
         refPos = 0
         newPos = 0
         
-        if len(data) > 0:        
-            varPos = data[0][2]
-    
-            # Rows in data[startIdx:endIdx] have the same position
-            startIdx = 0
-            endIdx = 0
-            for i in range(nRows+1):
-                if i < nRows and data[i][2] == varPos:
-                    endIdx+=1
-                    continue
-    
-                if (refPos > varPos):
-                    raise ValueError("Position not in order at line %d" %(i+1))
-                
-                # Fill 'M's in the gap.
-                if refPos < varPos:       
-                    maps.append((chrom, refPos, chrom, newPos, varPos-refPos, '+'))
-                    newPos += varPos - refPos
-                    refPos = varPos
-    
-                subSegs=[(1, 'm')]
-                for j in range(startIdx,endIdx):
-                    tup = data[j]
-                    if tup[0] == 's':
-                        subSegs[0] = (1, 's', tup[3])
-                    elif tup[0] == 'i':
-                        subSegs.append((len(tup[3]), 'i', tup[3]))
-                    elif tup[0] == 'd':
-                        subSegs[0] = (1, 'd')
-                    else:
-                        raise ValueError("Unknown operation %s" % tup[0])
-    
-                for seg in subSegs:
-                    segLen = seg[0]
-                    segType = seg[1]
-                    if segType == 'm':
-                        maps.append((chrom, refPos, chrom, newPos, segLen, '+'))
-                        refPos += segLen
-                        newPos += segLen
-                    elif segType == 's':
-                        maps.append((chrom, refPos, chrom, newPos, segLen, '+'))
-                        refPos += segLen
-                        newPos += segLen
-                    elif segType == 'i':
-                        # Insertion
-                        # Set the ref position to the preceding ref position
-                        maps.append((chrom, -refPos+1, chrom, newPos, segLen, '+'))
-                        newPos += segLen
-                    elif segType == 'd':
-                        # Deletion
-                        # Set the new position to the preceding new position
-                        maps.append((chrom, refPos, chrom, -newPos+1, segLen, '+'))
-                        refPos += segLen
-                    else:
-                        raise ValueError("Unknown operation %s" % segType)
-    
-                startIdx = endIdx
-                endIdx += 1
-    
-                if i<len(data):
-                    varPos = data[i][2]
+        # Rows in a group have the same position
+        for lineNo, varPos, group in self.iterGroups():
+            if (refPos > varPos):
+                raise ValueError("Position not in order at line %d" % lineNo)
+            
+            # Fill 'M's in the gap.
+            if refPos < varPos:       
+                maps.append((refPos, newPos, varPos-refPos))
+                newPos += varPos - refPos
+                refPos = varPos
+
+            subSegs=[(1, 'm')]
+            for tup in group:
+                if tup[0] == 's':
+                    subSegs[0] = (1, 's', tup[2])
+                elif tup[0] == 'i':
+                    subSegs.append((len(tup[2]), 'i', tup[2]))
+                elif tup[0] == 'd':
+                    subSegs[0] = (1, 'd')
+                else:
+                    raise ValueError("Unknown operation %s" % tup[0])
+
+            for seg in subSegs:
+                segLen = seg[0]
+                segType = seg[1]
+                if segType == 'm':
+                    maps.append((refPos, newPos, segLen))
+                    refPos += segLen
+                    newPos += segLen
+                elif segType == 's':
+                    maps.append((refPos, newPos, segLen))
+                    refPos += segLen
+                    newPos += segLen
+                elif segType == 'i':
+                    # Insertion
+                    # Set the ref position to the preceding ref position
+                    maps.append((-refPos+1, newPos, segLen))
+                    newPos += segLen
+                elif segType == 'd':
+                    # Deletion
+                    # Set the new position to the preceding new position
+                    maps.append((refPos, -newPos+1, segLen))
+                    refPos += segLen
+                else:
+                    raise ValueError("Unknown operation %s" % segType)
 
 #        assert refPos <= refLens[chrom]
         if refPos > chromLen:
@@ -172,7 +283,7 @@ class Mod:
                              % refPos)
 
         if refPos < chromLen:
-            maps.append((chrom, refPos, chrom, newPos, chromLen-refPos, '+'))
+            maps.append((refPos, newPos, chromLen-refPos))
  
         assert len(maps) > 0
 
@@ -180,22 +291,63 @@ class Mod:
         compressed = []
         buf = maps[0]
         for r in maps[1:]:            
-            if (buf[0] == r[0] and buf[2] == r[2] and buf[5] == r[5] and 
-                ((buf[1] >= 0 and r[1] >= 0 and buf[3] >= 0 and r[3] >= 0 and 
-                  (buf[1]-buf[3]) == (r[1]-r[3])) or 
-                 (buf[3] < 0 and buf[3] == r[3]))):
-                buf=(buf[0],buf[1],buf[2],buf[3],buf[4]+r[4],buf[5])
+            if ((buf[0] >= 0 and r[0] >= 0 and buf[1] >= 0 and r[1] >= 0 and 
+                 (buf[0]-buf[1]) == (r[0]-r[1])) or 
+                (buf[1] < 0 and buf[1] == r[1])):
+                buf=(buf[0],buf[1],buf[2]+r[2])
             else:
                 compressed.append(buf)
                 buf = r
         compressed.append(buf)
 
+        refStarts, newStarts, lengths = zip(*compressed)
         self.posmap = posmap.PosMap()
-        self.posmap.load(compressed, isConverted=True)
+        self.posmap.loadChrom(chrom, refStarts, newStarts, lengths, 
+                              [0] * len(compressed))
 
         gc.enable()      
 
 
+    def getPosMapCacheName(self, chrom):
+        '''Return the file name of the saved position map of a chromosome.'''
+        return "%s.%s.posmap" % (self.fileName, chrom)
+
+
+    def getPosMapKey(self, chrom, chromLen):
+        '''
+        Return the key of the position map of a chromosome, by the chromosome
+        length, and the size and the modification time of the mod file.
+        '''
+        st = os.stat(self.fileName)
+        return "%s\t%d\t%d\t%r" % (chrom, chromLen, st.st_size, st.st_mtime)
+
+
+    def loadPosMap(self, chromLen):
+        '''Load the saved position map. Return True if it is valid.'''
+        fileName = self.getPosMapCacheName(self.chrom)
+        cmap = posmap.readChromMap(fileName, self.chrom, 
+                                   self.getPosMapKey(self.chrom, chromLen))
+        if cmap is None:
+            return False
+        self.logger.info("[%s]: position map loaded from %s", self.chrom, 
+                         fileName)
+        self.posmap = posmap.PosMap()
+        self.posmap.addChromMap(cmap)
+        return True
+
+
+    def savePosMap(self, chromLen):
+        '''Save the position map, or only warn if it cannot be saved.'''
+        fileName = self.getPosMapCacheName(self.chrom)
+        try:
+            posmap.writeChromMap(fileName, 
+                                 self.posmap.getChromMap(self.chrom), 
+                                 self.getPosMapKey(self.chrom, chromLen))
+        except (IOError, OSError) as e:
+            self.logger.warning("cannot save position map %s (%s)", fileName, 
+                                e)
+
+
     def getPosMap(self, chrom, chromLen = None):
         '''Return a PosMap instance of the current mod instance.'''        
         if self.chrom != chrom:
@@ -205,17 +357,41 @@ class Mod:
             chromLen = self.meta.getChromLength(chrom)
             
         if self.posmap is None:
-            self.buildPosMap(chromLen)
+            if not (self.cachePosMap and self.loadPosMap(chromLen)):
+                self.buildPosMap(chromLen)
+                if self.cachePosMap:
+                    self.savePosMap(chromLen)
         assert self.posmap is not None
         return self.posmap
 
 
+    def getBlocks(self, chrom):
+        '''Return the variant blocks of the chromosome.'''
+        if self.chrom != chrom:
+            self.load(chrom)
+
+        if self.blocks is None:
+            self.logger.info("[%s]: building variant blocks ...", chrom)
+            self.blocks = blocks.buildBlocks(self.ops, self.positions, 
+                                             self.alleles, self.alleleOffsets)
+        return self.blocks
+
+
+    def getVariantIndex(self, chrom):
+        '''Return the rank/select bit vector of variant positions.'''
+        if self.chrom != chrom:
+            self.load(chrom)
+
+        if self.variantIndex is None:
+            self.variantIndex = rankselect.RankSelect(
+                                    self.getBlocks(chrom).positions)
+        return self.variantIndex
+
+
     def buildSeq(self, fasta, chrom, fastaChroms):
         '''Build the sequence based on the mod data and reference sequences.'''
         assert chrom == self.chrom
-        
-        data = self.data        
-        assert data is not None
+        assert self.positions is not None
         
         self.logger.info("[%s]: building sequence ...", chrom)
         
@@ -228,32 +404,24 @@ class Mod:
                              ','.join(sorted(fastaChroms)))
         
         # If no content in MOD for this chromosome
-        if len(data) == 0:
+        if len(self) == 0:
             self.seq = fasta.fetch(reference=fastaChrom, start=0) 
             return 
         
         gc.disable()        
         
         chromLen = meta.getChromLength(chrom)       
-        nRows = len(data)
         seqs = []
 
         # Current position in reference/new genome coordinate
         refPos = 0
         newPos = 0
-        varPos = data[0][2]
-
-        # Rows in data[startIdx:endIdx] have the same position
-        startIdx = 0
-        endIdx = 0
-        for i in range(nRows+1):
-            if i < nRows and data[i][2] == varPos:
-                endIdx+=1
-                continue
 
+        # Rows in a group have the same position
+        for lineNo, varPos, group in self.iterGroups():
             #assert refPos <= varPos
             if (refPos > varPos):
-                raise ValueError("Position not in order at line %d" %(i+1))
+                raise ValueError("Position not in order at line %d" % lineNo)
 
             # Fill 'M's in the gap.
             if refPos < varPos:                
@@ -263,12 +431,11 @@ class Mod:
                 refPos = varPos                
 
             subSegs=[(1, 'm')]
-            for j in range(startIdx,endIdx):
-                tup = data[j]
+            for tup in group:
                 if tup[0] == 's':
-                    subSegs[0] = (1, 's', tup[3])
+                    subSegs[0] = (1, 's', tup[2])
                 elif tup[0] == 'i':
-                    subSegs.append((len(tup[3]), 'i', tup[3]))
+                    subSegs.append((len(tup[2]), 'i', tup[2]))
                 elif tup[0] == 'd':
                     subSegs[0] = (1, 'd')
                 else:
@@ -294,12 +461,6 @@ class Mod:
                 else:
                     raise ValueError("Unknown operation %s" % segType)
 
-            startIdx = endIdx
-            endIdx += 1
-
-            if i<len(data):
-                varPos = data[i][2]
-
         #assert refPos <= refLens[chrom]
         if refPos > chromLen:
             raise ValueError("Variant position out of reference boundary")
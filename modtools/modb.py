@@ -0,0 +1,230 @@
+'''
+The module of the binary mod format (.modb).
+
+A modb file stores the rows of each chromosome in the columns used by Mod, so
+that a chromosome is loaded by slicing a memory map of the file, without
+parsing any text. All integers are little-endian.
+
+    magic       'MODB'
+    version     uint32
+    headerLen   uint64, the length of the header
+    nChroms     uint64
+    header      the meta lines of the text mod file, e.g. '#reference=mm9\n'
+    directory   for each chromosome: nameLen (uint32), name, nRows (uint64),
+                and the offsets of the op, position, allele offset and allele
+                columns (uint64 each)
+    columns     for each chromosome: ops (uint8 * nRows), positions
+                (int64 * nRows), allele offsets (int64 * (nRows+1)), and the
+                allele heap (alleleOffsets[-1] bytes), each aligned to 8 bytes
+'''
+
+import gzip
+import mmap
+import array
+import struct
+import numpy as np
+
+__all__ = ['ModbFile', 'isModb', 'writeModb', 'textToModb', 'modbToText']
+
+MAGIC = 'MODB'
+FORMAT_VERSION = 1
+PREFIX = struct.Struct('<4sIQQ')    # Magic, version, headerLen, nChroms
+ENTRY = struct.Struct('<QQQQQ')     # nRows and offsets of four columns
+ALIGNMENT = 8
+
+
+def isModb(fileName):
+    '''Return True if the file is a modb file.'''
+    fp = open(fileName, 'rb')
+    magic = fp.read(len(MAGIC))
+    fp.close()
+    return magic == MAGIC
+
+
+def align(offset):
+    '''Return the offset rounded up to the alignment.'''
+    return (offset + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+
+def parseHeader(text):
+    '''Return a dict of the meta lines of a mod file.'''
+    header = dict()
+    for line in text.splitlines():
+        line = line.strip()
+        if line.startswith('#'):
+            tup = line[1:].split('=')
+            assert len(tup) == 2
+            header[tup[0]] = tup[1]
+    return header
+
+
+
+class ModbFile:
+    '''The class for reading a modb file through a memory map.'''
+
+    def __init__(self, fileName):
+        self.fileName = fileName
+        fp = open(fileName, 'rb')
+        try:
+            self.data = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+        finally:
+            fp.close()
+        if len(self.data) < PREFIX.size:
+            raise ValueError("'%s' is not a modb file." % fileName)
+        magic, version, headerLen, nChroms = PREFIX.unpack_from(self.data)
+        if magic != MAGIC:
+            raise ValueError("'%s' is not a modb file." % fileName)
+        if version != FORMAT_VERSION:
+            raise ValueError("'%s' has an unsupported version %d."
+                             % (fileName, version))
+        offset = PREFIX.size
+        self.headerText = self.data[offset:offset+headerLen]
+        self.header = parseHeader(self.headerText)
+        offset += headerLen
+        self.chroms = []
+        self.entries = dict()   # chrom -> (nRows, offsets of columns)
+        for i in range(nChroms):
+            nameLen = struct.unpack_from('<I', self.data, offset)[0]
+            offset += 4
+            chrom = self.data[offset:offset+nameLen]
+            offset += nameLen
+            entry = ENTRY.unpack_from(self.data, offset)
+            offset += ENTRY.size
+            self.chroms.append(chrom)
+            self.entries[chrom] = entry
+
+
+    def getColumns(self, chrom):
+        '''
+        Return the ops (uint8), positions (int64), alleles (a string) and
+        allele offsets (int64) of a chromosome. The arrays are read-only views
+        of the file.
+        '''
+        nRows, opStart, posStart, offStart, alleleStart = self.entries[chrom]
+        ops = np.frombuffer(self.data, np.uint8, nRows, opStart)
+        positions = np.frombuffer(self.data, '<i8', nRows, posStart)
+        alleleOffsets = np.frombuffer(self.data, '<i8', nRows+1, offStart)
+        alleles = self.data[alleleStart:alleleStart+int(alleleOffsets[-1])]
+        return ops, positions, alleles, alleleOffsets
+
+
+    def getPositions(self, chrom):
+        '''Return the positions of rows of a chromosome, without the others.'''
+        nRows, opStart, posStart = self.entries[chrom][:3]
+        return np.frombuffer(self.data, '<i8', nRows, posStart)
+
+
+    def getRowCounts(self):
+        '''Return a dict of the numbers of rows of chromosomes.'''
+        return dict((chrom, int(self.entries[chrom][0]))
+                    for chrom in self.chroms)
+
+
+    def close(self):
+        self.data.close()
+
+
+
+def writeModb(fileName, headerText, columns):
+    '''
+    Write a modb file.
+    headerText: the meta lines of the text mod file.
+    columns: a list of tuples of (chrom, ops, positions, alleles,
+             alleleOffsets) as in getColumns().
+    '''
+    directorySize = sum(4 + len(col[0]) + ENTRY.size for col in columns)
+    offset = align(PREFIX.size + len(headerText) + directorySize)
+    entries = []
+    for chrom, ops, positions, alleles, alleleOffsets in columns:
+        nRows = len(ops)
+        assert len(positions) == nRows and len(alleleOffsets) == nRows + 1
+        assert alleleOffsets[-1] == len(alleles)
+        opStart = offset
+        posStart = align(opStart + nRows)
+        offStart = posStart + 8 * nRows
+        alleleStart = offStart + 8 * (nRows+1)
+        offset = align(alleleStart + len(alleles))
+        entries.append((nRows, opStart, posStart, offStart, alleleStart))
+
+    fp = open(fileName, 'wb')
+    fp.write(PREFIX.pack(MAGIC, FORMAT_VERSION, len(headerText),
+                         len(columns)))
+    fp.write(headerText)
+    for col, entry in zip(columns, entries):
+        fp.write(struct.pack('<I', len(col[0])))
+        fp.write(col[0])
+        fp.write(ENTRY.pack(*entry))
+    for col, entry in zip(columns, entries):
+        chrom, ops, positions, alleles, alleleOffsets = col
+        for start, data in zip(entry[1:],
+                               (np.asarray(ops, np.uint8).tostring(),
+                                np.asarray(positions, '<i8').tostring(),
+                                np.asarray(alleleOffsets, '<i8').tostring(),
+                                alleles)):
+            fp.write('\0' * (start - fp.tell()))
+            fp.write(data)
+    fp.write('\0' * (align(fp.tell()) - fp.tell()))
+    fp.close()
+
+
+def textToModb(modFile, modbFile):
+    '''
+    Convert a text mod file to a modb file. Chromosomes are in the order they
+    first appear in the mod file. Return the number of rows.
+    '''
+    fp = gzip.open(modFile, 'rb')
+    headerLines = []
+    data = dict()   # chrom -> (ops, positions, alleles, offsets)
+    chroms = []
+    nRows = 0
+    for line in fp:
+        if line.startswith('#'):
+            headerLines.append(line)
+            continue
+        if len(line.strip()) == 0:
+            continue
+        cols = line.split('\t')
+        if len(cols) != 4:
+            raise ValueError("ERROR!! at line %d: %s"
+                             % (len(headerLines)+nRows+1, line.rstrip()))
+        chrom = cols[1]
+        if chrom not in data:
+            chroms.append(chrom)
+            data[chrom] = (array.array('B'), array.array('l'),
+                           array.array('c'), array.array('l', [0]))
+        ops, positions, alleles, offsets = data[chrom]
+        ops.append(ord(cols[0]))
+        positions.append(int(cols[2]))
+        alleles.fromstring(cols[3].rstrip())
+        offsets.append(len(alleles))
+        nRows += 1
+    fp.close()
+
+    columns = []
+    for chrom in chroms:
+        ops, positions, alleles, offsets = data.pop(chrom)
+        columns.append((chrom, np.frombuffer(ops, np.uint8),
+                        np.frombuffer(positions, 'l').astype(np.int64),
+                        alleles.tostring(),
+                        np.frombuffer(offsets, 'l').astype(np.int64)))
+    writeModb(modbFile, ''.join(headerLines), columns)
+    return nRows
+
+
+def modbToText(modbFile, modFile):
+    '''Convert a modb file to a text mod file. Return the number of rows.'''
+    modb = ModbFile(modbFile)
+    fp = gzip.open(modFile, 'wb')
+    fp.write(modb.headerText)
+    nRows = 0
+    for chrom in modb.chroms:
+        ops, positions, alleles, alleleOffsets = modb.getColumns(chrom)
+        offsets = alleleOffsets.tolist()
+        for i, (op, pos) in enumerate(zip(ops.tostring(),
+                                          positions.tolist())):
+            fp.write('%s\t%s\t%d\t%s\n'
+                     % (op, chrom, pos, alleles[offsets[i]:offsets[i+1]]))
+        nRows += len(ops)
+    fp.close()
+    modb.close()
+    return nRows
@@ -1,117 +1,406 @@
 '''
-The module of position mapping. 
+The module of position mapping.
+
+The segments of a position map are stored per chromosome in parallel int64
+arrays of reference starts, new (in silico) starts, lengths and kinds. Positions
+are looked up with numpy.searchsorted, either one at a time (fmap/bmap) or as
+whole arrays (fmapMany/bmapMany).
+
+The segments of a chromosome can be saved with their sort orders to a file,
+which is read back through a memory map without sorting anything.
 
 Created on Sep 20, 2012
 
 @author: Shunping Huang
 '''
 
-import bisect
 import gc
+import os
+import mmap
+import struct
+import tempfile
+import numpy as np
+from modtools.cursor import Cursor
+
+__all__ = ['PosMap', 'ChromMap', 'writeChromMap', 'readChromMap']
+
+DIRECTIONS = '+-'   # Kinds of segments: 0 for regular, 1 for inverted
+
+MAGIC = 'PMAP'
+FORMAT_VERSION = 1
+PREFIX = struct.Struct('<4sIQQ')    # Magic, version, keyLen, nSegments
+COLUMNS = ('refStarts', 'newStarts', 'lengths', 'kinds', 'order', 'border',
+           'bkeys')                 # Arrays saved in a file, in order
+
+
+class ChromMap(object):
+    '''The segments of a position map on one chromosome.'''
+
+    def __init__(self, chrom, refStarts, newStarts, lengths, kinds):
+        '''Initialize the segments from arrays in their loading order.
+        A negative start is the inverse of the newest preceding position of an
+        insertion (refStarts) or a deletion (newStarts).
+        '''
+        self.chrom = chrom
+        refStarts = np.asarray(refStarts, dtype=np.int64)
+
+        # Keep the segments sorted by reference positions, and the order to
+        # restore the loading order.
+        self.order = np.argsort(refStarts, kind='mergesort')
+        self.refStarts = refStarts[self.order]
+        self.newStarts = np.asarray(newStarts, dtype=np.int64)[self.order]
+        self.lengths = np.asarray(lengths, dtype=np.int64)[self.order]
+        self.kinds = np.asarray(kinds, dtype=np.int64)[self.order]
+        self.build()
+
+
+    @classmethod
+    def fromArrays(cls, chrom, arrays):
+        '''
+        Initialize the segments from sorted arrays and their orders, as saved
+        by writeChromMap(), without sorting them again.
+        arrays: a dict of arrays by names in COLUMNS.
+        '''
+        cmap = cls.__new__(cls)
+        cmap.chrom = chrom
+        for name in COLUMNS:
+            setattr(cmap, name, arrays[name])
+        return cmap
+
+
+    def __len__(self):
+        return len(self.refStarts)
+
+
+    def build(self):
+        '''Build the index of segments sorted by in silico positions.'''
+        self.border = np.argsort(self.newStarts, kind='mergesort')
+        self.bkeys = self.newStarts[self.border]
+
+
+    def fmap(self, pos, cursor=None):
+        '''Mapping a position from reference to in silico genome.
+        cursor: None, or a cursor from getFCursor() for sorted positions.
+        '''
+        if cursor is None:
+            refStarts = self.refStarts
+            i = int(refStarts.searchsorted(pos, 'right')) - 1
+            if i >= 0:
+                refpos = int(refStarts[i])
+                newpos = int(self.newStarts[i])
+                length = int(self.lengths[i])
+                kind = self.kinds[i]
+        else:
+            i = cursor.search(pos, 'right') - 1
+            if i >= 0:
+                refpos, newpos, length, kind = cursor.getRow(i)
+        if i < 0 or refpos < 0:
+            raise ValueError("Error: Reference position %d underflows." % pos)
+        if pos >= refpos + length:
+            raise ValueError("Error: Reference position %d overflows." % pos)
+        ## Deletion, return the inverse of newest preceding position.
+        if newpos < 0:
+            return newpos
+        if kind == 0:  ## Regular region
+            return pos + newpos - refpos
+        else:          ## Inverted region
+            return newpos + refpos + length - 1 - pos
+
+
+    def bmap(self, pos, cursor=None):
+        '''Mapping a position from in silico genome to reference
+        cursor: None, or a cursor from getBCursor() for sorted positions.
+        '''
+        if cursor is None:
+            bkeys = self.bkeys
+            i = int(bkeys.searchsorted(pos, 'right')) - 1
+            if i >= 0:
+                j = self.border[i]
+                newpos = int(bkeys[i])
+                refpos = int(self.refStarts[j])
+                length = int(self.lengths[j])
+                kind = self.kinds[j]
+        else:
+            i = cursor.search(pos, 'right') - 1
+            if i >= 0:
+                newpos, refpos, length, kind = cursor.getRow(i)
+        if i < 0 or newpos < 0:
+            raise ValueError("Error: In silico position %d underflows." % pos)
+        if pos >= newpos + length:
+            raise ValueError("Error: In silico position %d overflows." % pos)
+        ## Insertion, return the inverse of newest preceding position.
+        if refpos < 0:
+            return refpos
+        if kind == 0:  ## Regular region
+            return pos + refpos - newpos
+        else:          ## Inverted region
+            return refpos + newpos + length - 1 - pos
+
+
+    def getFSegments(self, start, end):
+        '''Return segments [start, end) sorted by reference positions as
+        tuples of (ref start, new start, length, kind).'''
+        return zip(self.refStarts[start:end].tolist(),
+                   self.newStarts[start:end].tolist(),
+                   self.lengths[start:end].tolist(),
+                   self.kinds[start:end].tolist())
+
+
+    def getBSegments(self, start, end):
+        '''Return segments [start, end) sorted by in silico positions as
+        tuples of (new start, ref start, length, kind).'''
+        order = self.border[start:end]
+        return zip(self.bkeys[start:end].tolist(),
+                   self.refStarts[order].tolist(),
+                   self.lengths[order].tolist(),
+                   self.kinds[order].tolist())
+
+
+    def getFCursor(self):
+        '''Return a sweep-line cursor for fmap().'''
+        return Cursor(self.refStarts, self.getFSegments)
+
+
+    def getBCursor(self):
+        '''Return a sweep-line cursor for bmap().'''
+        return Cursor(self.bkeys, self.getBSegments)
+
+
+    def mapMany(self, positions, keys, order, others):
+        '''Vectorized mapping of positions by the sorted keys.
+        order: None, or the indexes of the sorted keys in the segment arrays.
+        Return a tuple of (mapped positions, valid flags). Positions flagged
+        invalid are those for which fmap/bmap would raise an error.
+        '''
+        pos = np.asarray(positions, dtype=np.int64)
+        i = np.searchsorted(keys, pos, 'right') - 1
+        valid = (i >= 0) & (pos >= 0)
+        i[~valid] = 0
+        j = i if order is None else order[i]
+        start = keys[i]
+        other = others[j]
+        length = self.lengths[j]
+        valid &= (start >= 0) & (pos < start + length)
+
+        ## Regular region, inverted region, or the inverse of the newest
+        ## preceding position for an insertion/deletion.
+        ret = np.where(self.kinds[j] == 0, pos + other - start,
+                       other + start + length - 1 - pos)
+        ret = np.where(other < 0, other, ret)
+        return ret, valid
+
+
+    def fmapMany(self, positions):
+        '''Map an array of positions from reference to in silico genome.'''
+        return self.mapMany(positions, self.refStarts, None, self.newStarts)
 
-__all__ = ['PosMap']
 
-class PosMap:
+    def bmapMany(self, positions):
+        '''Map an array of positions from in silico genome to reference.'''
+        return self.mapMany(positions, self.bkeys, self.border, self.refStarts)
+
+
+    def rows(self):
+        '''Return the segments as tuples in their loading order.'''
+        rows = [None] * len(self)
+        chrom = self.chrom
+        for i, j in enumerate(self.order.tolist()):
+            rows[j] = ((chrom, int(self.refStarts[i])),
+                       (chrom, int(self.newStarts[i])),
+                       int(self.lengths[i]), DIRECTIONS[self.kinds[i]])
+        return rows
+
+
+
+def writeChromMap(fileName, cmap, key):
+    '''
+    Save the segments of a chromosome to a file with a key, which is checked
+    when the file is read. The file is written under a temporary name and
+    renamed at the end, so that a partial file is never read.
+    '''
+    dirName = os.path.dirname(os.path.abspath(fileName))
+    fd, tmpName = tempfile.mkstemp('.tmp', '.posmap.', dirName)
+    try:
+        with os.fdopen(fd, 'wb') as fp:
+            fp.write(PREFIX.pack(MAGIC, FORMAT_VERSION, len(key), len(cmap)))
+            fp.write(key)
+            fp.write('\0' * (-fp.tell() % 8))   # Align arrays to 8 bytes
+            for name in COLUMNS:
+                fp.write(np.asarray(getattr(cmap, name), '<i8').tostring())
+        # mkstemp() creates the file readable by the owner only.
+        umask = os.umask(0)
+        os.umask(umask)
+        os.chmod(tmpName, 0666 & ~umask)
+        os.rename(tmpName, fileName)
+    finally:
+        if os.path.exists(tmpName):
+            os.remove(tmpName)
+
+
+def readChromMap(fileName, chrom, key):
+    '''
+    Return the segments of a chromosome saved in a file, as read-only views of
+    a memory map of the file. Return None if the file is not found, or its key
+    does not match.
+    '''
+    try:
+        fp = open(fileName, 'rb')
+    except IOError:
+        return None
+    try:
+        data = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+    except (ValueError, mmap.error):   # An empty file cannot be mapped.
+        return None
+    finally:
+        fp.close()
+    if len(data) < PREFIX.size:
+        return None
+    magic, version, keyLen, nSegments = PREFIX.unpack_from(data)
+    offset = PREFIX.size
+    if (magic != MAGIC or version != FORMAT_VERSION or 
+        data[offset:offset+keyLen] != key):
+        return None
+    offset += keyLen
+    offset += -offset % 8
+    if len(data) != offset + 8 * nSegments * len(COLUMNS):
+        return None
+    arrays = dict()
+    for name in COLUMNS:
+        arrays[name] = np.frombuffer(data, '<i8', nSegments, offset)
+        offset += 8 * nSegments
+    return ChromMap.fromArrays(chrom, arrays)
+
+
+
+class PosMap(object):
     def __init__(self, dataIter=None):
         '''Initialize a position map.
         dataIter: an iterator of tuples extracted from a mod file. Each tuple
-            should have 4 fields.
+            should have 6 fields.
         '''
-            
-        self.fvals = None  #forward mapping
-        self.bvals = None  #backward mapping        
-        self.fkeys = []
-        self.bkeys = []        
-        self.data = None
+        self.chroms = dict()    # chrom -> ChromMap
+        self.chromOrder = []
         if dataIter is not None:
-            self.loadData(dataIter)  
-        
-    
+            self.load(dataIter)
+
+
     def load(self, dataIter, isConverted=False):
         assert dataIter is not None
-        gc.disable()                
-        self.data = []
-        append = self.data.append
-        if isConverted:
-            for row in dataIter:
-                append(((row[0], row[1]), (row[2], row[3]), row[4], row[5]))
-        else:
-            for row in dataIter:
-                append(((row[0], int(row[1])), (row[2], int(row[3])), int(row[4]), row[5]))
-        self.build()
+        gc.disable()
+        columns = dict()
+        for row in dataIter:
+            chrom = row[0]
+            if row[2] != chrom:
+                raise NotImplementedError("mapping between chromosomes '%s' and"
+                                          " '%s' not supported."
+                                          % (chrom, row[2]))
+            if chrom not in columns:
+                columns[chrom] = ([], [], [], [])
+                self.chromOrder.append(chrom)
+            refStarts, newStarts, lengths, kinds = columns[chrom]
+            if isConverted:
+                refStarts.append(row[1])
+                newStarts.append(row[3])
+                lengths.append(row[4])
+            else:
+                refStarts.append(int(row[1]))
+                newStarts.append(int(row[3]))
+                lengths.append(int(row[4]))
+            kinds.append(DIRECTIONS.index(row[5][0]))
+        for chrom, cols in columns.items():
+            self.chroms[chrom] = ChromMap(chrom, *cols)
         gc.enable()
 
 
-    def build(self):                
-        data = self.data
-        self.fvals = sorted(data, key=lambda tup: tup[0])
-        self.fkeys = [tup[0] for tup in self.fvals]
-        self.bvals = sorted(data, key=lambda tup: tup[1])
-        self.bkeys = [tup[1] for tup in self.bvals]        
-    
-    
-    ##FIX ME!!!! Overlapping regions make the index from bisect not correct. 
+    def loadChrom(self, chrom, refStarts, newStarts, lengths, kinds):
+        '''Load the segments of a chromosome from arrays.'''
+        self.addChromMap(ChromMap(chrom, refStarts, newStarts, lengths, kinds))
+
+
+    def addChromMap(self, cmap):
+        '''Add the segments of a chromosome.'''
+        if cmap.chrom not in self.chroms:
+            self.chromOrder.append(cmap.chrom)
+        self.chroms[cmap.chrom] = cmap
+
+
+    def build(self):
+        for cmap in self.chroms.values():
+            cmap.build()
+
+
+    @property
+    def data(self):
+        '''The segments as tuples of ((chrom, pos), (chrom, pos), len, dir).'''
+        rows = []
+        for chrom in self.chromOrder:
+            rows.extend(self.chroms[chrom].rows())
+        return rows
+
+
+    @property
+    def fkeys(self):
+        '''The sorted (chrom, pos) keys for the forward mapping.'''
+        return [(chrom, pos) for chrom in sorted(self.chroms.keys())
+                for pos in self.chroms[chrom].refStarts.tolist()]
+
+
+    @property
+    def bkeys(self):
+        '''The sorted (chrom, pos) keys for the backward mapping.'''
+        return [(chrom, pos) for chrom in sorted(self.chroms.keys())
+                for pos in self.chroms[chrom].bkeys.tolist()]
+
+
+    def getChromMap(self, chrom):
+        '''Return the segments of a chromosome, or None if not found.'''
+        return self.chroms.get(chrom)
+
+
+    ##FIX ME!!!! Overlapping regions make the index from searchsorted not correct.
     def fmap(self, pos):
         '''Mapping a position from reference to in silico genome.'''
-        assert self.fkeys is not None
-        assert pos[1] >= 0            
-        i = bisect.bisect_right(self.fkeys, pos) - 1
-        if i < 0 or self.fvals[i][0][1] < 0:
-            raise ValueError("Error: Reference position %d underflows." % pos[1])                   
-        #print(self.fvals[i])
-        refpos = self.fvals[i][0]
-        newpos = self.fvals[i][1]        
-        length = self.fvals[i][2]
-        direction = self.fvals[i][3][0]      
-        if pos[0] == refpos[0]:
-            if pos[1] >= refpos[1] and pos[1] < refpos[1] + length:
-                ## May need to consider direction!!!
-                ## Deletion, return the inverse of newest preceding position.                                    
-                if newpos[1] < 0:       
-                    return newpos
-                                        
-                if direction == '+':    ## Regular region
-                    d = newpos[1] - refpos[1]         
-                    return (newpos[0], pos[1] + d)                                    
-                else:                   ## Inverted region
-                    s = newpos[1] + refpos[1] + length - 1                
-                    return (newpos[0], s - pos[1])                    
-            else:
-                raise ValueError("Error: Reference position %d overflows." % pos[1])
-        else:
+        assert pos[1] >= 0
+        try:
+            cmap = self.chroms[pos[0]]
+        except KeyError:
             raise ValueError("Error: Reference chromosome %s not found." % pos[0])
-    
-    
-    ##FIX ME!!!! Overlapping regions make the index from bisect not correct.
+        return (pos[0], cmap.fmap(pos[1]))
+
+
+    ##FIX ME!!!! Overlapping regions make the index from searchsorted not correct.
     def bmap(self, pos):
         '''Mapping a position from in silico genome to reference'''
-        assert self.fkeys is not None
-        assert pos[1] >= 0        
-        i=bisect.bisect_right(self.bkeys, pos)-1
-        if i < 0 or self.bvals[i][1][1] < 0:
-            raise ValueError("Error: In silico position %d underflows." % pos[1])                            
-        #print(self.bvals[i])
-        refpos = self.bvals[i][0]
-        newpos = self.bvals[i][1]
-        length = self.bvals[i][2]
-        direction = self.bvals[i][3][0]
-        if pos[0] == newpos[0]:
-            if pos[1] >= newpos[1] and pos[1] < newpos[1] + length:
-                ## May need to consider direction!!!
-                ## Insertion, return the inverse of newest preceding position.
-                if refpos[1] < 0:                 
-                    return refpos
-                
-                if direction == '+':    #regular direction
-                    d = refpos[1] - newpos[1]                
-                    return (refpos[0], pos[1] + d)                                
-                else:                   #reversed direction
-                    s = refpos[1] + newpos[1] + length - 1                
-                    return (refpos[0], s - pos[1])
-            else:
-                raise ValueError("Error: In silico position %d overflows." % pos[1])                
-        else:            
+        assert pos[1] >= 0
+        try:
+            cmap = self.chroms[pos[0]]
+        except KeyError:
             raise ValueError("Error: In silico chromosome not found.")
+        return (pos[0], cmap.bmap(pos[1]))
+
+
+    def fmapMany(self, chrom, positions):
+        '''Map an array of positions from reference to in silico genome.
+        Return a tuple of (mapped positions, valid flags).
+        '''
+        try:
+            cmap = self.chroms[chrom]
+        except KeyError:
+            return (np.zeros(len(positions), np.int64),
+                    np.zeros(len(positions), bool))
+        return cmap.fmapMany(positions)
+
+
+    def bmapMany(self, chrom, positions):
+        '''Map an array of positions from in silico genome to reference.
+        Return a tuple of (mapped positions, valid flags).
+        '''
+        try:
+            cmap = self.chroms[chrom]
+        except KeyError:
+            return (np.zeros(len(positions), np.int64),
+                    np.zeros(len(positions), bool))
+        return cmap.bmapMany(positions)
 
 
     def toCSV(self):
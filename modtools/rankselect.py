@@ -0,0 +1,88 @@
+'''
+The module of rank/select bit vectors.
+
+A bit vector marks positions of a chromosome, such as the positions having
+variants. The bits are packed in 64-bit words, with the number of bits set
+before each word, so that counting the bits set in a range takes constant
+time.
+'''
+
+import numpy as np
+
+__all__ = ['RankSelect']
+
+WORD_BITS = 64
+
+
+def popcount(word):
+    '''Return the number of bits set in an integer.'''
+    return bin(word).count('1')
+
+
+class RankSelect(object):
+    '''A bit vector supporting rank and select queries.'''
+
+    def __init__(self, positions, length=None):
+        '''
+        positions: the positions of bits set.
+        length: the number of bits (default: the last position plus one).
+        '''
+        positions = np.unique(np.asarray(positions, dtype=np.int64))
+        if len(positions) > 0 and positions[0] < 0:
+            raise ValueError("Position %d underflows." % positions[0])
+        if length is None:
+            length = int(positions[-1]) + 1 if len(positions) > 0 else 0
+        elif len(positions) > 0 and positions[-1] >= length:
+            raise ValueError("Position %d overflows." % positions[-1])
+        self.length = length
+        self.nSet = len(positions)
+
+        nWords = (length + WORD_BITS - 1) // WORD_BITS
+        wordIdx = positions // WORD_BITS
+        bits = np.left_shift(np.uint64(1),
+                             (positions % WORD_BITS).astype(np.uint64))
+        self.words = np.zeros(nWords, np.uint64)
+        if len(positions) > 0:
+            # Bits are distinct, so adding them up is the same as or-ing them.
+            isFirst = np.ones(len(positions), bool)
+            isFirst[1:] = wordIdx[1:] != wordIdx[:-1]
+            starts = np.flatnonzero(isFirst)
+            self.words[wordIdx[starts]] = np.add.reduceat(bits, starts)
+
+        # The number of bits set before each word.
+        counts = np.bincount(wordIdx, minlength=nWords)
+        self.ranks = np.zeros(nWords + 1, np.int64)
+        np.cumsum(counts, out=self.ranks[1:])
+
+
+    def __len__(self):
+        return self.length
+
+
+    def rank(self, pos):
+        '''Return the number of bits set in [0, pos).'''
+        if pos <= 0:
+            return 0
+        if pos >= self.length:
+            return self.nSet
+        i = pos // WORD_BITS
+        word = int(self.words[i]) & ((1 << (pos % WORD_BITS)) - 1)
+        return int(self.ranks[i]) + popcount(word)
+
+
+    def count(self, start, end):
+        '''Return the number of bits set in [start, end].'''
+        if start > end:
+            return 0
+        return self.rank(end + 1) - self.rank(start)
+
+
+    def select(self, k):
+        '''Return the position of the k-th (0-based) bit set.'''
+        if k < 0 or k >= self.nSet:
+            raise ValueError("Bit %d not found." % k)
+        i = int(self.ranks.searchsorted(k, 'right')) - 1
+        word = int(self.words[i])
+        for j in range(k - int(self.ranks[i])):
+            word &= word - 1    # Clear the lowest bit set.
+        return i * WORD_BITS + (word & -word).bit_length() - 1
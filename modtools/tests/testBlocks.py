@@ -0,0 +1,56 @@
+import unittest
+import numpy as np
+from modtools import blocks
+
+
+class TestBlocks(unittest.TestCase):
+
+    def buildBlocks(self, rows):
+        ops = np.array([ord(row[0]) for row in rows], np.uint8)
+        positions = np.array([row[1] for row in rows], np.int64)
+        alleles = ''.join(row[2] for row in rows)
+        offsets = np.cumsum([0] + [len(row[2]) for row in rows])
+        return blocks.buildBlocks(ops, positions, alleles, offsets)
+
+
+    def test_buildBlocks(self):
+        b = self.buildBlocks([('s', 3, 'A/T'),
+                              ('d', 5, 'C'),
+                              ('i', 5, 'GGG'),
+                              ('i', 5, 'TT'),
+                              ('s', 6, 'A/C'),
+                              ('s', 6, 'A/G'),
+                              ('s', 8, 'A/G'),
+                              ('d', 8, 'A'),
+                              ('d', 9, 'A'),
+                              ('s', 9, 'A/C'),
+                              ('i', 12, 'ACGT')])
+        self.assertEqual(len(b), 6)
+        self.assertEqual(b.getRows(0, len(b)),
+                         [(3, blocks.SUB, 'T', 0),
+                          (5, blocks.DEL, ' ', 5),
+                          (6, blocks.SUB, 'G', 0),
+                          (8, blocks.DEL, ' ', 0),
+                          (9, blocks.SUB, 'C', 0),
+                          (12, blocks.MATCH, ' ', 4)])
+        self.assertEqual(b.getRows(2, 4), [(6, blocks.SUB, 'G', 0),
+                                           (8, blocks.DEL, ' ', 0)])
+
+
+    def test_empty(self):
+        b = self.buildBlocks([])
+        self.assertEqual(len(b), 0)
+        self.assertEqual(b.getRows(0, 1), [])
+
+
+    def test_errors(self):
+        self.assertRaisesRegexp(ValueError, 'line 3', self.buildBlocks,
+                                [('s', 3, 'A/T'), ('s', 5, 'A/T'),
+                                 ('s', 4, 'A/T')])
+        self.assertRaisesRegexp(ValueError, 'Unknown operation v',
+                                self.buildBlocks, [('v', 3, 'A')])
+
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,47 @@
+import unittest
+import numpy as np
+from modtools.cursor import Cursor
+
+
+class TestCursor(unittest.TestCase):
+    
+    def setUp(self):
+        self.keys = np.array([2, 3, 3, 3, 5, 8, 8, 9, 12, 15, 15, 20], np.int64)
+        self.cursor = Cursor(self.keys, lambda start, end: range(start, end), 
+                             windowSize=4)
+        
+
+    def test_search(self):
+        cursor = self.cursor
+        for key in range(0, 23):
+            cursor.advance(key)
+            for side in ['left', 'right']:
+                for offset in range(-2, 6):
+                    self.assertEqual(cursor.search(key+offset, side), 
+                                     self.keys.searchsorted(key+offset, side))
+        self.assertTrue(cursor.isSorted)
+        self.assertTrue(cursor.nFallbacks < cursor.nSearches)
+
+
+    def test_getRows(self):
+        cursor = self.cursor
+        cursor.advance(8)
+        self.assertEqual(cursor.getRow(5), 5)
+        self.assertEqual(cursor.getRow(0), 0)
+        self.assertEqual(cursor.getRows(4, 7), [4, 5, 6])
+        self.assertEqual(cursor.getRows(2, 11), range(2, 11))
+
+
+    def test_unsorted(self):
+        cursor = self.cursor
+        cursor.advance(9)
+        cursor.advance(3)
+        self.assertFalse(cursor.isSorted)
+        cursor.advance(12)
+        self.assertEqual(cursor.search(3, 'left'), 1)
+        self.assertEqual(cursor.search(12, 'right'), 9)
+        self.assertEqual(cursor.nFallbacks, 2)
+        
+        
+if __name__ == '__main__':    
+    unittest.main()
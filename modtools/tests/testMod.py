@@ -4,9 +4,12 @@ Created on Oct 11, 2012
 @author: Shunping Huang
 '''
 
+import os
 import unittest
 import StringIO
 import csv
+import tempfile
+import pysam
 from modtools import mod
 
 class TestMod1(unittest.TestCase):
@@ -93,5 +96,91 @@ d\t1\t44\t0
 
 
 
+class TestMod2(unittest.TestCase):
+    '''Test Case 2: the columnar storage of a tabix-indexed mod file.'''
+
+    def setUp(self):
+        tmpName = tempfile.mkstemp('.tsv')[1]
+        tmpfp = open(tmpName, 'wb')
+        tmpfp.write('#reference=mm9\n'
+                    's\t1\t3\tA/T\n'
+                    'd\t1\t5\tC\n'
+                    'i\t1\t5\tGGG\n'
+                    'd\t1\t6\tA\n'
+                    'i\t1\t8\tTT\n')
+        tmpfp.close()
+        pysam.tabix_index(tmpName, force=True, seq_col=1, start_col=2, 
+                          end_col=2, meta_char='#', zerobased=True)
+        self.mod = mod.Mod(tmpName + '.gz')
+        self.mod.load('1')
+
+
+    def test_load(self):
+        self.assertEqual(len(self.mod), 5)
+        self.assertEqual(self.mod.ops.dtype, 'uint8')
+        self.assertEqual(self.mod.positions.tolist(), [3, 5, 5, 6, 8])
+        self.assertEqual(self.mod.alleles, 'A/TCGGGATT')
+        self.assertEqual(self.mod.alleleOffsets.tolist(), [0, 3, 4, 7, 8, 10])
+
+
+    def test_getRows(self):
+        self.assertEqual(self.mod.getRows(1, 3), [('d', 5, 'C'), ('i', 5, 'GGG')])
+        self.assertEqual(self.mod.getRows(4, 5), [('i', 8, 'TT')])
+        self.assertEqual(self.mod.getRows(5, 5), [])
+
+
+    def test_iterGroups(self):
+        self.assertEqual(list(self.mod.iterGroups()),
+                         [(1, 3, [('s', 3, 'A/T')]),
+                          (2, 5, [('d', 5, 'C'), ('i', 5, 'GGG')]),
+                          (4, 6, [('d', 6, 'A')]),
+                          (5, 8, [('i', 8, 'TT')])])
+
+
+    def test_getPosMap(self):
+        posmap = self.mod.getPosMap('1', 12)
+        self.assertEqual(posmap.data, [(('1', 0), ('1', 0), 5, '+'),
+                                       (('1', 5), ('1', -4), 1, '+'),
+                                       (('1', -5), ('1', 5), 3, '+'),
+                                       (('1', 6), ('1', -7), 1, '+'),
+                                       (('1', 7), ('1', 8), 2, '+'),
+                                       (('1', -8), ('1', 10), 2, '+'),
+                                       (('1', 9), ('1', 12), 3, '+')])
+
+
+    def test_preload(self):
+        self.mod.preload('1', 12, True)
+        ops = self.mod.ops
+        posmap = self.mod.posmap
+        blocks = self.mod.blocks
+        self.mod.load('2')
+        self.assertEqual(len(self.mod.ops), 0)
+        self.assertTrue(self.mod.posmap is None)
+        # Loading again restores the same objects without reading the file.
+        self.mod.load('1')
+        self.assertTrue(self.mod.ops is ops)
+        self.assertTrue(self.mod.getPosMap('1', 12) is posmap)
+        self.assertTrue(self.mod.getBlocks('1') is blocks)
+        self.assertTrue(self.mod.variantIndex is not None)
+        self.assertEqual(self.mod.alleles, 'A/TCGGGATT')
+
+
+    def test_cachePosMap(self):
+        cachedMod = mod.Mod(self.mod.fileName, True)
+        cacheName = cachedMod.getPosMapCacheName('1')
+        expected = self.mod.getPosMap('1', 12).data
+        self.assertEqual(cachedMod.getPosMap('1', 12).data, expected)
+        self.assertTrue(os.path.isfile(cacheName))
+        # The saved map is used by another instance, and only for the same
+        # chromosome length.
+        cachedMod = mod.Mod(self.mod.fileName, True)
+        cachedMod.load('1')
+        self.assertTrue(cachedMod.loadPosMap(12))
+        self.assertEqual(cachedMod.posmap.data, expected)
+        self.assertFalse(cachedMod.loadPosMap(13))
+        os.remove(cacheName)
+
+
+
 if __name__ == '__main__':
     unittest.main()
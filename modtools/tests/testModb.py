@@ -0,0 +1,95 @@
+import os
+import gzip
+import shutil
+import tempfile
+import unittest
+import pysam
+
+from modtools import mod
+from modtools import modb
+from modtools import tmpmod
+
+
+MOD = ('#reference=mm9\n'
+       '#sample=test\n'
+       's\t1\t3\tA/T\n'
+       'd\t1\t5\tC\n'
+       'i\t1\t5\tGGG\n'
+       'd\t1\t6\tA\n'
+       'i\t1\t8\tTT\n'
+       's\t2\t1\tC/G\n')
+
+
+class TestModb(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpDir = tempfile.mkdtemp()
+        self.modName = os.path.join(self.tmpDir, 'test.mod')
+        fp = gzip.open(self.modName, 'wb')
+        fp.write(MOD)
+        fp.close()
+        self.modbName = os.path.join(self.tmpDir, 'test.modb')
+        self.assertEqual(modb.textToModb(self.modName, self.modbName), 6)
+
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpDir)
+
+
+    def test_ModbFile(self):
+        self.assertTrue(modb.isModb(self.modbName))
+        self.assertFalse(modb.isModb(self.modName))
+        modbFile = modb.ModbFile(self.modbName)
+        self.assertEqual(modbFile.header, {'reference': 'mm9',
+                                           'sample': 'test'})
+        self.assertEqual(modbFile.chroms, ['1', '2'])
+        self.assertEqual(modbFile.getRowCounts(), {'1': 5, '2': 1})
+        ops, positions, alleles, offsets = modbFile.getColumns('1')
+        self.assertEqual(ops.tostring(), 'sdidi')
+        self.assertEqual(positions.tolist(), [3, 5, 5, 6, 8])
+        self.assertEqual(alleles, 'A/TCGGGATT')
+        self.assertEqual(offsets.tolist(), [0, 3, 4, 7, 8, 10])
+        self.assertEqual(modbFile.getPositions('2').tolist(), [1])
+        self.assertEqual(tmpmod.getRowCounts(self.modbName),
+                         {'1': 5, '2': 1})
+
+
+    def test_modbToText(self):
+        textName = os.path.join(self.tmpDir, 'test2.mod')
+        self.assertEqual(modb.modbToText(self.modbName, textName), 6)
+        fp = gzip.open(textName, 'rb')
+        self.assertEqual(fp.read(), MOD)
+        fp.close()
+
+
+    def test_Mod(self):
+        # The binary backend loads the same columns as the tabix one.
+        tmpName = os.path.join(self.tmpDir, 'test.tsv')
+        fp = open(tmpName, 'wb')
+        fp.write(MOD)
+        fp.close()
+        pysam.tabix_index(tmpName, force=True, seq_col=1, start_col=2,
+                          end_col=2, meta_char='#', zerobased=True)
+        textMod = mod.Mod(tmpName + '.gz')
+        binaryMod = mod.Mod(self.modbName)
+        self.assertEqual(binaryMod.header, textMod.header)
+        self.assertEqual(sorted(binaryMod.chroms), sorted(textMod.chroms))
+        for chrom in ['1', '2']:
+            textMod.load(chrom)
+            binaryMod.load(chrom)
+            self.assertEqual(list(binaryMod.iterRows()),
+                             list(textMod.iterRows()))
+            self.assertEqual(binaryMod.alleleOffsets.tolist(),
+                             textMod.alleleOffsets.tolist())
+            self.assertEqual(list(binaryMod.iterPositions(chrom)),
+                             list(textMod.iterPositions(chrom)))
+        self.assertEqual(binaryMod.getPosMap('1', 12).data,
+                         textMod.getPosMap('1', 12).data)
+        self.assertEqual(list(binaryMod.iterPositions('3')), [])
+        self.assertEqual(tmpmod.getIndexedMod(self.modbName),
+                         (self.modbName, False))
+
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -5,6 +5,8 @@ Created on Oct 11, 2012
 '''
 
 
+import os
+import tempfile
 import unittest
 from modtools import posmap
 
@@ -99,6 +101,64 @@ class TestMap(unittest.TestCase):
         self.assertRaises(ValueError, self.posmap.bmap, ('0',0))
         self.assertRaises(AssertionError, self.posmap.bmap, ('1',-1))
         self.assertRaises(ValueError, self.posmap.bmap, ('1',45))
+
+    
+    def test_mapMany(self):
+        positions = range(-1, 57)
+        for mapMany, smap in [(self.posmap.fmapMany, self.posmap.fmap),
+                              (self.posmap.bmapMany, self.posmap.bmap)]:
+            mapped, valid = mapMany('1', positions)
+            for pos, newPos, isValid in zip(positions, mapped, valid):
+                try:
+                    expected = smap(('1', pos))[1]
+                except (ValueError, AssertionError):
+                    self.assertFalse(isValid)
+                else:
+                    self.assertTrue(isValid)
+                    self.assertEqual(newPos, expected)
+        
+        mapped, valid = self.posmap.fmapMany('0', [0, 1])
+        self.assertFalse(valid.any())
+
+
+    def test_cursor(self):
+        cmap = self.posmap.getChromMap('1')
+        for smap, cursor in [(cmap.fmap, cmap.getFCursor()),
+                             (cmap.bmap, cmap.getBCursor())]:
+            cursor.windowSize = 3
+            for pos in range(0, 57):
+                cursor.advance(pos)
+                try:
+                    expected = smap(pos)
+                except ValueError:
+                    self.assertRaises(ValueError, smap, pos, cursor)
+                else:
+                    self.assertEqual(smap(pos, cursor), expected)
+            self.assertTrue(cursor.isSorted)
+
+
+    def test_writeChromMap(self):
+        fileName = tempfile.mkstemp('.posmap')[1]
+        cmap = self.posmap.getChromMap('1')
+        posmap.writeChromMap(fileName, cmap, 'key')
+        umask = os.umask(0)
+        os.umask(umask)
+        self.assertEqual(os.stat(fileName).st_mode & 0777, 0666 & ~umask)
+        self.assertTrue(posmap.readChromMap(fileName, '1', 'other') is None)
+        self.assertTrue(posmap.readChromMap(fileName + '.x', '1', 'key') 
+                        is None)
+        saved = posmap.readChromMap(fileName, '1', 'key')
+        self.assertEqual(saved.rows(), cmap.rows())
+        for pos in range(0, 55):
+            for smap, savedMap in [(cmap.fmap, saved.fmap), 
+                                   (cmap.bmap, saved.bmap)]:
+                try:
+                    expected = smap(pos)
+                except ValueError:
+                    self.assertRaises(ValueError, savedMap, pos)
+                else:
+                    self.assertEqual(savedMap(pos), expected)
+        os.remove(fileName)
               
         
 if __name__ == '__main__':    
@@ -0,0 +1,41 @@
+import unittest
+from modtools.rankselect import RankSelect
+
+
+class TestRankSelect(unittest.TestCase):
+    
+    def setUp(self):
+        self.positions = [0, 3, 63, 64, 65, 127, 128, 200, 201, 255]
+        self.bv = RankSelect(self.positions + [3, 64], 300)
+        
+
+    def test_rank(self):
+        self.assertEqual(len(self.bv), 300)
+        for pos in range(-1, 302):
+            self.assertEqual(self.bv.rank(pos), 
+                             len([p for p in self.positions if p < pos]))
+            
+
+    def test_count(self):
+        for start in range(0, 260, 7):
+            for end in range(start - 1, 300, 11):
+                self.assertEqual(self.bv.count(start, end),
+                                 len([p for p in self.positions 
+                                      if start <= p <= end]))
+                
+
+    def test_select(self):
+        for k, pos in enumerate(self.positions):
+            self.assertEqual(self.bv.select(k), pos)
+        self.assertRaises(ValueError, self.bv.select, len(self.positions))
+        
+
+    def test_bounds(self):
+        self.assertEqual(len(RankSelect([5, 2])), 6)
+        self.assertEqual(RankSelect([]).count(0, 100), 0)
+        self.assertRaises(ValueError, RankSelect, [300], 300)
+        self.assertRaises(ValueError, RankSelect, [-1])
+        
+
+if __name__ == '__main__':    
+    unittest.main()
@@ -0,0 +1,73 @@
+import os
+import gzip
+import shutil
+import tempfile
+import unittest
+
+from modtools import tmpmod
+
+
+MOD = ('#reference=mm9\n'
+       's\t1\t3\tA/T\n'
+       'd\t1\t5\tC\n'
+       'i\t2\t8\tTT\n')
+
+
+class TestTmpMod(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpDir = tempfile.mkdtemp()
+        self.modName = os.path.join(self.tmpDir, 'test.mod')
+        fp = gzip.open(self.modName, 'wb')
+        fp.write(MOD)
+        fp.close()
+
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpDir)
+
+
+    def test_getIndexedMod(self):
+        fileName, isTemp = tmpmod.getIndexedMod(self.modName)
+        self.assertEqual(fileName, self.modName + '.bgz')
+        self.assertFalse(isTemp)
+        self.assertEqual(tmpmod.getRowCounts(fileName), {'1': 2, '2': 1})
+        self.assertEqual(sorted(os.listdir(self.tmpDir)),
+                         ['test.mod', 'test.mod.bgz', 'test.mod.bgz.key',
+                          'test.mod.bgz.tbi'])
+
+        # A valid companion is reused as it is.
+        os.utime(fileName, (1000000000, 1000000000))
+        self.assertEqual(tmpmod.getIndexedMod(self.modName), (fileName, False))
+        self.assertEqual(os.stat(fileName).st_mtime, 1000000000)
+
+        # A changed mod file invalidates the companion.
+        mtime = int(os.stat(self.modName).st_mtime) + 100
+        os.utime(self.modName, (mtime, mtime))
+        self.assertEqual(tmpmod.getIndexedMod(self.modName), (fileName, False))
+        self.assertNotEqual(os.stat(fileName).st_mtime, 1000000000)
+
+
+    def test_cacheDir(self):
+        cacheDir = os.path.join(self.tmpDir, 'cache')
+        fileName, isTemp = tmpmod.getIndexedMod(self.modName, cacheDir)
+        self.assertFalse(isTemp)
+        self.assertEqual(os.path.dirname(fileName), cacheDir)
+        self.assertTrue(os.path.basename(fileName).startswith('test.mod.'))
+        self.assertTrue(tmpmod.isValidCompanion(fileName,
+                                                tmpmod.getSourceKey(
+                                                    self.modName)))
+        self.assertEqual(len(os.listdir(cacheDir)), 3)
+
+
+    def test_interrupted(self):
+        fileName = tmpmod.getIndexedMod(self.modName)[0]
+        key = tmpmod.getSourceKey(self.modName)
+        self.assertTrue(tmpmod.isValidCompanion(fileName, key))
+        os.remove(fileName + '.key')
+        self.assertFalse(tmpmod.isValidCompanion(fileName, key))
+
+
+
+if __name__ == '__main__':
+    unittest.main()
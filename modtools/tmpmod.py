@@ -1,18 +1,30 @@
 '''
 Convert a mod format to a tabix accessible format.
 
+The converted file and its index can be kept as a companion of the mod file,
+which is reused as long as the size and the modification time of the mod file
+are unchanged.
+
 Created on Oct 30, 2012
 
 @author: Shunping Huang
 '''
 
+import os
 import logging
 import gzip
+import struct
+import hashlib
 import tempfile
 import pysam
+from modtools import modb
+
 
+__all__ = ['getTabixMod', 'getIndexedMod', 'getRowCounts']
 
-__all__ = ['getTabixMod']
+PSEUDO_BIN = 37450  # The bin of counts in a tabix index
+ROW_BYTES = 4       # Compressed bytes per row of a mod file, roughly
+KEY_VERSION = 1     # Bumped when the format of companions changes
 
 
 def getTabixMod(filename):
@@ -31,4 +43,152 @@ def getTabixMod(filename):
     logger.info('temporary file %s created', tmpName)
     return tmpName
 
+
+def getCompanionName(filename, cacheDir=None):
+    '''
+    Return the file name of the companion of a mod file, which is next to the
+    mod file, or in the cache directory if given. In a cache directory, names
+    have a hash of the full path of the mod file, so that mod files of the
+    same name in different directories do not share a companion.
+    '''
+    if cacheDir is None:
+        return filename + '.bgz'
+    path = os.path.abspath(filename)
+    return os.path.join(cacheDir, "%s.%s.bgz" 
+                        % (os.path.basename(path), 
+                           hashlib.md5(path).hexdigest()[:8]))
+
+
+def getSourceKey(filename):
+    '''Return the key of a mod file, by its size and modification time.'''
+    st = os.stat(filename)
+    return "%d\t%d\t%r\n" % (KEY_VERSION, st.st_size, st.st_mtime)
+
+
+def isValidCompanion(companion, key):
+    '''Return True if the companion and its index exist and match the key.'''
+    if not (os.path.isfile(companion) and os.path.isfile(companion + '.tbi')):
+        return False
+    try:
+        with open(companion + '.key', 'rb') as fp:
+            return fp.read() == key
+    except IOError:
+        return False
+
+
+def buildCompanion(filename, companion, key):
+    '''
+    Build the companion of a mod file. Files are written under temporary names
+    and renamed at the end, and the key is written last, so that a companion 
+    left by an interrupted run is never taken as valid.
+    '''
+    logger = logging.getLogger('tmpmod')
+    logger.info("building MOD index %s ...", companion)
+    dirName = os.path.dirname(os.path.abspath(companion))
+    fd, tmpName = tempfile.mkstemp('.tsv', '.modindex.', dirName)
+    try:
+        with os.fdopen(fd, 'wb') as tmpfp:
+            modfp = gzip.open(filename, 'rb')
+            tmpfp.writelines(modfp)
+            modfp.close()
+        pysam.tabix_index(tmpName, force=True, seq_col=1, start_col=2, 
+                          end_col=2, meta_char='#', zerobased=True)
+        if os.path.exists(companion + '.key'):
+            os.remove(companion + '.key')
+        os.rename(tmpName + '.gz', companion)
+        os.rename(tmpName + '.gz.tbi', companion + '.tbi')
+        with open(tmpName + '.key', 'wb') as fp:
+            fp.write(key)
+        os.rename(tmpName + '.key', companion + '.key')
+    finally:
+        for name in (tmpName, tmpName + '.gz', tmpName + '.gz.tbi', 
+                     tmpName + '.key'):
+            if os.path.exists(name):
+                os.remove(name)
+
+
+def getIndexedMod(filename, cacheDir=None, rebuild=False, useCache=True):
+    '''
+    Return the name of a bgzipped and indexed copy of a mod file, and whether
+    it is a temporary file that the caller should remove.
+    
+    The companion of the mod file is reused if valid, and otherwise built. If
+    it cannot be written, or useCache is False, a temporary file is made as
+    getTabixMod() does. A binary mod file is used as it is.
+    '''
+    logger = logging.getLogger('tmpmod')
+    if modb.isModb(filename):
+        return filename, False
+    if not useCache:
+        return getTabixMod(filename), True
+    companion = getCompanionName(filename, cacheDir)
+    key = getSourceKey(filename)
+    if not rebuild and isValidCompanion(companion, key):
+        logger.info("MOD index %s reused", companion)
+        return companion, False
+    try:
+        if cacheDir is not None and not os.path.isdir(cacheDir):
+            os.makedirs(cacheDir)
+        buildCompanion(filename, companion, key)
+    except (IOError, OSError) as e:
+        logger.warning("cannot write MOD index %s (%s)", companion, e)
+        return getTabixMod(filename), True
+    return companion, False
+
+
+def getRowCounts(filename):
+    '''
+    Return a dict of the numbers of rows of chromosomes in a bgzipped file,
+    read from its tabix index (.tbi) without reading the file.
+    
+    The numbers are exact if the index has the pseudo bins of counts, and 
+    otherwise estimated from the compressed bytes of chromosomes. For a binary
+    mod file, the numbers are read from its directory.
+    '''
+    if modb.isModb(filename):
+        modbFile = modb.ModbFile(filename)
+        counts = modbFile.getRowCounts()
+        modbFile.close()
+        return counts
+    fp = gzip.open(filename + '.tbi', 'rb')
+    data = fp.read()
+    fp.close()
+    if data[:4] != 'TBI\1':
+        raise ValueError("'%s.tbi' is not a tabix index." % filename)
+    
+    nRefs = struct.unpack_from('<i', data, 4)[0]
+    nameLen = struct.unpack_from('<i', data, 32)[0]
+    names = data[36:36+nameLen].split('\0')[:nRefs]
+    offset = 36 + nameLen
+    counts = dict()
+    for name in names:
+        nBins = struct.unpack_from('<i', data, offset)[0]
+        offset += 4
+        start = None
+        end = 0
+        nRows = None
+        for i in range(nBins):
+            binId, nChunks = struct.unpack_from('<Ii', data, offset)
+            offset += 8
+            chunks = struct.unpack_from('<%dQ' % (2*nChunks), data, offset)
+            offset += 16 * nChunks
+            if binId == PSEUDO_BIN:
+                nRows = chunks[2]   # Numbers of mapped and unmapped rows
+            elif nChunks > 0:
+                # The upper 48 bits of a virtual offset is the file offset.
+                chunkStart = min(chunks[0::2]) >> 16
+                if start is None or chunkStart < start:
+                    start = chunkStart
+                end = max(end, max(chunks[1::2]) >> 16)
+        nIntervals = struct.unpack_from('<i', data, offset)[0]
+        offset += 4 + 8 * nIntervals
+        if nRows is None:
+            if start is None:
+                nRows = 0
+            else:
+                # A chromosome in a single block is counted as one row.
+                nRows = max((end - start) // ROW_BYTES, 1)
+        counts[name] = int(nRows)
+    return counts
+
 #print(getTabixMod("../data/B.mod"))
\ No newline at end of file
@@ -19,8 +19,9 @@ setup(
     packages = ['lapels', 'modtools'],
     scripts = ['lapels/scripts/pylapels', 'lapels/scripts/fixmate',
                'modtools/scripts/vcf2mod','modtools/scripts/insilico',
-               'modtools/scripts/modstat'],
-    install_requires = ['pysam>=0.6b', 'argparse>=1.2'],
+               'modtools/scripts/modstat', 'modtools/scripts/modindex',
+               'modtools/scripts/modconvert'],
+    install_requires = ['pysam>=0.6b', 'argparse>=1.2', 'numpy>=1.6'],
     dependency_links = ['http://lapels.googlecode.com/files/pysam-0.6b.tar.gz',],    
     keywords = 'lapels remap position bam mod',
     long_description='''